@@ -1,6 +1,10 @@
 from modulefinder import Module
 from .dataset import *
 from .split import *
+from .patch import *
+from .batch import *
+from .stream import *
+from .sampler import *
 try:
     from .cache import *
     from .remote import *
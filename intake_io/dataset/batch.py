@@ -0,0 +1,163 @@
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+from .index import MAX_NDIM
+
+try:
+    import torch
+except ModuleNotFoundError:
+    torch = None
+
+__all__ = ["ShapeBatchSampler", "PaddedCollate"]
+
+
+class ShapeBatchSampler:
+    """
+    Batch sampler that groups samples of similar shape, using the shape metadata of a dataset instead of loading it.
+
+    Samples are sorted by number of dimensions and shape, ties in random order, and split into batches, so that padding
+    a batch to its largest sample is cheap. Batches never mix numbers of dimensions. Yields lists of indices, e.g. as
+    `batch_sampler` of a PyTorch `DataLoader`.
+    """
+
+    def __init__(self, data: Any, batch_size: int, shuffle: bool = True, drop_last: bool = False, seed: int = 0):
+        """
+        :param data: Dataset with `get_shape`, e.g. :class:`IntakeDataset`
+        :param batch_size: Maximum number of samples per batch
+        :param shuffle: Shuffle samples of the same shape and the order of batches
+        :param drop_last: Drop batches with fewer than `batch_size` samples
+        :param seed: Seed, combined with the epoch set by :meth:`set_epoch`
+        """
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be positive, got {batch_size}.")
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.shapes, self.ndims = _get_shapes(data)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _get_batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.ndims)) if self.shuffle else np.arange(len(self.ndims))
+        # np.lexsort sorts by the last key first
+        keys = [self.shapes[order, d] for d in reversed(range(self.shapes.shape[1]))] + [self.ndims[order]]
+        order = order[np.lexsort(keys)]
+
+        batches = []
+        groups = np.split(order, np.flatnonzero(np.diff(self.ndims[order])) + 1)
+        for group in groups:
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start:start + self.batch_size]
+                if len(batch) == self.batch_size or (len(batch) > 0 and not self.drop_last):
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for batch in self._get_batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        groups = np.unique(self.ndims, return_counts=True)[1]
+        if self.drop_last:
+            return int(np.sum(groups // self.batch_size))
+        return int(np.sum(-(-groups // self.batch_size)))
+
+
+def _get_shapes(data: Any) -> Tuple[np.ndarray, np.ndarray]:
+    # Zero-padded shapes and numbers of dimensions of all samples, from the sample index if there is one
+    index = getattr(data, "_index", None)
+    if index is not None and hasattr(index, "sample_shapes"):
+        return index.sample_shapes()
+    shapes = np.zeros((len(data), MAX_NDIM), np.int64)
+    ndims = np.zeros(len(data), np.uint8)
+    for i in range(len(data)):
+        shape = data.get_shape(i)
+        shapes[i, :len(shape)] = shape
+        ndims[i] = len(shape)
+    return shapes, ndims
+
+
+class PaddedCollate:
+    """
+    Collate function that stacks arrays of different shapes into preallocated buffers, zero-padded to the largest
+    sample of the batch. Use with :class:`ShapeBatchSampler` to keep padding small.
+
+    Buffers are reused: the arrays of a batch are overwritten `num_buffers` calls later, so they must be consumed (e.g.
+    copied to the GPU) before then. The original shape of each sample is returned in "<key>_shape". Other values are
+    returned as lists.
+    """
+
+    def __init__(self, keys: Sequence[str] = ("data",), pad_value: Any = 0, pin_memory: bool = False,
+                 num_buffers: int = 2):
+        """
+        :param keys: Keys of the samples holding arrays or xarray objects to stack
+        :param pad_value: Value to pad with
+        :param pin_memory: Allocate buffers in page-locked memory for faster transfer to the GPU, requires PyTorch
+        :param num_buffers: Number of buffers per key used in turn, i.e. number of batches that can be in use at once
+        """
+        if pin_memory and torch is None:
+            raise ModuleNotFoundError("Pinned memory requires optional dependency torch, which is not installed.")
+        if num_buffers < 1:
+            raise ValueError(f"Number of buffers must be positive, got {num_buffers}.")
+        self.keys = tuple(keys)
+        self.pad_value = pad_value
+        self.pin_memory = pin_memory
+        self.num_buffers = num_buffers
+        self._buffers = {}
+        self._calls = {}
+
+    def __call__(self, samples: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+        out = {}
+        for k in samples[0]:
+            if k in self.keys:
+                arrays = [_as_array(sample[k]) for sample in samples]
+                out[k] = self._stack(k, arrays)
+                out[f"{k}_shape"] = np.array([a.shape for a in arrays], np.int64)
+            else:
+                out[k] = [sample[k] for sample in samples]
+        return out
+
+    def _stack(self, key: str, arrays: List[np.ndarray]) -> np.ndarray:
+        ndims = {a.ndim for a in arrays}
+        if len(ndims) > 1:
+            raise ValueError(f'Arrays of "{key}" have different numbers of dimensions: {sorted(ndims)}.')
+        shape = tuple(np.max([a.shape for a in arrays], 0)) if arrays[0].ndim > 0 else ()
+        dtype = np.result_type(*arrays)
+        out = self._get_buffer(key, len(arrays) * int(np.prod(shape)) * dtype.itemsize)
+        out = out[:len(arrays) * int(np.prod(shape)) * dtype.itemsize].view(dtype).reshape(len(arrays), *shape)
+        for i, a in enumerate(arrays):
+            out[(i, *[slice(0, n) for n in a.shape])] = a
+            # Pad only what the sample doesn't cover
+            for d, n in enumerate(a.shape):
+                if n < shape[d]:
+                    out[(i, *[slice(None)] * d, slice(n, None))] = self.pad_value
+        return out
+
+    def _get_buffer(self, key: str, nbytes: int) -> np.ndarray:
+        buffers = self._buffers.setdefault(key, [None] * self.num_buffers)
+        i = self._calls.get(key, 0) % self.num_buffers
+        self._calls[key] = i + 1
+        if buffers[i] is None or buffers[i].nbytes < nbytes:
+            # Grow geometrically, so that buffers settle at the size of the largest bucket
+            nbytes = max(nbytes, 0 if buffers[i] is None else buffers[i].nbytes * 3 // 2)
+            if self.pin_memory:
+                buffers[i] = torch.empty(nbytes, dtype=torch.uint8).pin_memory().numpy()
+            else:
+                buffers[i] = np.empty(nbytes, np.uint8)
+        return buffers[i]
+
+
+def _as_array(x: Any) -> np.ndarray:
+    if isinstance(x, xr.Dataset):
+        x = x["image"]
+    if isinstance(x, xr.DataArray):
+        return x.values
+    return np.asarray(x)
@@ -1,26 +1,383 @@
+import hashlib
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+import weakref
 from copy import deepcopy
+from multiprocessing.shared_memory import SharedMemory
 import lmdb
+import numpy as np
 from .serialization import serialize as _serialize, deserialize as _deserialize
+from .util import fingerprint_callable
+
+_ACCESS = struct.Struct("<dQQ")  # last access time, number of accesses, size in bytes
+_TOTAL_KEY = b"\x00total"
+_ACCESS_DB = b"__access__"
+_SHM_HEADER = struct.Struct("<QQQ")  # data write offset, next index slot, number of evictions
+_SHM_INDEX = np.dtype([("k0", "<u8"), ("k1", "<u8"), ("offset", "<u8"), ("nbytes", "<u8"), ("pins", "<i8")])
+_SHM_TABLE = np.dtype("<i8")  # index slot + 1 of each hash table position, 0 if empty
+_SHM_ALIGNMENT = 64
+
+
+class Transform:
+    """
+    Stage of a transform chain for :class:`CachedDataset`.
+
+    Outputs of the leading run of deterministic stages are cached, keyed by a fingerprint of these stages. Stochastic
+    stages, and all stages after the first stochastic one, run on every access.
+
+    :param fn: Callable
+    :param deterministic: Whether `fn` always returns the same output for the same input
+    :param fingerprint: Identifies the configuration of `fn`, derived from `fn` if `None` (see
+        :func:`fingerprint_callable`). Set explicitly if `fn` depends on state that isn't captured, e.g. global
+        variables, or if it can't be fingerprinted.
+    """
+
+    def __init__(self, fn, deterministic=False, fingerprint=None):
+        self.fn = fn
+        self.deterministic = deterministic
+        self._fingerprint = fingerprint
+
+    def __call__(self, x):
+        return self.fn(x)
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is not None:
+            return str(self._fingerprint)
+        return fingerprint_callable(self.fn)
+
+
+def deterministic(fn, fingerprint=None):
+    return Transform(fn, True, fingerprint)
+
+
+def stochastic(fn):
+    return Transform(fn, False)
+
+
+class SharedMemoryCache:
+    """
+    In-memory cache tier shared by all processes that hold a (pickled) copy, e.g. DataLoader workers.
+
+    Serialized entries are stored in a ring buffer in shared memory and evicted first in, first out. Keys are found
+    through an open addressing hash table, so lookups under the cross-process lock take constant time. :meth:`get`
+    returns read-only views, entries stay pinned while views of them are alive and are not overwritten.
+
+    :param size_gb: Budget for entries in GB
+    :param max_entries: Maximum number of entries, defaults to one per 64 KB of budget but at least 1024
+    """
+
+    def __init__(self, size_gb, max_entries=None):
+        self.size_gb = size_gb
+        self.max_entries = max(1024, int(size_gb * 1024**3) // 2**16) if max_entries is None else max_entries
+        self._shm = SharedMemory(create=True, size=self._data_offset() + int(size_gb * 1024**3))
+        self._lock = multiprocessing.get_context("spawn").Lock()
+        self._attach()
+        self._finalizer = weakref.finalize(self, _unlink, self._shm)
+
+    def _table_size(self):
+        # Power of two with at least half of the positions empty
+        return 1 << (2 * self.max_entries - 1).bit_length()
+
+    def _data_offset(self):
+        return _shm_align(_SHM_HEADER.size + self.max_entries * _SHM_INDEX.itemsize +
+                          self._table_size() * _SHM_TABLE.itemsize)
+
+    def _attach(self):
+        buf = self._shm.buf
+        self._header = np.frombuffer(buf, "<u8", 3)
+        self._index = np.frombuffer(buf, _SHM_INDEX, self.max_entries, _SHM_HEADER.size)
+        self._table = np.frombuffer(buf, _SHM_TABLE, self._table_size(),
+                                    _SHM_HEADER.size + self.max_entries * _SHM_INDEX.itemsize)
+        self._data = np.frombuffer(buf, np.uint8, offset=self._data_offset())
+
+    def __getstate__(self):
+        return {"size_gb": self.size_gb, "max_entries": self.max_entries, "_name": self._shm.name, "_lock": self._lock}
+
+    def __setstate__(self, state):
+        self.size_gb = state["size_gb"]
+        self.max_entries = state["max_entries"]
+        self._lock = state["_lock"]
+        self._shm = SharedMemory(state["_name"])
+        self._attach()
+
+    @staticmethod
+    def _digest(k):
+        h = hashlib.blake2b(k, digest_size=16).digest()
+        return int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little")
+
+    def _position(self, k0, k1):
+        # Position of a key in the hash table, linear probing from k0
+        mask = len(self._table) - 1
+        p = k0 & mask
+        while self._table[p] != 0:
+            i = int(self._table[p]) - 1
+            if self._index["k0"][i] == k0 and self._index["k1"][i] == k1:
+                return p
+            p = (p + 1) & mask
+        return None
+
+    def _find(self, k0, k1):
+        p = self._position(k0, k1)
+        return None if p is None else int(self._table[p]) - 1
+
+    def _insert(self, k0, i):
+        mask = len(self._table) - 1
+        p = k0 & mask
+        while self._table[p] != 0:
+            p = (p + 1) & mask
+        self._table[p] = i + 1
+
+    def _remove(self, i):
+        # Backward shift deletion, so that probe sequences stay unbroken without tombstones
+        mask = len(self._table) - 1
+        p = self._position(int(self._index["k0"][i]), int(self._index["k1"][i]))
+        j = p
+        while True:
+            j = (j + 1) & mask
+            if self._table[j] == 0:
+                break
+            home = int(self._index["k0"][int(self._table[j]) - 1]) & mask
+            # Move the entry at j to p unless its home lies cyclically in (p, j]
+            if (j > p and (home <= p or home > j)) or (j < p and p >= home > j):
+                self._table[p] = self._table[j]
+                p = j
+        self._table[p] = 0
+
+    def __contains__(self, k):
+        with self._lock:
+            return self._find(*self._digest(k)) is not None
+
+    def get(self, k):
+        k0, k1 = self._digest(k)
+        with self._lock:
+            i = self._find(k0, k1)
+            if i is None:
+                return None
+            self._index["pins"][i] += 1
+            offset, nbytes = int(self._index["offset"][i]), int(self._index["nbytes"][i])
+        out = self._data[offset:offset + nbytes]
+        out.flags.writeable = False
+        weakref.finalize(out, self._unpin, i)
+        return out
+
+    def _unpin(self, i):
+        with self._lock:
+            self._index["pins"][i] -= 1
+
+    def put(self, k, v):
+        v = memoryview(v).cast("B")
+        size = _shm_align(v.nbytes)
+        if size > len(self._data):
+            return False
+        k0, k1 = self._digest(k)
+        with self._lock:
+            if self._find(k0, k1) is not None:
+                return True
+            head, slot, num_evicted = (int(i) for i in self._header)
+            offsets = self._index["offset"]
+            ends = offsets + self._index["nbytes"]
+            used = (self._index["k0"] != 0) | (self._index["k1"] != 0)
+            wrapped = False
+            while True:
+                if head + size > len(self._data):
+                    if wrapped:
+                        return False
+                    head = 0
+                    wrapped = True
+                overlap = used & (offsets < head + size) & (ends > head)
+                overlap[slot] |= used[slot]
+                pinned = overlap & (self._index["pins"] > 0)
+                if not np.any(pinned):
+                    break
+                if pinned[slot]:
+                    return False
+                # Skip over entries that are in use
+                head = _shm_align(int(ends[pinned].max()))
+            for i in np.flatnonzero(overlap):
+                self._remove(int(i))
+            self._index[overlap] = np.zeros((), _SHM_INDEX)
+            self._data[head:head + v.nbytes] = v
+            self._index[slot] = (k0, k1, head, v.nbytes, 0)
+            self._insert(k0, slot)
+            self._header[:] = (head + size, (slot + 1) % self.max_entries, num_evicted + int(overlap.sum()))
+        return True
+
+    def stats(self):
+        with self._lock:
+            used = (self._index["k0"] != 0) | (self._index["k1"] != 0)
+            return dict(evictions=int(self._header[2]), size_bytes=int(self._index["nbytes"][used].sum()),
+                        num_entries=int(used.sum()))
+
+    def close(self):
+        del self._header, self._index, self._table, self._data
+        finalizer = getattr(self, "_finalizer", None)
+        if finalizer is not None:
+            finalizer()
+        else:
+            try:
+                self._shm.close()
+            except BufferError:
+                pass
+
+
+def _shm_align(n):
+    return (n + _SHM_ALIGNMENT - 1) // _SHM_ALIGNMENT * _SHM_ALIGNMENT
+
+
+def _unlink(shm):
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        # Views are still alive, the memory is released once they are
+        pass
+
+
+def _write_behind(cache_dir, map_size_gb, max_size_gb, eviction, kwargs, q, batch_size, interval):
+    # Single writer, commits entries handed over by all copies of a CachedDataset in large batches
+    cache = CachedDataset(None, cache_dir, map_size_gb, max_size_gb=max_size_gb, eviction=eviction, **kwargs)
+    last = time.monotonic()
+    try:
+        while True:
+            try:
+                item = q.get(timeout=interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                pending, accesses = item
+                cache._pending.update(pending)
+                for k, (t, n) in accesses.items():
+                    t0, n0 = cache._accesses.get(k, (0.0, 0))
+                    cache._accesses[k] = (max(t, t0), n + n0)
+            if len(cache._pending) >= batch_size or time.monotonic() - last >= interval:
+                cache.flush()
+                last = time.monotonic()
+    finally:
+        cache.close()
+
+
+class _Readers:
+    # Read transactions of CachedDataset.get and the number of arrays alive that view each. LMDB unmaps its memory when
+    # the map is resized or the environment is closed, which has to wait until no such arrays are alive.
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.txn = None
+        self.num_views = {}
+        self.on_idle = []
+
+    def busy(self):
+        return len(self.num_views) > 0
+
+    def acquire(self, txn):
+        self.num_views[txn] = self.num_views.get(txn, 0) + 1
+
+    def release(self, txn):
+        with self.lock:
+            self.num_views[txn] -= 1
+            if self.num_views[txn] == 0:
+                del self.num_views[txn]
+                if txn is not self.txn:
+                    txn.abort()
+            if not self.busy():
+                callbacks, self.on_idle = self.on_idle, []
+                for fn in callbacks:
+                    fn()
+
+
+def _stop_writer(q, writer):
+    if writer.is_alive():
+        q.put(None)
+        writer.join()
 
 
 class CachedDataset:
 
-    def __init__(self, data, cache_dir, map_size_gb=1, transform=None, flush_every_n=1, **kwargs):
+    def __init__(self, data, cache_dir, map_size_gb=1, transform=None, flush_every_n=1, max_size_gb=None,
+                 eviction="lru", write_behind=False, write_behind_batch=256, write_behind_interval=1.0,
+                 ram_cache_gb=None, **kwargs):
+        if eviction not in ("lru", "lfu"):
+            raise ValueError(f'Unknown eviction policy "{eviction}", supports "lru" and "lfu".')
         self.data = data
         self.cache_dir = cache_dir
         self.map_size_gb = map_size_gb
         self._kwargs = deepcopy(kwargs)
         self.transform = transform
         self.flush_every_n = flush_every_n
+        self.max_size_gb = max_size_gb
+        self.eviction = eviction
+        self.write_behind = write_behind
+        self.write_behind_batch = write_behind_batch
+        self.write_behind_interval = write_behind_interval
+        self._write_queue = None
+        self._ram = None if ram_cache_gb is None else SharedMemoryCache(ram_cache_gb)
         self._setup()
 
     def _setup(self):
-        self._cache = lmdb.open(path=self.cache_dir, map_size=self.map_size_gb * 1024**3, **self._kwargs)
-        self._write_txn_ = None
+        self._setup_transforms()
+        kwargs = dict(self._kwargs)
+        kwargs["max_dbs"] = max(kwargs.get("max_dbs", 0), 1)
+        self._cache = lmdb.open(path=self.cache_dir, map_size=int(self.map_size_gb * 1024**3), **kwargs)
+        self._access_db = self._cache.open_db(_ACCESS_DB, create=not kwargs.get("readonly", False))
+        self._pending = {}
+        self._accesses = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._ram_hits = 0
+        self._readers = _Readers()
+        if self.write_behind and self._write_queue is None:
+            self._start_writer()
+
+    def _start_writer(self):
+        # Copies, incl. those in DataLoader worker processes, share the queue and never open write transactions, so
+        # that they don't contend for LMDB's writer lock.
+        ctx = multiprocessing.get_context("spawn")
+        self._write_queue = ctx.Queue(maxsize=64)
+        writer = ctx.Process(target=_write_behind, daemon=True, args=(
+            self.cache_dir, self.map_size_gb, self.max_size_gb, self.eviction, self._kwargs, self._write_queue,
+            self.write_behind_batch, self.write_behind_interval))
+        writer.start()
+        self._writer = weakref.finalize(self, _stop_writer, self._write_queue, writer)
+
+    def _setup_transforms(self):
+        if self.transform is None:
+            transforms = []
+        elif isinstance(self.transform, (list, tuple)):
+            transforms = list(self.transform)
+        else:
+            transforms = [self.transform]
+        transforms = [t if isinstance(t, Transform) else Transform(t, getattr(t, "deterministic", False))
+                      for t in transforms]
+
+        n = 0
+        while n < len(transforms) and transforms[n].deterministic:
+            n += 1
+        self._cached_transforms = transforms[:n]
+        self._uncached_transforms = transforms[n:]
+        if n > 0:
+            h = hashlib.sha1("".join(t.fingerprint for t in self._cached_transforms).encode())
+            self._key_suffix = "@" + h.hexdigest()[:16]
+        else:
+            self._key_suffix = ""
+
+    def _key(self, x):
+        return f"{x}{self._key_suffix}".encode()
 
     def __copy__(self):
-        self.flush()
-        return CachedDataset(deepcopy(self.data), self.cache_dir, self.map_size_gb, deepcopy(self.transform), self.flush_every_n, **deepcopy(self._kwargs))
+        state = self.__getstate__()
+        state["data"] = deepcopy(self.data)
+        state["transform"] = deepcopy(self.transform)
+        state["_kwargs"] = deepcopy(self._kwargs)
+        out = type(self).__new__(type(self))
+        out.__setstate__(state)
+        return out
 
     def __deepcopy__(self, *args):
         return self.__copy__()
@@ -28,7 +385,8 @@ class CachedDataset:
     def __getstate__(self):
         self.flush()
         return {k: getattr(self, k) for k in (
-            "data", "cache_dir", "map_size_gb", "_kwargs", "transform", "flush_every_n"
+            "data", "cache_dir", "map_size_gb", "_kwargs", "transform", "flush_every_n", "max_size_gb", "eviction",
+            "write_behind", "write_behind_batch", "write_behind_interval", "_write_queue", "_ram"
         )}
 
     def __setstate__(self, state):
@@ -43,13 +401,15 @@ class CachedDataset:
     #         return self.data.__getattr__(x)
 
     def __getitem__(self, x):
-        k = str(x).encode()
+        k = self._key(x)
         y = self.get(k)
         if y is None:
             y = self.data[x]
+            for t in self._cached_transforms:
+                y = t(y)
             self.put(k, y)
-        if self.transform is not None:
-            y = self.transform(y)
+        for t in self._uncached_transforms:
+            y = t(y)
         return y
 
     # def __iter__(self):
@@ -57,36 +417,193 @@ class CachedDataset:
     #         yield self[i]
 
     def get(self, k):
-        with self._cache.begin(buffers=True, write=False) as txn:
-            y = txn.get(k, None)
-            if y is not None:
-                y = self._deserialize(y)
+        y = self._pending.get(k)
+        if y is None and self._ram is not None:
+            y = self._ram.get(k)
+            self._ram_hits += y is not None
+        if y is None:
+            y = self._get_stored(k)
+            if y is not None and self._ram is not None:
+                self._ram.put(k, y)
+        if y is None:
+            self._misses += 1
+        else:
+            y = self._deserialize(y)
+            self._hits += 1
+            self._record_access(k)
+        return y
+
+    def _get_stored(self, k):
+        # Stored entry as a view of LMDB's memory map, without copying. The view is only valid while its read
+        # transaction is open, so the transaction stays open until all arrays viewing it are gone. It is replaced once
+        # it's outdated, so that entries written since become visible and LMDB can reuse freed pages.
+        readers = self._readers
+        with readers.lock:
+            if readers.txn is None or readers.txn.id() < self._cache.info()["last_txnid"]:
+                self._renew_read_txn()
+            txn = readers.txn
+            y = None if txn is None else txn.get(k, None)
+            if y is None:
+                return None
+            y = np.frombuffer(y, np.uint8)
+            readers.acquire(txn)
+        # Deserialized arrays are views of y, so y is collected once none of them is alive
+        weakref.finalize(y, readers.release, txn)
         return y
 
-    def _write_txn(self, buffers=True, write=True):
-        if self._write_txn_ is None:
-            self._write_txn_ = self._cache.begin(buffers=buffers, write=write)
-            self._n = 0
-        return self._write_txn_
+    def _renew_read_txn(self):
+        readers = self._readers
+        try:
+            txn = self._cache.begin(buffers=True)
+        except lmdb.MapResizedError:
+            if readers.busy():
+                # Another process grew the map. Adopting its size remaps, keep reading the previous snapshot until
+                # the arrays viewing the current map are gone.
+                return
+            self._resize(0)
+            txn = self._cache.begin(buffers=True)
+        if readers.txn is not None and readers.txn not in readers.num_views:
+            readers.txn.abort()
+        readers.txn = txn
+
+    def _resize(self, map_size):
+        # False if arrays viewing the current map are alive
+        readers = self._readers
+        with readers.lock:
+            if readers.busy():
+                return False
+            if readers.txn is not None:
+                readers.txn.abort()
+                readers.txn = None
+            self._cache.set_mapsize(map_size)
+            return True
 
     def put(self, k, v):
-        self._write_txn().put(k, self._serialize(v))
-        self._n += 1
-        if self._n >= self.flush_every_n:
+        self.put_serialized(k, self._serialize(v))
+
+    def put_serialized(self, k, v):
+        self._pending[k] = v
+        if self._ram is not None:
+            self._ram.put(k, v)
+        self._record_access(k)
+        if len(self._pending) >= self.flush_every_n:
+            self.flush()
+
+    def _record_access(self, k):
+        # Access statistics are buffered and written with the next flush, to keep reads free of write transactions.
+        _, n = self._accesses.get(k, (0.0, 0))
+        self._accesses[k] = (time.time(), n + 1)
+        if len(self._accesses) >= max(self.flush_every_n, 1024):
             self.flush()
 
+    def _begin(self, **kwargs):
+        try:
+            return self._cache.begin(**kwargs)
+        except lmdb.MapResizedError:
+            # Another process grew the map
+            if not self._resize(0):
+                raise
+            return self._cache.begin(**kwargs)
+
     def flush(self):
-        if self._write_txn_ is None:
+        if len(self._pending) == 0 and len(self._accesses) == 0:
+            return
+        if self._write_queue is not None:
+            self._write_queue.put((self._pending, self._accesses))
+            self._pending = {}
+            self._accesses = {}
             return
-        self._write_txn_.commit()
-        self._n = 0
-        self._write_txn_ = None
+        while True:
+            try:
+                with self._begin(write=True) as txn:
+                    num_evicted = self._write(txn)
+                break
+            except (lmdb.MapFullError, lmdb.MapResizedError) as ex:
+                if isinstance(ex, lmdb.MapResizedError) or not self._resize(2 * self._cache.info()["map_size"]):
+                    # The map can't be remapped while arrays read from it are alive. Retried with the next flush,
+                    # pending entries are served from memory meanwhile.
+                    return
+        self._evictions += num_evicted
+        self._pending = {}
+        self._accesses = {}
+
+    def _write(self, txn):
+        total = self._get_total(txn)
+        for k, (t, n) in self._accesses.items():
+            record = txn.get(k, db=self._access_db)
+            last, count, nbytes = (0.0, 0, 0) if record is None else _ACCESS.unpack(record)
+            if k in self._pending:
+                txn.put(k, self._pending[k])
+                total += len(self._pending[k]) - nbytes
+                nbytes = len(self._pending[k])
+            elif record is None:
+                # Evicted in the meantime
+                continue
+            txn.put(k, _ACCESS.pack(max(last, t), count + n, nbytes), db=self._access_db)
+
+        num_evicted = 0
+        if self.max_size_gb is not None and total > self.max_size_gb * 1024**3:
+            # Evict down to 90% of the budget, so that eviction doesn't run on every flush
+            freed, num_evicted = self._evict(txn, total - int(0.9 * self.max_size_gb * 1024**3))
+            total -= freed
+        txn.put(_TOTAL_KEY, struct.pack("<Q", total), db=self._access_db)
+        return num_evicted
+
+    def _get_total(self, txn):
+        total = txn.get(_TOTAL_KEY, db=self._access_db)
+        return 0 if total is None else struct.unpack("<Q", total)[0]
+
+    def _evict(self, txn, nbytes):
+        records = []
+        for k, record in txn.cursor(db=self._access_db):
+            if k == _TOTAL_KEY:
+                continue
+            last, count, size = _ACCESS.unpack(record)
+            records.append((count if self.eviction == "lfu" else 0, last, size, k))
+        records.sort()
+
+        freed = 0
+        num_evicted = 0
+        for _, _, size, k in records:
+            if freed >= nbytes:
+                break
+            txn.delete(k)
+            txn.delete(k, db=self._access_db)
+            freed += size
+            num_evicted += 1
+        return freed, num_evicted
+
+    def stats(self):
+        self.flush()
+        with self._begin() as txn:
+            size = self._get_total(txn)
+            num_entries = txn.stat(self._access_db)["entries"] - (txn.get(_TOTAL_KEY, db=self._access_db) is not None)
+        out = dict(hits=self._hits, misses=self._misses, evictions=self._evictions, size_bytes=size,
+                   num_entries=num_entries)
+        if self._ram is not None:
+            out["ram"] = dict(self._ram.stats(), hits=self._ram_hits)
+        return out
 
     def __len__(self):
         return len(self.data)
 
     def close(self):
         self.flush()
+        writer = getattr(self, "_writer", None)
+        if writer is not None:
+            # Blocks until the writer committed everything handed over so far
+            writer()
+        if self._ram is not None:
+            self._ram.close()
+        readers = self._readers
+        with readers.lock:
+            if readers.txn is not None and readers.txn not in readers.num_views:
+                readers.txn.abort()
+            readers.txn = None
+            if readers.busy():
+                # Closing unmaps, wait until the arrays read from the map are gone
+                readers.on_idle.append(self._cache.close)
+                return
         self._cache.close()
 
     def _serialize(self, x):
@@ -1,10 +1,19 @@
+import os
+import queue
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
 from functools import cached_property
-from typing import Any, Tuple, Dict, Union
+from typing import Any, Tuple, Dict, Iterator, List, Optional, Sequence, Union
 
 import intake
 import numpy as np
 from intake.catalog import Catalog
 
+from .index import SampleIndex
+from .statistics import compute_statistics
 from .util import *
 from .. import io
 
@@ -31,11 +40,19 @@ class Dataset:
 
 class IntakeDataset(Dataset):
 
-    def __init__(self, catalog: Union[str, Catalog]):
+    def __init__(self, catalog: Union[str, Catalog], index_path: Optional[str] = None, num_workers: int = 8,
+                 timeout: Optional[float] = None, errors: str = "raise"):
         super().__init__()
         self._items = []
-        self._num_partitions = []
-        self._cumsum_partitions = []
+        self._index = None
+        if errors not in ("raise", "skip"):
+            raise ValueError(f'Unknown error policy "{errors}", supports "raise" and "skip".')
+        # Manifest of discovered catalog items. Items found in it aren't discovered again, it's updated if items are
+        # added to the catalog.
+        self._index_path = index_path
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.errors = errors
         if isinstance(catalog, Catalog):
             self._parse_catalog(catalog)
         else:
@@ -47,7 +64,7 @@ class IntakeDataset(Dataset):
         self.close()
 
     def __len__(self):
-        return self._cumsum_partitions[-1]
+        return len(self._index)
 
     def close(self):
         for item in self._items:
@@ -61,68 +78,130 @@ class IntakeDataset(Dataset):
         return {"data": io.imload(src, partition=partition)}
 
     def _parse_catalog(self, catalog: Catalog):
-        self._items.extend(getattr(catalog, i) for i in list(catalog))
-
-        # get nr of partitions per item
-        for item in self._items:
-            item.discover()
-            if "i" in item.metadata["axes"]:
-                assert item.metadata["axes"].index("i") == 0
-                assert item.npartitions == item.shape[0]
-                self._num_partitions.append(item.npartitions)
+        names = list(catalog)
+        items = [getattr(catalog, i) for i in names]
+
+        known = {}
+        if self._index_path is not None and os.path.exists(self._index_path):
+            index = SampleIndex.load(self._index_path)
+            known = dict(zip(index.names, index.items))
+        records = [known.get(name) for name in names]
+        missing = [i for i, record in enumerate(records) if record is None]
+        self._discover(names, items, records, missing)
+
+        keep = [i for i, record in enumerate(records) if record is not None]
+        self._items.extend(items[i] for i in keep)
+        self._index = SampleIndex.from_records([records[i] for i in keep])
+        if self._index_path is not None and (len(missing) > 0 or len(known) != len(keep)):
+            self.save_index(self._index_path)
+
+    def _discover(self, names, items, records, ixs):
+        # Each item runs on its own daemon thread, at most num_workers at a time. The timeout of an item counts from
+        # when its thread starts, and an item that timed out frees its slot, since its thread can't be stopped.
+        results = queue.Queue()
+
+        def _task(i):
+            try:
+                items[i].discover()
+                results.put((i, SampleIndex.record(names[i], items[i]), None))
+            except Exception as ex:
+                results.put((i, None, ex))
+
+        def _fail(i, ex):
+            if self.errors == "raise":
+                raise ex
+            warnings.warn(f"Skipping catalog item {names[i]}: {ex!r}")
+
+        queued = deque(ixs)
+        running = {}  # start time of each running item
+        while len(queued) > 0 or len(running) > 0:
+            while len(queued) > 0 and len(running) < self.num_workers:
+                i = queued.popleft()
+                running[i] = time.monotonic()
+                threading.Thread(target=_task, args=(i,), daemon=True).start()
+            timeout = None
+            if self.timeout is not None:
+                timeout = max(min(running.values()) + self.timeout - time.monotonic(), 0)
+            try:
+                i, record, ex = results.get(timeout=timeout)
+            except queue.Empty:
+                now = time.monotonic()
+                for i in [i for i, start in running.items() if now - start >= self.timeout]:
+                    del running[i]
+                    _fail(i, TimeoutError(f"Discovery took longer than {self.timeout} s."))
+                continue
+            if i not in running:
+                # Finished after timing out
+                continue
+            del running[i]
+            if ex is not None:
+                _fail(i, ex)
             else:
-                self._num_partitions.append(1)
+                records[i] = record
 
-        # cumsum partitions to map linear indices to catalog items & their partitions
-        self._cumsum_partitions = np.cumsum(self._num_partitions)
+    def save_index(self, path: str):
+        self._index.save(path)
 
-    def _get_item_partition_ixs(self, i: int) -> Tuple[int, int]:
-        if i < 0 or i >= len(self):
-            raise IndexError("Index out of range.")
-        item_ix = int(np.argwhere(self._cumsum_partitions > i)[0])
-        partition_ix = i - (self._cumsum_partitions[item_ix - 1] if item_ix > 0 else 0)
-        if self._num_partitions[item_ix] == 1:
-            partition_ix = None
-        return item_ix, partition_ix
+    def _get_item_partition_ixs(self, i: int) -> Tuple[int, Optional[int]]:
+        return self._index.locate(i)
 
     def get_dtype(self, i: int) -> np.dtype:
-        item_ix, _ = self._get_item_partition_ixs(i)
-        return self._items[item_ix].dtype
+        return self._index.get_dtype(i)
 
     def get_shape(self, i: int) -> Tuple[int, ...]:
-        item_ix, _ = self._get_item_partition_ixs(i)
-        shape = self._items[item_ix].shape
-        return shape[self._num_partitions[item_ix] - 1:]
+        return self._index.get_shape(i)
 
     @cached_property
     def median_shape(self) -> Tuple[int, ...]:
-        shapes = [self.get_shape(i) for i in range(self.__len__())]
-        ndims = np.asarray([len(i) for i in shapes])
-        assert np.all(ndims == ndims[0])
-        median = np.median(np.asarray(shapes), axis=0)
-        return tuple(map(int, np.round(median)))
+        return tuple(map(int, np.round(self._index.median_shape())))
 
-    def get_spacing(self, i: int) -> Tuple[float, ...]:
-        item_ix, _ = self._get_item_partition_ixs(i)
-        return self._items[item_ix].metadata["spacing"]
+    def get_spacing(self, i: int) -> Dict[str, Optional[float]]:
+        return self._index.get_spacing(i)
 
     @cached_property
-    def median_spacing(self) -> Tuple[float, ...]:
-        spacings = [self.get_spacing(i) for i in range(self.__len__())]
-        ndims = np.asarray([len(i) for i in spacings])
-        assert np.all(ndims == ndims[0])
-        return tuple(np.median(np.asarray(spacings), axis=0))
+    def median_spacing(self) -> Tuple[Optional[float], ...]:
+        return tuple(self._index.median_spacing().values())
+
+    def compute_statistics(self, cache_path: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        return compute_statistics(self, cache_path, fingerprint=self._index.fingerprint, **kwargs)
 
     def get_metadata(self, i: int) -> Dict[str, Any]:
         item_ix, _ = self._get_item_partition_ixs(i)
         return self._items[item_ix].discover()
 
 
+def _get_category_index(data: IntakeDataset, path: Optional[str], fn: Any,
+                        fn_fingerprint: Optional[str] = None) -> CategoryIndex:
+    # Cached on disk if a path is given, rebuilt if the catalog or the user function changed
+    if path is not None and fn_fingerprint is None:
+        try:
+            fn_fingerprint = fingerprint_callable(fn)
+        except ValueError as ex:
+            raise ValueError(f"Can't fingerprint {fn!r} to key the category index, pass category_index_fingerprint "
+                             f"explicitly.") from ex
+    fingerprint = f"{data._index.fingerprint}:{fn_fingerprint}"
+    if path is not None and os.path.exists(path):
+        index = CategoryIndex.load(path, fingerprint)
+        if index is not None and index.num_samples == len(data):
+            return index
+    index = CategoryIndex.build(data, data.num_workers)
+    if path is not None:
+        try:
+            index.save(path, fingerprint)
+        except ValueError as ex:
+            warnings.warn(f"Not caching the category index: {ex}")
+    return index
+
+
 class CategorizedDataset(IntakeDataset):
 
-    def __init__(self, catalog: Union[str, Catalog], get_category, loader=None):
-        super().__init__(catalog, loader)
+    def __init__(self, catalog: Union[str, Catalog], get_category, loader=None, category_index_path: Optional[str] = None,
+                 category_index_fingerprint: Optional[str] = None, **kwargs):
+        super().__init__(catalog, **kwargs)
         self._get_category = get_category
+        # The cached index is reused while the catalog and the fingerprint of `get_category` are unchanged
+        self._category_index_path = category_index_path
+        self._category_index_fingerprint = category_index_fingerprint
 
     def __getitem__(self, i: int) -> Dict[str, Any]:
         data = super().__getitem__(i)
@@ -132,6 +211,11 @@ class CategorizedDataset(IntakeDataset):
     def get_category(self, i: int) -> str:
         return self._get_category(self.get_metadata(i))
 
+    @cached_property
+    def category_index(self) -> CategoryIndex:
+        return _get_category_index(self, self._category_index_path, self._get_category,
+                                   self._category_index_fingerprint)
+
     @cached_property
     def all_categories(self) -> pd.DataFrame:
         return get_categories(self)
@@ -139,9 +223,12 @@ class CategorizedDataset(IntakeDataset):
 
 class AnnotatedDataset(IntakeDataset):
 
-    def __init__(self, catalog: Union[str, Catalog], get_annotations, loader=None):
-        super().__init__(catalog, loader)
+    def __init__(self, catalog: Union[str, Catalog], get_annotations, loader=None,
+                 category_index_path: Optional[str] = None, category_index_fingerprint: Optional[str] = None, **kwargs):
+        super().__init__(catalog, **kwargs)
         self._get_annotations = get_annotations
+        self._category_index_path = category_index_path
+        self._category_index_fingerprint = category_index_fingerprint
 
     def __getitem__(self, i: int) -> Dict[str, Any]:
         data = super().__getitem__(i)
@@ -158,6 +245,11 @@ class AnnotatedDataset(IntakeDataset):
         assert len(cols) == 1
         return cols[0]
 
+    @cached_property
+    def category_index(self) -> CategoryIndex:
+        return _get_category_index(self, self._category_index_path, self._get_annotations,
+                                   self._category_index_fingerprint)
+
     @cached_property
     def all_categories(self) -> pd.DataFrame:
         return get_categories(self)
@@ -165,11 +257,20 @@ class AnnotatedDataset(IntakeDataset):
 
 class MappedDataset:
 
-    def __init__(self, data: Any, mapper: Any):
+    def __init__(self, data: Any, mapper: Any, batched: bool = False):
+        """
+        :param data: Dataset
+        :param mapper: Callable applied to each sample, or, if `batched`, to a list of samples returning a list
+        :param batched: Whether `mapper` is vectorized over lists of samples
+        """
         self._data = data
         self._mapper = mapper
+        self._batched = batched
 
     def __getattr__(self, item):
+        if item in ("_data", "_mapper", "_batched"):
+            # Not set yet, e.g. while unpickling
+            raise AttributeError(item)
         if item == "__getitem__":
             return getattr(self, item)
         return getattr(self._data, item)
@@ -182,4 +283,46 @@ class MappedDataset:
             yield self[ix]
 
     def __getitem__(self, i: int) -> Dict[str, Any]:
+        if self._batched:
+            return self._mapper([self._data[i]])[0]
         return self._mapper(self._data[i])
+
+    def _map_batch(self, ixs: Sequence[int]) -> List[Dict[str, Any]]:
+        samples = [self._data[i] for i in ixs]
+        if self._batched:
+            return list(self._mapper(samples))
+        return [self._mapper(sample) for sample in samples]
+
+    def iter_batches(self, batch_size: int = 1, num_workers: int = 8, executor: Optional[Executor] = None,
+                     prefetch: int = 2, ixs: Optional[Sequence[int]] = None,
+                     max_in_flight: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Load and map batches in parallel, yielding them in order.
+
+        :param batch_size: Number of samples per batch, the last batch may be smaller
+        :param num_workers: Number of threads, if no executor is given
+        :param executor: Executor to use instead of a thread pool, e.g. a :class:`ProcessPoolExecutor` for mappers
+            that hold the GIL. The dataset and mapper must then be picklable. Not shut down.
+        :param prefetch: Number of batches in flight per worker
+        :param ixs: Indices of the samples to map, all by default
+        :param max_in_flight: Maximum number of batches submitted but not yet yielded, `num_workers * prefetch` by
+            default. Set it according to the number of workers of `executor`, if given.
+        :return: Iterator over lists of mapped samples
+        """
+        ixs = range(len(self)) if ixs is None else ixs
+        batches = (ixs[i:i + batch_size] for i in range(0, len(ixs), batch_size))
+        pool = executor if executor is not None else ThreadPoolExecutor(num_workers)
+        max_in_flight = max(num_workers * prefetch if max_in_flight is None else max_in_flight, 1)
+        futures = deque()
+        try:
+            for batch in batches:
+                futures.append(pool.submit(self._map_batch, batch))
+                if len(futures) >= max_in_flight:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            if executor is None:
+                pool.shutdown(wait=True)
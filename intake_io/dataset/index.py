@@ -0,0 +1,160 @@
+import hashlib
+import os
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+MAX_NDIM = 8
+
+
+def _item_dtype(name_length: int) -> np.dtype:
+    return np.dtype([
+        ("name", f"U{max(name_length, 1)}"),
+        ("offset", "<i8"),  # linear index of the item's first sample
+        ("num_partitions", "<i8"),
+        ("partitioned", "?"),  # whether samples are partitions along axis "i"
+        ("ndim", "u1"),
+        ("shape", "<i8", (MAX_NDIM,)),
+        ("dtype", "S8"),
+        ("axes", f"U{MAX_NDIM}"),
+        ("spacing", "<f8", (MAX_NDIM,)),
+    ])
+
+
+class SampleIndex:
+    """
+    Array-backed index of the samples of a catalog, with one record per catalog item.
+
+    Items with axis "i" contribute one sample per partition, all other items one sample. Shape, spacing and axes are
+    those of a sample, i.e. without axis "i". Unknown spacing is NaN.
+    """
+
+    def __init__(self, items: np.ndarray):
+        self.items = items
+        self._ends = items["offset"] + items["num_partitions"]
+
+    @classmethod
+    def from_sources(cls, names: Sequence[str], sources: Sequence[Any]) -> "SampleIndex":
+        return cls.from_records([cls.record(name, src) for name, src in zip(names, sources)])
+
+    @classmethod
+    def from_records(cls, records: Sequence[Any]) -> "SampleIndex":
+        # Records as returned by `record` or taken from another index
+        items = np.zeros(len(records), _item_dtype(max((len(r[0]) for r in records), default=1)))
+        for i, record in enumerate(records):
+            items[i] = tuple(record)
+        if len(items) > 0:
+            items["offset"][1:] = np.cumsum(items["num_partitions"])[:-1]
+        return cls(items)
+
+    @staticmethod
+    def record(name: str, src: Any) -> tuple:
+        # Record of a discovered source
+        axes = src.metadata["axes"]
+        shape = tuple(src.shape)
+        partitioned = "i" in axes
+        if partitioned:
+            assert axes.index("i") == 0
+            assert src.npartitions == shape[0]
+            axes, shape = axes[1:], shape[1:]
+        if len(shape) > MAX_NDIM:
+            raise ValueError(f"Item {name} has {len(shape)} dimensions, supports up to {MAX_NDIM}.")
+        spacing = src.metadata.get("spacing") or {}
+        return (
+            name,
+            0,
+            src.npartitions if partitioned else 1,
+            partitioned,
+            len(shape),
+            (*shape, *[0] * (MAX_NDIM - len(shape))),
+            np.dtype(src.dtype).str.encode(),
+            axes,
+            (*[spacing.get(ax) or np.nan for ax in axes], *[np.nan] * (MAX_NDIM - len(axes)))
+        )
+
+    def __len__(self) -> int:
+        return int(self._ends[-1]) if len(self._ends) > 0 else 0
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha1(self.items.tobytes()).hexdigest()
+
+    @property
+    def names(self) -> list:
+        return self.items["name"].tolist()
+
+    def locate(self, i: int) -> Tuple[int, Optional[int]]:
+        if i < 0 or i >= len(self):
+            raise IndexError("Index out of range.")
+        item_ix = int(np.searchsorted(self._ends, i, side="right"))
+        if not self.items["partitioned"][item_ix]:
+            return item_ix, None
+        return item_ix, int(i - self.items["offset"][item_ix])
+
+    def item_ixs(self, ixs: Any) -> np.ndarray:
+        return np.searchsorted(self._ends, ixs, side="right")
+
+    def get_dtype(self, i: int) -> np.dtype:
+        return np.dtype(self.items["dtype"][self.locate(i)[0]].decode())
+
+    def get_shape(self, i: int) -> Tuple[int, ...]:
+        item = self.items[self.locate(i)[0]]
+        return tuple(map(int, item["shape"][:item["ndim"]]))
+
+    def get_axes(self, i: int) -> str:
+        return str(self.items["axes"][self.locate(i)[0]])
+
+    def get_spacing(self, i: int) -> Dict[str, Optional[float]]:
+        item = self.items[self.locate(i)[0]]
+        return {ax: None if np.isnan(s) else float(s) for ax, s in zip(item["axes"], item["spacing"])}
+
+    def sample_shapes(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Shapes (padded with zeros to MAX_NDIM) and numbers of dimensions of all samples
+        return (np.repeat(self.items["shape"], self.items["num_partitions"], 0),
+                np.repeat(self.items["ndim"], self.items["num_partitions"]))
+
+    def _uniform_axes(self) -> str:
+        axes = np.unique(self.items["axes"])
+        if len(axes) != 1:
+            raise ValueError(f"Samples have different axes: {axes.tolist()}.")
+        return str(axes[0])
+
+    def median_shape(self) -> Tuple[float, ...]:
+        ndim = np.unique(self.items["ndim"])
+        if len(ndim) != 1:
+            raise ValueError(f"Samples have different numbers of dimensions: {ndim.tolist()}.")
+        ndim = int(ndim[0])
+        shapes = self.items["shape"][:, :ndim].astype(np.float64)
+        return tuple(_weighted_median(shapes[:, i], self.items["num_partitions"]) for i in range(ndim))
+
+    def median_spacing(self) -> Dict[str, Optional[float]]:
+        # Unknown spacing is ignored, None if unknown for all samples
+        axes = self._uniform_axes()
+        out = {}
+        for i, ax in enumerate(axes):
+            spacing = self.items["spacing"][:, i]
+            known = ~np.isnan(spacing)
+            median = _weighted_median(spacing[known], self.items["num_partitions"][known])
+            out[ax] = None if np.isnan(median) else median
+        return out
+
+    def save(self, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, self.items, allow_pickle=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SampleIndex":
+        return cls(np.load(path, allow_pickle=False))
+
+
+def _weighted_median(values: np.ndarray, weights: np.ndarray) -> float:
+    # Median of `values` repeated `weights` times, without repeating them
+    if len(values) == 0 or weights.sum() == 0:
+        return np.nan
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    ends = np.cumsum(weights[order])
+    lower, upper = np.searchsorted(ends, [(ends[-1] - 1) // 2, ends[-1] // 2], side="right")
+    return float((values[lower] + values[upper]) / 2)
@@ -0,0 +1,178 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .dataset import Dataset
+
+__all__ = ["PatchDataset"]
+
+MAX_FOREGROUND_COORDINATES = 10000
+
+
+class PatchDataset(Dataset):
+    """
+    Patches of the samples of an :class:`IntakeDataset`, e.g. for training on images too large to process whole.
+
+    Patches span the last `len(patch_size)` axes of a sample, leading axes (e.g. "c") are taken whole. Patches
+    extending beyond a sample are zero-padded. Patches are read as regions from sources that support it, e.g. TIF
+    files, otherwise up to `max_cached_volumes` decoded samples are kept in memory.
+    """
+
+    def __init__(self, data: Any, patch_size: Sequence[int], sampling: str = "uniform", patches_per_sample: int = 1,
+                 labels: Optional[Any] = None, foreground_probability: float = 0.33, overlap: float = 0.5,
+                 foreground_cache: Optional[str] = None, max_cached_volumes: int = 2, seed: Optional[int] = None):
+        """
+        :param data: Dataset with metadata, e.g. :class:`IntakeDataset`
+        :param patch_size: Patch size along the last `len(patch_size)` axes
+        :param sampling: "uniform" for random patches, "foreground" for random patches that contain foreground of
+            `labels` with probability `foreground_probability`, or "sliding_window" for a regular grid of patches
+        :param patches_per_sample: Random patches per sample and epoch
+        :param labels: Dataset of label images aligned with `data`, read at the same regions
+        :param foreground_probability: Probability of sampling a patch centered on foreground
+        :param overlap: Overlap of neighbouring sliding windows, relative to the patch size
+        :param foreground_cache: Directory to cache foreground coordinates of label images in
+        :param max_cached_volumes: Number of decoded samples kept for sources without region access
+        :param seed: Seed for random patches, combined with the epoch set by :meth:`set_epoch` and the index of the
+            patch. Random if `None`.
+        """
+        if sampling not in ("uniform", "foreground", "sliding_window"):
+            raise ValueError(f'Unknown sampling "{sampling}", supports "uniform", "foreground" and "sliding_window".')
+        if sampling == "foreground" and labels is None:
+            raise ValueError('Sampling "foreground" requires labels.')
+        if labels is not None and len(labels) != len(data):
+            raise ValueError(f"Data and labels have different lengths: {len(data)}, {len(labels)}.")
+        if not 0 <= overlap < 1:
+            raise ValueError(f"Overlap must be in [0, 1), got {overlap}.")
+        super().__init__()
+        self.data = data
+        self.labels = labels
+        self.patch_size = tuple(map(int, patch_size))
+        self.sampling = sampling
+        self.patches_per_sample = patches_per_sample
+        self.foreground_probability = foreground_probability
+        self.overlap = overlap
+        self.foreground_cache = foreground_cache
+        self.max_cached_volumes = max_cached_volumes
+        # Drawn once, so that copies in DataLoader workers agree
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.epoch = 0
+        self._lock = threading.Lock()
+        self._volumes = OrderedDict()
+        self._foreground = {}
+        self._windows = self._get_windows() if sampling == "sliding_window" else None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self._windows is not None:
+            return len(self._windows)
+        return len(self.data) * self.patches_per_sample
+
+    def _spatial_shape(self, j: int) -> Tuple[int, ...]:
+        shape = self.data.get_shape(j)
+        if len(shape) < len(self.patch_size):
+            raise ValueError(f"Sample {j} has shape {shape}, patch size is {self.patch_size}.")
+        return tuple(shape[len(shape) - len(self.patch_size):])
+
+    def _get_windows(self) -> np.ndarray:
+        # One row (sample, *starts) per window, the last window along each axis is aligned with the end
+        out = []
+        for j in range(len(self.data)):
+            starts = []
+            for n, p in zip(self._spatial_shape(j), self.patch_size):
+                step = max(int(p * (1 - self.overlap)), 1)
+                starts.append(np.unique(np.append(np.arange(0, max(n - p, 0), step), max(n - p, 0))))
+            grid = np.stack(np.meshgrid(*starts, indexing="ij"), -1).reshape(-1, len(starts))
+            out.append(np.concatenate([np.full((len(grid), 1), j), grid], 1))
+        if len(out) == 0:
+            return np.zeros((0, 1 + len(self.patch_size)), np.int64)
+        return np.concatenate(out).astype(np.int64)
+
+    def _load_index(self, i: int):
+        if i < 0 or i >= len(self):
+            raise IndexError("Index out of range.")
+        if self._windows is not None:
+            j, starts = int(self._windows[i, 0]), tuple(map(int, self._windows[i, 1:]))
+        else:
+            j = i // self.patches_per_sample
+            starts = self._sample_starts(j, np.random.default_rng((self.seed, self.epoch, i)))
+        region = tuple((s, s + p) for s, p in zip(starts, self.patch_size))
+        out = {"source_index": j, "region": region, "data": self._read(self.data, j, region)}
+        if self.labels is not None:
+            out["labels"] = self._read(self.labels, j, region)
+        return out
+
+    def _sample_starts(self, j: int, rng: np.random.Generator) -> Tuple[int, ...]:
+        shape = self._spatial_shape(j)
+        high = [max(n - p, 0) for n, p in zip(shape, self.patch_size)]
+        if self.sampling == "foreground" and rng.random() < self.foreground_probability:
+            coords = self._get_foreground(j)
+            if len(coords) > 0:
+                center = coords[rng.integers(len(coords))]
+                return tuple(int(np.clip(c - p // 2, 0, h)) for c, p, h in zip(center, self.patch_size, high))
+        return tuple(int(rng.integers(0, h + 1)) for h in high)
+
+    def _get_foreground(self, j: int) -> np.ndarray:
+        # Subset of foreground coordinates of the label image of sample j, along the patch axes
+        if j in self._foreground:
+            return self._foreground[j]
+        fpath = None
+        fingerprint = getattr(getattr(self.labels, "_index", None), "fingerprint", None)
+        if self.foreground_cache is not None and fingerprint is not None:
+            fpath = os.path.join(self.foreground_cache, f"{fingerprint}_{j}.npy")
+            if os.path.exists(fpath):
+                self._foreground[j] = np.load(fpath, allow_pickle=False)
+                return self._foreground[j]
+
+        labels = np.asarray(self._read_volume(self.labels, j))
+        leading = tuple(range(labels.ndim - len(self.patch_size)))
+        mask = labels > 0
+        if len(leading) > 0:
+            mask = mask.any(leading)
+        coords = np.argwhere(mask)
+        if len(coords) > MAX_FOREGROUND_COORDINATES:
+            rng = np.random.default_rng(j)
+            coords = coords[np.sort(rng.choice(len(coords), MAX_FOREGROUND_COORDINATES, replace=False))]
+        coords = coords.astype(np.int64)
+
+        if fpath is not None:
+            os.makedirs(self.foreground_cache, exist_ok=True)
+            tmp = f"{fpath}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, coords, allow_pickle=False)
+            os.replace(tmp, fpath)
+        self._foreground[j] = coords
+        return coords
+
+    def _read(self, data: Any, j: int, region: Tuple[Tuple[int, int], ...]) -> np.ndarray:
+        item_ix, partition = data._get_item_partition_ixs(j)
+        src = data._items[item_ix]
+        slices = (*[slice(None)] * (len(data.get_shape(j)) - len(region)), *[slice(*i) for i in region])
+        if partition is None and src.supports_region_access:
+            patch = src.read_region(slices)
+        else:
+            patch = self._read_volume(data, j)[slices]
+        pad = [(0, 0)] * (patch.ndim - len(region))
+        pad += [(0, (stop - start) - n) for (start, stop), n in zip(region, patch.shape[-len(region):])]
+        if any(i[1] > 0 for i in pad):
+            patch = np.pad(patch, pad)
+        return patch
+
+    def _read_volume(self, data: Any, j: int) -> np.ndarray:
+        key = (id(data), j)
+        with self._lock:
+            if key in self._volumes:
+                self._volumes.move_to_end(key)
+                return self._volumes[key]
+        item_ix, partition = data._get_item_partition_ixs(j)
+        src = data._items[item_ix]
+        volume = np.asarray(src.read() if partition is None else src.read_partition(partition))
+        with self._lock:
+            self._volumes[key] = volume
+            while len(self._volumes) > self.max_cached_volumes:
+                self._volumes.popitem(last=False)
+        return volume
@@ -1,93 +1,260 @@
-from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import queue
+import struct
 from copy import deepcopy
 
-from torch.utils.data import get_worker_info
 import zmq
 
-from .cache import CachedDataset
-from .serialization import deserialize as _deserialize, serialize as _serialize
+from .cache import CachedDataset, SharedMemoryCache
+from .serialization import blosc, deserialize as _deserialize, join_frames as _join_frames, serialize as _serialize, \
+    serialize_frames as _serialize_frames
+
+# Wire codecs and the blosc compressor they map to, "none" sends array data uncompressed
+CODECS = {"none": None, "blosc": "blosclz", "lz4": "lz4", "zstd": "zstd", "zlib": "zlib"}
+
+
+# Replies start with a header frame with one entry per item: number of frames, whether the item is an exception
+_ITEM = struct.Struct("<IB")
+
+
+def supported_codecs():
+    if blosc is None:
+        return ["none"]
+    return [k for k, v in CODECS.items() if v is None or v in blosc.compressor_list()]
 
 
 class _RemoteDataset:
 
-    def __init__(self, hostname, port, key, data_name, transform=None):
+    def __init__(self, hostname, port, key, data_name, transform=None, max_in_flight=8, batch_size=16,
+                 codec=("lz4", "zstd", "none"), clevel=4):
         self.hostname = hostname
         self.port = port
         self._key = key.encode()
         self.data_name = data_name
         self.transform = transform
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.codec = [codec] if isinstance(codec, str) else list(codec)
+        self.clevel = clevel
+        self._wire_codec = None
         self._len = None
         self._socket = None
-        self._worker_ids = set()
+        self._pid = None
+        self._next_id = 0
 
     def _setup(self):
         self._context = zmq.Context.instance()
-        self._socket = self._context.socket(zmq.REQ)
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
         self._socket.connect(f"tcp://{self.hostname}:{self.port}")
+        self._pid = os.getpid()
+        self._wire_codec = None
+        self._wire_codec = self._negotiate()
+
+    def _negotiate(self):
+        # Use the first preferred codec that both ends support
+        codecs = set(self._call("__codecs__")).intersection(supported_codecs())
+        for codec in self.codec:
+            if codec in codecs:
+                return codec
+        raise ValueError(f"None of the codecs {self.codec} are supported by both client and server, "
+                         f"the server supports {sorted(codecs)}.")
 
     def __copy__(self):
-        return _RemoteDataset(self.hostname, self.port, self._key.decode("utf8"), self.data_name, deepcopy(self.transform))
+        return _RemoteDataset(self.hostname, self.port, self._key.decode("utf8"), self.data_name,
+                              deepcopy(self.transform), self.max_in_flight, self.batch_size, self.codec, self.clevel)
 
     def __deepcopy__(self, *args):
         return self.__copy__()
 
     def __getstate__(self):
         out = {k: getattr(self, k) for k in (
-            "hostname", "port", "_key", "data_name", "transform", "_len", "_worker_ids"
+            "hostname", "port", "_key", "data_name", "transform", "max_in_flight", "batch_size", "codec", "clevel",
+            "_len"
         )}
         out["_socket"] = None
+        out["_pid"] = None
+        out["_next_id"] = 0
         return out
 
     def __setstate__(self, state):
         for k, v in state.items():
             setattr(self, k, v)
 
-    def __getitem__(self, x):
-        winfo = get_worker_info()
-        wid = None if winfo is None else winfo.id
-        if self._socket is not None and not wid in self._worker_ids:
-            self._socket.close()
+    def _get_socket(self):
+        # zmq sockets must not be shared with forked (DataLoader worker) processes, each process connects on its own.
+        if self._socket is not None and self._pid != os.getpid():
             self._socket = None
-
         if self._socket is None:
             self._setup()
-
-        socket = self._socket
-        socket.send_serialized((x, self.data_name), self.serialize)
-        y = socket.recv_serialized(self.deserialize)
-        if isinstance(y, Exception):
+        return self._socket
+
+    def _send(self, x, batch):
+        # Requests are tagged with an id, replies to requests that were abandoned (e.g. after an error) are dropped.
+        self._next_id += 1
+        request_id = struct.pack("<Q", self._next_id)
+        socket = self._get_socket()
+        # The reply is encoded with the negotiated codec, "none" until negotiated
+        request = (x, self.data_name, batch, self._wire_codec or "none", self.clevel)
+        socket.send_multipart([b"", request_id, *self.serialize(request)], copy=False)
+        return request_id
+
+    def _recv(self):
+        _, request_id, header, *frames = self._socket.recv_multipart(copy=False)
+        items = []
+        for nframes, error in _ITEM.iter_unpack(header.buffer):
+            items.append((error, frames[:nframes]))
+            frames = frames[nframes:]
+        return request_id.bytes, items
+
+    def _call(self, x):
+        request_id = self._send(x, False)
+        while True:
+            i, items = self._recv()
+            if i == request_id:
+                break
+        error, frames = items[0]
+        y = self.deserialize(frames)
+        if error:
             raise y
-        elif x != "__len__":
-            return y
+        return y
 
+    def __getitem__(self, x):
+        y = self._call(x)
         if self.transform is not None:
             y = self.transform(y)
         return y
 
+    def set_epoch_plan(self, indices):
+        # The server prefetches these samples in this order, if it caches samples
+        self._call(("__plan__", list(indices)))
+
+    def get_many(self, indices, raw=False):
+        # With raw=True, return the frames of each sample as received, without deserializing or transforming them
+        indices = list(indices)
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        out = [None] * len(batches)
+        pending = {}
+        for i, batch in enumerate(batches):
+            while len(pending) >= self.max_in_flight:
+                self._collect(pending, out)
+            pending[self._send(batch, True)] = i
+        while len(pending) > 0:
+            self._collect(pending, out)
+
+        out = [y for batch in out for y in batch]
+        if raw:
+            return out
+        out = [self.deserialize(y) for y in out]
+        if self.transform is not None:
+            out = [self.transform(y) for y in out]
+        return out
+
+    def _collect(self, pending, out):
+        request_id, items = self._recv()
+        i = pending.pop(request_id, None)
+        if i is None:
+            return
+        for error, frames in items:
+            if error:
+                raise self.deserialize(frames)
+        out[i] = [frames for _, frames in items]
+
     def __len__(self):
         if self._len is None:
-            self._len = self["__len__"]
+            self._len = self._call("__len__")
         return self._len
 
     def deserialize(self, x):
         return _deserialize(x, self._key)
 
     def serialize(self, x):
-        return _serialize(x, self._key, maxsize=50 * 1024 ** 2, cname="zlib", clevel=4)
+        return _serialize_frames(x, self._key, cname=CODECS[self._wire_codec or "none"], clevel=self.clevel)
 
 
 class CachedRemoteDataset(CachedDataset):
-    # TODO: Extra overhead on first load, item is first fetched and deserialized, then serialized again to be cached.
-    # Possibly intercept and store item before deserialization, or perhaps utilize the separate serializations by
-    # optimizing separate serialization parameters for transport and caching.
 
-    def __init__(self, hostname, port, key, data_name, cache_dir, map_size_gb=1, **kwargs):
-        super().__init__(_RemoteDataset(hostname, port, key, data_name), cache_dir, map_size_gb=map_size_gb, **kwargs)
+    def __init__(self, hostname, port, key, data_name, cache_dir, map_size_gb=1, max_in_flight=8, batch_size=16,
+                 codec=("lz4", "zstd", "none"), clevel=4, **kwargs):
+        super().__init__(_RemoteDataset(hostname, port, key, data_name, max_in_flight=max_in_flight,
+                                        batch_size=batch_size, codec=codec, clevel=clevel),
+                         cache_dir, map_size_gb=map_size_gb, **kwargs)
+
+    def __getitem__(self, x):
+        return self.get_many([x])[0]
+
+    def get_many(self, indices):
+        indices = list(indices)
+        out = [self.get(self._key(x)) for x in indices]
+        missing = [i for i, y in enumerate(out) if y is None]
+        if len(self._cached_transforms) > 0:
+            for i, y in zip(missing, self.data.get_many([indices[i] for i in missing])):
+                for t in self._cached_transforms:
+                    y = t(y)
+                self.put(self._key(indices[i]), y)
+                out[i] = y
+        else:
+            # Cache samples as received, only buffers compressed for transport are decompressed
+            for i, frames in zip(missing, self.data.get_many([indices[i] for i in missing], raw=True)):
+                y = _join_frames(frames, self.data._key)
+                out[i] = self._deserialize(y)
+                self.put_serialized(self._key(indices[i]), y)
+        for t in self._uncached_transforms:
+            out = [t(y) for y in out]
+        return out
+
+    def set_epoch_plan(self, indices):
+        # Locally cached samples don't need to be prefetched by the server
+        with self._begin() as txn:
+            indices = [x for x in indices if self._key(x) not in self._pending and txn.get(self._key(x)) is None]
+        self.data.set_epoch_plan(indices)
+
+
+class _EpochPlan:
+    # Samples to prefetch, shared by all workers of a server. Prefetching stays at most `ahead` samples ahead of the
+    # samples served since the plan was pushed.
+
+    def __init__(self, ahead):
+        self.ahead = ahead
+        self._lock = multiprocessing.Lock()
+        self._tasks = multiprocessing.Queue()
+        self._generation = multiprocessing.Value("q", 0, lock=False)
+        self._num_prefetched = multiprocessing.Value("q", 0, lock=False)
+        self._num_served = multiprocessing.Value("q", 0, lock=False)
+
+    def push(self, name, indices):
+        # Replaces the previous plan, its remaining samples are skipped
+        with self._lock:
+            self._generation.value += 1
+            self._num_prefetched.value = 0
+            self._num_served.value = 0
+            generation = self._generation.value
+        for x in indices:
+            self._tasks.put((generation, name, x))
+
+    def next(self):
+        while True:
+            with self._lock:
+                if self._num_prefetched.value - self._num_served.value >= self.ahead:
+                    return None
+            try:
+                generation, name, x = self._tasks.get_nowait()
+            except queue.Empty:
+                return None
+            with self._lock:
+                if generation == self._generation.value:
+                    self._num_prefetched.value += 1
+                    return name, x
+
+    def served(self, n=1):
+        with self._lock:
+            self._num_served.value += n
 
 
 class DatasetServer:
 
-    def __init__(self, datasets, port, key, num_workers=4):
+    def __init__(self, datasets, port, key, num_workers=4, codecs=None, cache_gb=None, prefetch=256):
         context = zmq.Context().instance()
 
         frontend = context.socket(zmq.ROUTER)
@@ -96,23 +263,36 @@ class DatasetServer:
         backend = context.socket(zmq.DEALER)
         backend.bind("ipc://backend.ipc")
 
-        with ProcessPoolExecutor(max_workers=num_workers) as pool:
-            for i in range(num_workers):
-                pool.submit(DatasetWorker, i, datasets, key)
-            try:
-                zmq.proxy(frontend, backend)
-            except KeyboardInterrupt:
-                print("Keyboard interrupt received. Stopping ...")
-            finally:
-                frontend.close()
-                backend.close()
-                context.term()
+        # Samples are cached in shared memory, so that all workers serve them and prefetch into them
+        cache = None if cache_gb is None else SharedMemoryCache(cache_gb)
+        plan = None if cache is None else _EpochPlan(prefetch)
+
+        workers = [multiprocessing.Process(target=DatasetWorker, args=(i, datasets, key, codecs, cache, plan))
+                   for i in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            zmq.proxy(frontend, backend)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received. Stopping ...")
+        finally:
+            frontend.close()
+            backend.close()
+            context.term()
+            for worker in workers:
+                worker.join()
+            if cache is not None:
+                cache.close()
 
 
 class DatasetWorker:
 
-    def __init__(self, i, datasets, key):
+    def __init__(self, i, datasets, key, codecs=None, cache=None, plan=None):
         self._key = key.encode()
+        self.codecs = supported_codecs() if codecs is None else [c for c in codecs if c in supported_codecs()]
+        self.datasets = datasets
+        self.cache = cache
+        self.plan = plan
         context = zmq.Context.instance()
         socket = context.socket(zmq.REP)
         socket.connect("ipc://backend.ipc")
@@ -120,27 +300,85 @@ class DatasetWorker:
         print(f"DatasetWorker {i} started")
 
         try:
+            prefetching = False
             while True:
+                # Prefetch while idle
+                if not socket.poll(0 if prefetching else 100):
+                    prefetching = self._prefetch()
+                    continue
+                request_id, *frames = socket.recv_multipart(copy=False)
                 try:
-                    x, name = socket.recv_serialized(self.deserialize)
+                    x, name, batch, codec, clevel = self.deserialize(frames)
                     if x == "__stop__":
                         break
-                    elif x == "__len__":
-                        y = len(datasets[name])
+                    elif x == "__codecs__":
+                        items = [self.codecs]
+                    elif isinstance(x, tuple) and x[:1] == ("__plan__",):
+                        if self.plan is not None:
+                            self.plan.push(name, x[1])
+                        items = [None]
+                    elif batch:
+                        # One reply for the whole batch, errors are returned per item
+                        items = [self._get(name, i) for i in x]
                     else:
-                        y = datasets[name][x]
+                        items = [self._get(name, x)]
                 except Exception as ex:
-                    y = ex
-                socket.send_serialized(y, self.serialize)
+                    items = [ex]
+                    codec, clevel = "none", 0
+                socket.send_multipart([request_id, *self._reply(items, codec, clevel)], copy=False)
         finally:
             socket.close()
             context.term()
 
+    def _get(self, name, x):
+        try:
+            if x == "__len__":
+                return len(self.datasets[name])
+            if self.plan is not None:
+                self.plan.served()
+            k = f"{name}/{x}".encode()
+            if self.cache is not None:
+                y = self.cache.get(k)
+                if y is not None:
+                    return _deserialize(y)
+            y = self.datasets[name][x]
+            if self.cache is not None:
+                self.cache.put(k, _serialize(y))
+            return y
+        except Exception as ex:
+            return ex
+
+    def _prefetch(self):
+        task = None if self.plan is None else self.plan.next()
+        if task is None:
+            return False
+        name, x = task
+        k = f"{name}/{x}".encode()
+        if k not in self.cache:
+            try:
+                self.cache.put(k, _serialize(self.datasets[name][x]))
+            except Exception:
+                # Reported when the sample is requested
+                pass
+        return True
+
+    def _reply(self, items, codec, clevel):
+        header = []
+        frames = []
+        for y in items:
+            error = isinstance(y, Exception)
+            y = self.serialize(y, "none" if error else codec, clevel)
+            header.append(_ITEM.pack(len(y), error))
+            frames.extend(y)
+        return [b"".join(header), *frames]
+
     def deserialize(self, x):
         return _deserialize(x, self._key)
 
-    def serialize(self, x):
-        return _serialize(x, self._key, maxsize=50 * 1024 ** 2, cname="zlib", clevel=4)
+    def serialize(self, x, codec="none", clevel=0):
+        if codec not in self.codecs:
+            codec = "none"
+        return _serialize_frames(x, self._key, cname=CODECS[codec], clevel=clevel)
 
 
 def start_server(datasets, *args, **kwargs):
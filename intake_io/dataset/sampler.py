@@ -0,0 +1,109 @@
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from .split import SubsetDataset
+from .util import CategoryIndex
+
+__all__ = ["BalancedSampler"]
+
+
+class BalancedSampler:
+    """
+    Sampler that draws samples such that categories occur with given frequencies, equal by default.
+
+    Per-category sample arrays and an alias table of category weights are built once from the category index of the
+    dataset, so that draws with replacement take constant time and epochs are drawn vectorized. Samples of an
+    :class:`AnnotatedDataset` belong to all categories of their instances. Yields sample indices, e.g. as `sampler` of
+    a PyTorch `DataLoader`.
+    """
+
+    def __init__(self, data: Any, num_samples: Optional[int] = None, replacement: bool = True,
+                 weights: Optional[Dict[Any, float]] = None, seed: int = 0):
+        """
+        :param data: :class:`CategorizedDataset`, :class:`AnnotatedDataset` or a :class:`SubsetDataset` of one
+        :param num_samples: Number of draws per epoch, defaults to the number of samples
+        :param replacement: Draw with replacement. Otherwise each sample is drawn at most once per epoch, with
+            probability proportional to the weight of its categories.
+        :param weights: Relative frequency of each category, categories not listed aren't drawn. Equal by default.
+        :param seed: Seed, combined with the epoch set by :meth:`set_epoch`
+        """
+        samples, categories, names = _get_pairs(data)
+        self.names = names
+        self.num_samples = len(data) if num_samples is None else num_samples
+        self.replacement = replacement
+        self.seed = seed
+        self.epoch = 0
+
+        # Samples of each category, as slices of one array
+        order = np.argsort(categories, kind="stable")
+        self._samples = samples[order]
+        self._counts = np.bincount(categories, minlength=len(names))
+        self._starts = np.cumsum(self._counts) - self._counts
+
+        if weights is None:
+            weights = np.ones(len(names))
+        else:
+            weights = np.array([float(weights.get(name, 0.0)) for name in names])
+        weights[self._counts == 0] = 0
+        if weights.sum() <= 0:
+            raise ValueError("No samples of any category with positive weight.")
+        self.weights = weights / weights.sum()
+        self._prob, self._alias = _alias_table(self.weights)
+
+        # Probability of each sample for drawing without replacement
+        self._sample_weights = np.bincount(samples, (self.weights / np.maximum(self._counts, 1))[categories],
+                                           minlength=len(data))
+        if not replacement and self.num_samples > np.count_nonzero(self._sample_weights):
+            raise ValueError(f"Cannot draw {self.num_samples} samples without replacement from "
+                             f"{np.count_nonzero(self._sample_weights)}.")
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def draw(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        if not self.replacement:
+            # Efraimidis-Spirakis: the n largest of u^(1/w) are a weighted sample without replacement
+            positive = np.flatnonzero(self._sample_weights > 0)
+            keys = np.log(rng.random(len(positive))) / self._sample_weights[positive]
+            top = np.argpartition(-keys, n - 1)[:n] if n > 0 else np.zeros(0, np.int64)
+            return positive[top[np.argsort(-keys[top])]]
+        # Category from the alias table, then a sample of that category
+        categories = rng.integers(len(self._prob), size=n)
+        categories = np.where(rng.random(n) < self._prob[categories], categories, self._alias[categories])
+        offsets = (rng.random(n) * self._counts[categories]).astype(np.int64)
+        return self._samples[self._starts[categories] + offsets]
+
+    def __iter__(self) -> Iterator[int]:
+        yield from self.draw(self.num_samples, np.random.default_rng((self.seed, self.epoch))).tolist()
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+
+def _get_pairs(data: Any) -> Tuple[np.ndarray, np.ndarray, list]:
+    # (sample, category) pairs of a dataset or a subset of one
+    ixs = None
+    if isinstance(data, SubsetDataset):
+        data, ixs = data._root_ixs()
+    index = getattr(data, "category_index", None)
+    if not isinstance(index, CategoryIndex):
+        index = CategoryIndex.build(data)
+    return (*index.pairs(ixs), index.names)
+
+
+def _alias_table(p: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Vose's alias method: entry i is kept with probability prob[i], else replaced by alias[i]
+    n = len(p)
+    prob = p * n
+    alias = np.arange(n)
+    small = [i for i in range(n) if prob[i] < 1]
+    large = [i for i in range(n) if prob[i] >= 1]
+    while small and large:
+        s, g = small.pop(), large.pop()
+        alias[s] = g
+        prob[g] -= 1 - prob[s]
+        (small if prob[g] < 1 else large).append(g)
+    # Remaining entries are 1 up to rounding
+    prob[small + large] = 1
+    return prob, alias
@@ -0,0 +1,221 @@
+import hashlib
+import hmac
+import pickle
+import struct
+from typing import Any, List, Optional, Sequence, Union
+
+try:
+    import blosc
+except ModuleNotFoundError:
+    blosc = None
+
+# Serialized layout, as a list of frames or as a single contiguous buffer:
+#
+#   meta:    prefix | one table entry per buffer | pickle stream
+#   buffers: raw or compressed out-of-band pickle buffers (array data)
+#   mac:     optional HMAC-SHA256 of all preceding frames
+#
+# In the contiguous form, meta and buffers start at multiples of ALIGNMENT bytes, so that arrays deserialized as views
+# are aligned.
+
+MAGIC = b"IIOS"
+VERSION = 1
+ALIGNMENT = 64
+MIN_COMPRESS_NBYTES = 1024
+_PREFIX = struct.Struct("<4sBBxxII")  # magic, version, flags, number of buffers, pickle stream size
+_BUFFER = struct.Struct("<QQB7x")     # stored size, raw size, compressed
+_FLAG_MAC = 1
+_MAC_NBYTES = hashlib.sha256().digest_size
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def serialize_frames(
+        x: Any,
+        key: Optional[bytes] = None,
+        cname: Optional[str] = None,
+        clevel: int = 4
+) -> List[Buffer]:
+    """
+    Serialize to a list of frames: a small metadata frame followed by one frame per array buffer.
+
+    Contiguous array data (incl. arrays held by xarray objects) is not copied unless compressed.
+
+    :param x: Object to serialize, typically a (nested) dict of arrays and xarray objects
+    :param key: If given, append a frame with the HMAC of all other frames
+    :param cname: Compress buffers using blosc with this codec, e.g. "lz4" or "zstd". Default `None` doesn't compress.
+    :param clevel: Compression level
+    :return: Frames
+    """
+    if cname is not None and blosc is None:
+        raise ModuleNotFoundError(f'Compression "{cname}" requires optional dependency blosc, which is not installed.')
+
+    buffers = []
+    stream = pickle.dumps(x, protocol=5, buffer_callback=buffers.append)
+
+    frames = [None]
+    table = []
+    for buffer in buffers:
+        view = memoryview(buffer)
+        typesize = view.itemsize
+        view = buffer.raw()
+        stored = view
+        if cname is not None and MIN_COMPRESS_NBYTES <= view.nbytes <= blosc.MAX_BUFFERSIZE:
+            compressed = blosc.compress(view, typesize=min(typesize, 255), clevel=clevel, cname=cname)
+            if len(compressed) < view.nbytes:
+                stored = compressed
+        table.append(_BUFFER.pack(memoryview(stored).nbytes, view.nbytes, stored is not view))
+        frames.append(stored)
+
+    flags = _FLAG_MAC if key is not None else 0
+    frames[0] = b"".join((_PREFIX.pack(MAGIC, VERSION, flags, len(buffers), len(stream)), *table, stream))
+    if key is not None:
+        frames.append(_mac(frames, key))
+    return frames
+
+
+def serialize(
+        x: Any,
+        key: Optional[bytes] = None,
+        cname: Optional[str] = None,
+        clevel: int = 4
+) -> bytearray:
+    """
+    Serialize to a single contiguous buffer, e.g. for storage in a key-value store. See :func:`serialize_frames`.
+    """
+    frames = serialize_frames(x, key, cname, clevel)
+    mac = frames.pop() if key is not None else b""
+    return _join(frames, mac)
+
+
+def join_frames(
+        frames: Sequence[Buffer],
+        key: Optional[bytes] = None,
+        cname: Optional[str] = None,
+        clevel: int = 4
+) -> bytearray:
+    """
+    Convert the output of :func:`serialize_frames` to that of :func:`serialize` without deserializing it, e.g. to
+    store a message as received.
+
+    Only buffers are transcoded: compressed buffers are decompressed if `cname` is `None`, uncompressed ones are
+    compressed otherwise. Buffers compressed with a different codec than `cname` are kept as they are.
+
+    :param frames: Frames
+    :param key: If given, verify the HMAC of `frames` and raise :class:`ValueError` on mismatch or if there is none.
+        The output isn't signed.
+    :param cname: Codec of the output, see :func:`serialize_frames`
+    :param clevel: Compression level
+    :return: Contiguous buffer
+    """
+    if cname is not None and blosc is None:
+        raise ModuleNotFoundError(f'Compression "{cname}" requires optional dependency blosc, which is not installed.')
+    frames = [memoryview(i).cast("B") for i in frames]
+    flags, num_buffers, table, stream = _parse_meta(frames[0])
+    if len(frames) != 1 + num_buffers + (flags & _FLAG_MAC):
+        raise ValueError(f"Expected {1 + num_buffers + (flags & _FLAG_MAC)} frames, got {len(frames)}.")
+    if key is not None:
+        _verify(frames[:1 + num_buffers], frames[-1] if flags & _FLAG_MAC else None, key)
+
+    buffers = frames[1:1 + num_buffers]
+    for i, (_, nbytes, compressed) in enumerate(table):
+        if compressed and cname is None:
+            if blosc is None:
+                raise ModuleNotFoundError("Decompression requires optional dependency blosc, which is not installed.")
+            buffers[i] = blosc.decompress(buffers[i])
+            compressed = False
+        elif not compressed and cname is not None and MIN_COMPRESS_NBYTES <= nbytes <= blosc.MAX_BUFFERSIZE:
+            # The item size isn't known at this point, which only affects the compression ratio
+            c = blosc.compress(buffers[i], typesize=1, clevel=clevel, cname=cname)
+            if len(c) < nbytes:
+                buffers[i] = c
+                compressed = True
+        table[i] = _BUFFER.pack(memoryview(buffers[i]).nbytes, nbytes, compressed)
+    meta = b"".join((_PREFIX.pack(MAGIC, VERSION, flags & ~_FLAG_MAC, num_buffers, stream.nbytes), *table, stream))
+    return _join([meta, *buffers])
+
+
+def _join(frames: Sequence[Buffer], mac: bytes = b"") -> bytearray:
+    offsets = []
+    nbytes = 0
+    for frame in frames:
+        offsets.append(nbytes)
+        nbytes = _align(nbytes + memoryview(frame).nbytes)
+    out = bytearray(nbytes + len(mac))
+    for offset, frame in zip(offsets, frames):
+        frame = memoryview(frame).cast("B")
+        out[offset:offset + frame.nbytes] = frame
+    out[nbytes:] = mac
+    return out
+
+
+def deserialize(x: Union[Buffer, Sequence[Buffer]], key: Optional[bytes] = None) -> Any:
+    """
+    Deserialize the output of :func:`serialize` or :func:`serialize_frames`.
+
+    Uncompressed arrays are returned as views of `x` without copying. They are read-only if `x` is, and must not outlive
+    `x`, e.g. an LMDB transaction.
+
+    :param x: Contiguous buffer or list of frames
+    :param key: If given, verify the HMAC and raise :class:`ValueError` on mismatch or if there is none
+    :return: Deserialized object
+    """
+    if isinstance(x, (list, tuple)):
+        frames = [memoryview(i).cast("B") for i in x]
+        flags, num_buffers, table, stream = _parse_meta(frames[0])
+        if len(frames) != 1 + num_buffers + (flags & _FLAG_MAC):
+            raise ValueError(f"Expected {1 + num_buffers + (flags & _FLAG_MAC)} frames, got {len(frames)}.")
+        buffers = frames[1:1 + num_buffers]
+        mac = frames[-1] if flags & _FLAG_MAC else None
+        signed = frames[:1 + num_buffers]
+    else:
+        data = memoryview(x).cast("B")
+        flags, num_buffers, table, stream = _parse_meta(data)
+        signed = [data[:_PREFIX.size + len(table) * _BUFFER.size + len(stream)]]
+        offset = _align(signed[0].nbytes)
+        buffers = []
+        for stored, _, _ in table:
+            buffers.append(data[offset:offset + stored])
+            signed.append(buffers[-1])
+            offset = _align(offset + stored)
+        mac = data[offset:offset + _MAC_NBYTES] if flags & _FLAG_MAC else None
+
+    if key is not None:
+        _verify(signed, mac, key)
+
+    for i, (_, nbytes, compressed) in enumerate(table):
+        if compressed:
+            if blosc is None:
+                raise ModuleNotFoundError("Decompression requires optional dependency blosc, which is not installed.")
+            buffers[i] = blosc.decompress(buffers[i])
+    return pickle.loads(stream, buffers=buffers)
+
+
+def _parse_meta(data: memoryview):
+    magic, version, flags, num_buffers, stream_nbytes = _PREFIX.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not serialized by intake_io.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported serialization version {version}.")
+    offset = _PREFIX.size
+    table = [_BUFFER.unpack_from(data, offset + i * _BUFFER.size) for i in range(num_buffers)]
+    offset += num_buffers * _BUFFER.size
+    return flags, num_buffers, table, data[offset:offset + stream_nbytes]
+
+
+def _verify(signed: Sequence[Buffer], mac: Optional[Buffer], key: bytes):
+    if mac is None:
+        raise ValueError("Data isn't signed.")
+    if not hmac.compare_digest(_mac(signed, key), bytes(mac)):
+        raise ValueError("HMAC mismatch.")
+
+
+def _mac(frames: Sequence[Buffer], key: bytes) -> bytes:
+    mac = hmac.new(key, digestmod=hashlib.sha256)
+    for frame in frames:
+        mac.update(frame)
+    return mac.digest()
+
+
+def _align(n: int) -> int:
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
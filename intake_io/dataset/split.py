@@ -1,12 +1,11 @@
 from functools import cached_property
-from typing import Any, Tuple, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import ShuffleSplit
 
 from .dataset import Dataset
-from .util import get_categories
+from .util import CategoryIndex, get_categories
 
 
 class SubsetDataset(Dataset):
@@ -27,35 +26,156 @@ class SubsetDataset(Dataset):
     def _load_index(self, i: int) -> Dict[str, Any]:
         return self._data[self._ixs[i]]
 
+    def _root_ixs(self) -> Tuple[Any, np.ndarray]:
+        # Underlying dataset and indices into it, resolving nested subsets
+        data, ixs = self._data, np.asarray(self._ixs, np.int64)
+        while isinstance(data, SubsetDataset):
+            data, ixs = data._data, np.asarray(data._ixs, np.int64)[ixs]
+        return data, ixs
+
     @cached_property
     def subset_categories(self) -> pd.DataFrame:
-        return get_categories(self)
+        return get_categories(*self._root_ixs())
+
+
+def category_subset(data, categories: Sequence[Any]) -> SubsetDataset:
+    """
+    Subset of the samples of `data` of (or, if annotated, with instances of) any of `categories`.
+    """
+    if isinstance(data, SubsetDataset):
+        root, ixs = data._root_ixs()
+        selected = np.isin(ixs, root.category_index.sample_ixs(categories))
+        return SubsetDataset(data, tuple(map(int, np.flatnonzero(selected))))
+    return SubsetDataset(data, tuple(map(int, data.category_index.sample_ixs(categories))))
 
 
-def shuffle_split(data, ratio: float = 0.2) -> Dict[str, List[Dict[str, Any]]]:
-    out = dict(
-        trn=(),
-        val=()
-    )
+def shuffle_split(data, ratio: float = 0.2, stratify: bool = False, groups: Optional[Union[str, Callable]] = None,
+                  seed: Optional[int] = None) -> Dict[str, SubsetDataset]:
+    """
+    Split into training and validation set in a single pass.
 
+    Samples with metadata "must_be_in_train_set" or "must_be_in_validation_set" are pinned to the respective set, all
+    other samples are assigned randomly, such that the validation set holds `ratio` of the samples (of each category,
+    if stratified). Samples of the same group are assigned to the same set.
+
+    :param data: Dataset
+    :param ratio: Fraction of samples in the validation set
+    :param stratify: Split each category separately, see :func:`get_categories`
+    :param groups: Metadata key or callable `groups(data, i)` returning the group of sample i, e.g. a subject id
+    :param seed: Seed, random if `None`
+    :return: Dict with datasets "trn" and "val"
+    """
     if len(data) == 0:
-        return out
-
-    def is_valid():
-        for key, name in (("trn", "train"), ("val", "validation")):
-            for ix in range(len(data)):
-                try:
-                    if data.get_metadata(ix)[f"must_be_in_{name}_set"] and ix not in out[key]:
-                        return False
-                except KeyError:
-                    pass
-        return True
-
-    while len(out["trn"]) == 0 or not is_valid():
-        for trn_ixs, val_ixs in ShuffleSplit(n_splits=1, test_size=ratio).split(np.arange(len(data))):
-            for k, ixs in zip(("trn", "val"), (trn_ixs, val_ixs)):
-                out[k] = tuple(map(int, ixs))
-
-    for k in out.keys():
-        out[k] = SubsetDataset(data, out[k])
+        return dict(trn=(), val=())
+    table = _read_split_table(data, stratify, groups)
+    bins = _assign(table, np.array([1 - ratio, ratio]), np.random.default_rng(seed))
+    if not np.any(bins == 0):
+        # Move the smallest unpinned group to the training set
+        free = np.flatnonzero(table["pinned"] < 0)
+        if len(free) == 0:
+            raise ValueError("All samples are pinned to the validation set.")
+        bins[free[np.argmin(table["sizes"][free])]] = 0
+    return {k: SubsetDataset(data, _sample_ixs(table, bins == b)) for b, k in enumerate(("trn", "val"))}
+
+
+def kfold_split(data, n_splits: int = 5, stratify: bool = False, groups: Optional[Union[str, Callable]] = None,
+                seed: Optional[int] = None) -> List[Dict[str, SubsetDataset]]:
+    """
+    Split into `n_splits` folds in a single pass, each fold serves as validation set once. See :func:`shuffle_split`.
+
+    Samples pinned to the training set are never validated on, samples pinned to the validation set are validated on
+    in every split.
+
+    :return: One dict with datasets "trn" and "val" per split
+    """
+    if n_splits < 2:
+        raise ValueError(f"Number of splits must be at least 2, got {n_splits}.")
+    table = _read_split_table(data, stratify, groups)
+    pinned = table["pinned"]
+    free = pinned < 0
+    folds = _assign(table, np.full(n_splits, 1 / n_splits), np.random.default_rng(seed), free)
+    out = []
+    for k in range(n_splits):
+        val = (free & (folds == k)) | (pinned == 1)
+        out.append(dict(trn=SubsetDataset(data, _sample_ixs(table, ~val)),
+                        val=SubsetDataset(data, _sample_ixs(table, val))))
     return out
+
+
+def _read_split_table(data, stratify: bool, groups: Optional[Union[str, Callable]]) -> Dict[str, np.ndarray]:
+    # Read constraints, categories and groups once, and reduce them to one entry per group
+    n = len(data)
+    must = np.zeros((n, 2), bool)
+    keys = []
+    for ix in range(n):
+        metadata = data.get_metadata(ix)
+        for j, name in enumerate(("train", "validation")):
+            try:
+                must[ix, j] = bool(metadata[f"must_be_in_{name}_set"])
+            except KeyError:
+                pass
+        if groups is None:
+            keys.append(str(ix))
+        elif isinstance(groups, str):
+            keys.append(str(metadata[groups]))
+        else:
+            keys.append(str(groups(data, ix)))
+    _, group_ixs = np.unique(keys, return_inverse=True)
+    group_ixs = group_ixs.ravel()
+    num_groups = group_ixs.max() + 1 if n > 0 else 0
+
+    must_train = np.bincount(group_ixs, must[:, 0], num_groups) > 0
+    must_val = np.bincount(group_ixs, must[:, 1], num_groups) > 0
+    if np.any(must_train & must_val):
+        raise ValueError("Samples of the same group must be in both the training and the validation set.")
+    pinned = np.full(num_groups, -1)
+    pinned[must_train] = 0
+    pinned[must_val] = 1
+
+    strata = np.zeros(num_groups, np.int64)
+    if stratify:
+        categories = _read_categories(data)
+        _, categories = np.unique(categories, return_inverse=True)
+        # Stratum of a group is its most frequent category
+        counts = np.zeros((num_groups, categories.max() + 1 if n > 0 else 0), np.int64)
+        np.add.at(counts, (group_ixs, categories.ravel()), 1)
+        strata = counts.argmax(1)
+
+    return dict(group_ixs=group_ixs, sizes=np.bincount(group_ixs, minlength=num_groups), pinned=pinned, strata=strata)
+
+
+def _read_categories(data) -> np.ndarray:
+    # Most frequent category of each sample, -1 if there is none
+    if isinstance(data, SubsetDataset):
+        root, ixs = data._root_ixs()
+        return _read_categories(root)[ixs]
+    index = getattr(data, "category_index", None)
+    if not isinstance(index, CategoryIndex):
+        index = CategoryIndex.build(data)
+    return index.dominant_categories()
+
+
+def _assign(table: Dict[str, np.ndarray], fractions: np.ndarray, rng: np.random.Generator,
+            mask: Optional[np.ndarray] = None) -> np.ndarray:
+    # Assign groups to bins, such that each stratum is split according to `fractions`. Groups are visited in random
+    # order, larger groups first, and each goes to the bin furthest below its target. Pinned groups are assigned first.
+    sizes, strata, pinned = table["sizes"], table["strata"], table["pinned"]
+    if mask is None:
+        mask = np.ones(len(sizes), bool)
+    bins = np.where(mask, pinned, -1)
+    for stratum in np.unique(strata[mask]):
+        members = np.flatnonzero(mask & (strata == stratum))
+        targets = fractions * sizes[members].sum()
+        counts = np.array([sizes[members[bins[members] == b]].sum() for b in range(len(fractions))], np.float64)
+        free = members[bins[members] < 0]
+        free = free[rng.permutation(len(free))]
+        free = free[np.argsort(-sizes[free], kind="stable")]
+        for g in free:
+            b = int(np.argmax(targets - counts))
+            bins[g] = b
+            counts[b] += sizes[g]
+    return bins
+
+
+def _sample_ixs(table: Dict[str, np.ndarray], groups: np.ndarray) -> Tuple[int, ...]:
+    return tuple(map(int, np.flatnonzero(groups[table["group_ixs"]])))
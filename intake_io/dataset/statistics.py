@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import numpy as np
+import xarray as xr
+
+from .util import fingerprint_callable
+
+QUANTILES = (0.005, 0.05, 0.25, 0.5, 0.75, 0.95, 0.995)
+
+
+def compute_statistics(
+        data: Any,
+        cache_path: Optional[str] = None,
+        num_workers: int = 8,
+        bins: int = 256,
+        quantiles: Sequence[float] = QUANTILES,
+        num_values: int = 10000,
+        foreground: Optional[Callable[[Dict[str, Any]], np.ndarray]] = None,
+        seed: int = 0,
+        fingerprint: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Per-channel intensity statistics of all samples of a dataset, computed in a single parallel pass.
+
+    Samples are merged into running per-channel statistics as they are computed, with at most `2 * num_workers`
+    samples in flight, so memory doesn't grow with the size of the dataset. Count, mean, std, min and max are exact.
+    Histograms are binned per sample and merged into bins spanning the range seen so far, quantiles are computed from
+    a random subset of values of each sample, weighted by sample size and compacted to `num_values` weighted values
+    when more are held.
+
+    :param data: Dataset, samples are dicts with the image in "data"
+    :param cache_path: JSON file to cache the result in, recomputed if `data`, its transform or the parameters changed.
+        Not cached if the transform or `foreground` can't be fingerprinted, see :func:`fingerprint_callable`.
+    :param num_workers: Number of samples loaded concurrently
+    :param bins: Number of histogram bins
+    :param quantiles: Quantiles to estimate
+    :param num_values: Maximum number of values per sample and channel, and of merged values per channel, used to
+        estimate quantiles
+    :param foreground: Callable returning the foreground mask of a sample, broadcastable to the shape of a channel.
+        Defaults to non-zero values of each channel.
+    :param seed: Seed for subsetting values
+    :param fingerprint: Identifies the content of `data` for caching, e.g. :attr:`SampleIndex.fingerprint`
+    :return: Dict with one dict of statistics per channel in "channels"
+    """
+    key = None
+    if cache_path is not None:
+        try:
+            params = dict(n=len(data), bins=bins, quantiles=list(quantiles), num_values=num_values, seed=seed,
+                          foreground=None if foreground is None else fingerprint_callable(foreground),
+                          transform=_fingerprint_transform(getattr(data, "transform", None)), fingerprint=fingerprint)
+            key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        except ValueError as ex:
+            warnings.warn(f"Not caching statistics: {ex}")
+            cache_path = None
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return cached["statistics"]
+
+    def _task(i):
+        sample = data[i]
+        image = _get_image(sample)
+        if foreground is None:
+            masks = image != 0
+        else:
+            masks = [np.broadcast_to(np.asarray(foreground(sample)), image.shape[1:])] * image.shape[0]
+        rng = np.random.default_rng((seed, i))
+        return [_sample_statistics(image[c], masks[c], bins, num_values, rng) for c in range(image.shape[0])]
+
+    # Merged in order, so that the result doesn't depend on the order in which samples finish
+    channels = None
+
+    def _add(stats):
+        nonlocal channels
+        if channels is None:
+            channels = [_ChannelStatistics(bins, num_values) for _ in stats]
+        if len(stats) != len(channels):
+            raise ValueError(f"Samples have different numbers of channels: {sorted({len(channels), len(stats)})}.")
+        for c, i in zip(channels, stats):
+            c.add(i)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = deque()
+        try:
+            for i in range(len(data)):
+                futures.append(executor.submit(_task, i))
+                if len(futures) >= 2 * num_workers:
+                    _add(futures.popleft().result())
+            while futures:
+                _add(futures.popleft().result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+    out = {"num_samples": len(data), "channels": [c.result(quantiles) for c in channels or ()]}
+    if cache_path is not None:
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "statistics": out}, f)
+        os.replace(tmp, cache_path)
+    return out
+
+
+def _fingerprint_transform(transform: Any) -> Any:
+    # Statistics are computed on transformed samples, so the transform is part of the cache key
+    if transform is None:
+        return None
+    if isinstance(transform, (list, tuple)):
+        return [_fingerprint_transform(i) for i in transform]
+    fingerprint = getattr(transform, "fingerprint", None)
+    if isinstance(fingerprint, str):
+        return fingerprint
+    return fingerprint_callable(transform)
+
+
+def _get_image(sample: Dict[str, Any]) -> np.ndarray:
+    # Channels first, one channel if there is no axis "c"
+    image = sample["data"]
+    if isinstance(image, xr.Dataset):
+        image = image["image"]
+    if isinstance(image, xr.DataArray):
+        if "c" in image.dims:
+            image = image.transpose("c", ...)
+            return image.values
+        return image.values[np.newaxis]
+    return np.asarray(image)[np.newaxis]
+
+
+def _sample_statistics(values: np.ndarray, mask: np.ndarray, bins: int, num_values: int,
+                       rng: np.random.Generator) -> Dict[str, Any]:
+    values = values.ravel()
+    counts, edges = np.histogram(values, bins, (values.min(), values.max()))
+    subset = values if values.size <= num_values else values[rng.integers(0, values.size, num_values)]
+    return dict(
+        n=values.size,
+        mean=values.mean(dtype=np.float64),
+        m2=values.var(dtype=np.float64) * values.size,
+        min=float(values.min()),
+        max=float(values.max()),
+        foreground=int(np.count_nonzero(mask)),
+        counts=counts,
+        edges=edges,
+        subset=subset.astype(np.float64)
+    )
+
+
+class _ChannelStatistics:
+    # Running statistics of one channel, merged sample by sample
+
+    def __init__(self, bins: int, num_values: int):
+        self.bins = bins
+        self.num_values = num_values
+        self.n, self.mean, self.m2 = 0, 0.0, 0.0
+        self.min, self.max = np.inf, -np.inf
+        self.foreground = 0
+        self.edges = None
+        self.counts = np.zeros(bins, np.int64)
+        # Weighted values for quantiles, compacted when more than twice num_values are held
+        self.values = []
+        self.weights = []
+        self.num_held = 0
+
+    def add(self, stats: Dict[str, Any]):
+        # Mean and variance are merged pairwise (Chan et al.)
+        delta = stats["mean"] - self.mean
+        total = self.n + stats["n"]
+        self.mean += delta * stats["n"] / total
+        self.m2 += stats["m2"] + delta ** 2 * self.n * stats["n"] / total
+        self.n = total
+        self.foreground += stats["foreground"]
+
+        # Histograms are re-binned by bin centers into bins spanning the range seen so far
+        lo, hi = min(self.min, stats["min"]), max(self.max, stats["max"])
+        if lo != self.min or hi != self.max:
+            edges = np.linspace(lo, hi, self.bins + 1) if hi > lo else np.linspace(lo - 0.5, lo + 0.5, self.bins + 1)
+            if self.edges is not None:
+                self.counts = self._rebin(self.edges, self.counts, edges)
+            self.edges, self.min, self.max = edges, lo, hi
+        self.counts += self._rebin(stats["edges"], stats["counts"], self.edges)
+
+        subset = stats["subset"]
+        self.values.append(subset)
+        self.weights.append(np.full(len(subset), stats["n"] / len(subset)))
+        self.num_held += len(subset)
+        if self.num_held > 2 * self.num_values:
+            self._compact()
+
+    def _rebin(self, edges: np.ndarray, counts: np.ndarray, new_edges: np.ndarray) -> np.ndarray:
+        out = np.zeros(self.bins, np.int64)
+        centers = (edges[:-1] + edges[1:]) / 2
+        np.add.at(out, np.clip(np.searchsorted(new_edges, centers, side="right") - 1, 0, self.bins - 1), counts)
+        return out
+
+    def _cdf(self):
+        # Sorted values and their weighted cumulative distribution, taken at the middle of each value's weight
+        values = np.concatenate(self.values)
+        weights = np.concatenate(self.weights)
+        order = np.argsort(values, kind="stable")
+        values, weights = values[order], weights[order]
+        return values, weights, (np.cumsum(weights) - weights / 2) / weights.sum()
+
+    def _compact(self):
+        # Replace the held values by num_values equally weighted quantiles of them
+        values, weights, cdf = self._cdf()
+        self.values = [np.interp((np.arange(self.num_values) + 0.5) / self.num_values, cdf, values)]
+        self.weights = [np.full(self.num_values, weights.sum() / self.num_values)]
+        self.num_held = self.num_values
+
+    def result(self, quantiles: Sequence[float]) -> Dict[str, Any]:
+        values, _, cdf = self._cdf()
+        return dict(
+            count=self.n,
+            mean=float(self.mean),
+            std=float(np.sqrt(self.m2 / self.n)),
+            min=self.min,
+            max=self.max,
+            foreground_fraction=self.foreground / self.n,
+            quantiles={f"{q:g}": float(np.interp(q, cdf, values)) for q in quantiles},
+            histogram=dict(edges=self.edges.tolist(), counts=self.counts.tolist())
+        )
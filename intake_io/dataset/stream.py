@@ -0,0 +1,135 @@
+import os
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+try:
+    from torch.utils.data import IterableDataset as _IterableDataset, get_worker_info
+except ModuleNotFoundError:
+    _IterableDataset = object
+    get_worker_info = None
+
+__all__ = ["StreamingDataset"]
+
+
+class StreamingDataset(_IterableDataset):
+    """
+    Iterable over the samples of an :class:`IntakeDataset` that reads each catalog item's partitions sequentially.
+
+    Catalog items are shuffled per epoch and split into shards of similar numbers of samples, one shard per
+    distributed rank and DataLoader worker. Each shard reads whole items in order and shuffles samples locally in a
+    buffer. Samples are dicts as returned by the dataset, plus their "shard" and their "position" within the shard's
+    stream, from which iteration can be resumed (see :meth:`load_state_dict`).
+    """
+
+    def __init__(self, data: Any, shuffle_buffer: int = 0, shuffle_items: bool = True, seed: int = 0,
+                 rank: Optional[int] = None, world_size: Optional[int] = None):
+        """
+        :param data: Dataset with a sample index, e.g. :class:`IntakeDataset`
+        :param shuffle_buffer: Number of samples to shuffle locally, no shuffling if less than 2
+        :param shuffle_items: Shuffle the order of catalog items per epoch
+        :param seed: Seed, combined with the epoch set by :meth:`set_epoch`
+        :param rank: Distributed rank, defaults to environment variable RANK or 0
+        :param world_size: Number of distributed ranks, defaults to environment variable WORLD_SIZE or 1
+        """
+        super().__init__()
+        self.data = data
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_items = shuffle_items
+        self.seed = seed
+        self.rank = int(os.environ.get("RANK", 0)) if rank is None else rank
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1)) if world_size is None else world_size
+        self.epoch = 0
+        # Samples yielded per shard in the current epoch
+        self._positions = {}
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self._positions = {}
+        self.epoch = epoch
+
+    def state_dict(self) -> Dict[str, Any]:
+        # Only covers iteration in this process. With DataLoader workers, collect "shard" and "position" of consumed
+        # samples instead.
+        return {"epoch": self.epoch, "positions": dict(self._positions)}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.epoch = state["epoch"]
+        self._positions = {int(k): int(v) for k, v in state["positions"].items()}
+
+    def _get_worker(self) -> Tuple[int, int]:
+        if get_worker_info is not None:
+            info = get_worker_info()
+            if info is not None:
+                return info.id, info.num_workers
+        return 0, 1
+
+    def _get_sequence(self, worker: int = 0, num_workers: int = 1) -> np.ndarray:
+        # Sample indices of a shard in reading order. Items are split among ranks, then among the workers of a rank, the
+        # same way everywhere.
+        items = self.data._index.items
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(items)) if self.shuffle_items else np.arange(len(items))
+        order = order[_balance(items["num_partitions"][order], self.world_size) == self.rank]
+        order = order[_balance(items["num_partitions"][order], num_workers) == worker]
+        if len(order) == 0:
+            return np.zeros(0, np.int64)
+        offsets, sizes = items["offset"][order], items["num_partitions"][order]
+        return np.concatenate([np.arange(o, o + n) for o, n in zip(offsets, sizes)]).astype(np.int64)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        worker, num_workers = self._get_worker()
+        shard = self.rank * num_workers + worker
+        sequence = self._get_sequence(worker, num_workers)
+        order = _shuffled(len(sequence), self.shuffle_buffer, np.random.default_rng((self.seed, self.epoch, shard)))
+
+        # Skip what was yielded before resuming, without reading it
+        start = self._positions.get(shard, 0)
+        done = np.zeros(len(sequence), bool)
+        for _ in range(start):
+            done[next(order)] = True
+
+        pending = iter(np.flatnonzero(~done))
+        loaded = {}
+        for position, k in enumerate(order, start + 1):
+            while k not in loaded:
+                j = int(next(pending))
+                loaded[j] = self.data[int(sequence[j])]
+            sample = loaded.pop(k)
+            sample["shard"] = shard
+            sample["position"] = position
+            self._positions[shard] = position
+            yield sample
+        # Finished, iterating again starts over
+        self._positions.pop(shard, None)
+
+    def __len__(self) -> int:
+        # Number of samples of this rank in the current epoch, over all its workers
+        return len(self._get_sequence())
+
+
+def _balance(sizes: np.ndarray, n: int) -> np.ndarray:
+    # Assign each entry to one of n bins, larger entries first, each to the bin with the smallest total
+    out = np.zeros(len(sizes), np.int64)
+    totals = np.zeros(n, np.int64)
+    for k in np.argsort(-sizes, kind="stable"):
+        out[k] = int(np.argmin(totals))
+        totals[out[k]] += sizes[k]
+    return out
+
+
+def _shuffled(n: int, size: int, rng: np.random.Generator) -> Iterator[int]:
+    # Positions 0..n-1 in the order they leave a shuffle buffer of the given size
+    if size < 2:
+        yield from range(n)
+        return
+    buffer = []
+    for i in range(n):
+        if len(buffer) < size:
+            buffer.append(i)
+            continue
+        j = int(rng.integers(size))
+        yield buffer[j]
+        buffer[j] = i
+    for j in rng.permutation(len(buffer)):
+        yield buffer[j]
@@ -1,47 +1,204 @@
+import functools
+import hashlib
+import os
+import pickle
+import types
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
 import pandas as pd
 
 
-def _get_categories_categorized(data) -> pd.DataFrame:
-    counts = {}
-    for ix in range(len(data)):
-        category = data.get_category(ix)
+class CategoryIndex:
+    """
+    Columnar index of the categories of a dataset, with one row per sample of a :class:`CategorizedDataset` or one row
+    per annotated instance of an :class:`AnnotatedDataset`.
+
+    Category tables, subset statistics and category filters are computed from it without calling user code again.
+    """
+
+    def __init__(self, num_samples: int, samples: np.ndarray, categories: np.ndarray, names: Sequence[Any],
+                 instances: bool):
+        self.num_samples = num_samples
+        self.samples = samples        # sample of each row
+        self.categories = categories  # index into `names` of each row
+        self.names = list(names)      # sorted category names
+        self.instances = instances    # whether rows are annotated instances
+        # Unique (sample, category) pairs
+        pairs = np.unique(samples * max(len(self.names), 1) + categories)
+        self._pair_samples, self._pair_categories = np.divmod(pairs, max(len(self.names), 1))
+
+    @classmethod
+    def build(cls, data: Any, num_workers: int = 8) -> "CategoryIndex":
+        # Calls get_category or get_annotations once per sample, in parallel
+        if hasattr(data, "get_category"):
+            values = _map_samples(data, lambda i: [data.get_category(i)], num_workers)
+            instances = False
+        else:
+            def _task(i):
+                annotations = data.get_annotations(i)
+                return list(annotations[data.get_category_name_column(annotations.columns)])
+            values = _map_samples(data, _task, num_workers)
+            instances = True
+
+        names = sorted({v for i in values for v in i})
+        codes = {name: i for i, name in enumerate(names)}
+        samples = np.repeat(np.arange(len(values), dtype=np.int64), [len(i) for i in values])
+        categories = np.fromiter((codes[v] for i in values for v in i), np.int64, len(samples))
+        return cls(len(values), samples, categories, names, instances)
+
+    def save(self, path: str, fingerprint: str = ""):
+        # Category names are stored as an array of their type, e.g. str or int, to be loaded without pickle
+        names = np.array(self.names)
+        if names.ndim != 1 or [type(i) for i in names.tolist()] != [type(i) for i in self.names] or \
+                names.tolist() != self.names:
+            raise ValueError(f"Can't store category names {self.names!r} as an array of one type.")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, samples=self.samples, categories=self.categories, names=names,
+                     num_samples=self.num_samples, instances=self.instances, fingerprint=fingerprint)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: Optional[str] = None) -> Optional["CategoryIndex"]:
+        # None if the index was saved with a different fingerprint
+        with np.load(path, allow_pickle=False) as f:
+            if fingerprint is not None and str(f["fingerprint"]) != fingerprint:
+                return None
+            return cls(int(f["num_samples"]), f["samples"], f["categories"], f["names"].tolist(), bool(f["instances"]))
+
+    def _weights(self, ixs: Optional[Sequence[int]]) -> np.ndarray:
+        # Number of occurrences of each sample in `ixs`
+        if ixs is None:
+            return np.ones(self.num_samples, np.int64)
+        return np.bincount(np.asarray(ixs, np.int64), minlength=self.num_samples)
+
+    def table(self, ixs: Optional[Sequence[int]] = None) -> pd.DataFrame:
+        # Categories of all samples or of the samples `ixs`, in the format of `get_categories`
+        weights = self._weights(ixs)
+        num_samples = np.bincount(self._pair_categories, weights[self._pair_samples], len(self.names))
+        num_instances = np.bincount(self.categories, weights[self.samples], len(self.names))
+        present = np.flatnonzero(num_instances > 0)
+        out = dict(
+            category_index=np.arange(len(present)),
+            category_name=[self.names[i] for i in present],
+            category_num_samples=num_samples[present].astype(np.int64)
+        )
+        if self.instances:
+            out["category_num_instances"] = num_instances[present].astype(np.int64)
+        return pd.DataFrame(out)
+
+    def pairs(self, ixs: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Unique (sample, category) pairs, of the samples `ixs` with samples given as positions in `ixs`
+        if ixs is None:
+            return self._pair_samples, self._pair_categories
+        ixs = np.asarray(ixs, np.int64)
+        start = np.searchsorted(self._pair_samples, ixs, "left")
+        counts = np.searchsorted(self._pair_samples, ixs, "right") - start
+        rows = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.repeat(np.arange(len(ixs)), counts), self._pair_categories[rows]
+
+    def sample_ixs(self, categories: Sequence[Any]) -> np.ndarray:
+        # Samples of (or with instances of) any of `categories`
+        codes = [i for i, name in enumerate(self.names) if name in set(categories)]
+        return np.unique(self._pair_samples[np.isin(self._pair_categories, codes)])
+
+    def dominant_categories(self) -> np.ndarray:
+        # Index into `names` of the most frequent category of each sample, -1 for samples without category
+        counts = np.zeros((self.num_samples, max(len(self.names), 1)), np.int64)
+        np.add.at(counts, (self.samples, self.categories), 1)
+        out = counts.argmax(1)
+        out[counts.sum(1) == 0] = -1
+        return out
+
+
+def _map_samples(data: Any, fn: Callable[[int], List[Any]], num_workers: int) -> List[List[Any]]:
+    # Samples of the same catalog item are processed by the same task, since they share a source
+    index = getattr(data, "_index", None)
+    if index is not None:
+        tasks = [range(int(o), int(o + n)) for o, n in zip(index.items["offset"], index.items["num_partitions"])]
+    else:
+        tasks = [range(i, i + 1) for i in range(len(data))]
+    with ThreadPoolExecutor(num_workers) as executor:
+        return [v for task in executor.map(lambda ixs: [fn(i) for i in ixs], tasks) for v in task]
+
+
+def get_categories(data, ixs: Optional[Sequence[int]] = None) -> pd.DataFrame:
+    index = getattr(data, "category_index", None)
+    if not isinstance(index, CategoryIndex):
+        index = CategoryIndex.build(data)
+    return index.table(ixs)
+
+
+def fingerprint_callable(fn: Callable) -> str:
+    """
+    Fingerprint of a callable that is the same in every process and run, e.g. to key cached outputs of `fn`.
+
+    Functions (incl. lambdas and closures) are identified by their code, constants, referenced names, defaults and
+    closure values, other callables by pickling them. Global variables that `fn` reads aren't captured.
+
+    :param fn: Callable
+    :return: Hex digest
+    :raises ValueError: If `fn` can't be fingerprinted stably, e.g. if it holds values that can't be pickled
+    """
+    h = hashlib.sha1()
+    _hash_callable(fn, h)
+    return h.hexdigest()
+
+
+def _hash_callable(fn: Any, h):
+    if isinstance(fn, functools.partial):
+        h.update(b"partial")
+        _hash_callable(fn.func, h)
+        _hash_value((fn.args, fn.keywords), h)
+    elif isinstance(fn, types.MethodType):
+        h.update(b"method")
+        _hash_callable(fn.__func__, h)
+        _hash_value(fn.__self__, h)
+    elif isinstance(fn, types.FunctionType):
+        h.update(f"function:{fn.__module__}.{fn.__qualname__}".encode())
+        _hash_code(fn.__code__, h)
+        _hash_value(fn.__defaults__, h)
+        _hash_value(fn.__kwdefaults__, h)
+        for cell in fn.__closure__ or ():
+            _hash_value(cell.cell_contents, h)
+    else:
+        # Builtins pickle by name, callable objects by value. Include the code of their class' __call__, since
+        # classes pickle by name only.
+        _hash_value(fn, h)
+        call = getattr(type(fn), "__call__", None)
+        if isinstance(call, types.FunctionType):
+            _hash_code(call.__code__, h)
+
+
+def _hash_code(code: types.CodeType, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, h)
+        elif isinstance(const, frozenset):
+            # Order of sets of strings depends on the hash seed
+            h.update(repr(sorted(map(repr, const))).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def _hash_value(x: Any, h):
+    if isinstance(x, (types.FunctionType, types.MethodType, functools.partial)):
+        _hash_callable(x, h)
+    elif isinstance(x, (list, tuple)):
+        h.update(f"{type(x).__name__}:{len(x)}".encode())
+        for i in x:
+            _hash_value(i, h)
+    elif isinstance(x, dict):
+        h.update(f"dict:{len(x)}".encode())
+        for k, v in x.items():
+            _hash_value(k, h)
+            _hash_value(v, h)
+    else:
         try:
-            counts[category] += 1
-        except KeyError:
-            counts[category] = 1
-    return pd.DataFrame(dict(
-        category_index=i,
-        category_name=name,
-        category_num_samples=counts[name]
-    ) for i, name in enumerate(sorted(list(counts.keys()))))
-
-
-def _get_categories_annotated(data) -> pd.DataFrame:
-    num_total = {}
-    num_samples = {}
-    for ix in range(len(data)):
-        annotations = data.get_annotations(ix)
-        categories = annotations[data.get_category_name_column(annotations.columns)]
-        for category in categories:
-            try:
-                num_total[category] += 1
-            except KeyError:
-                num_total[category] = 1
-        for category in set(categories):
-            try:
-                num_samples[category] += 1
-            except KeyError:
-                num_samples[category] = 1
-    return pd.DataFrame(dict(
-        category_index=i,
-        category_name=name,
-        category_num_samples=num_samples[name],
-        category_num_instances=num_total[name]
-    ) for i, name in enumerate(sorted(list(num_total.keys()))))
-
-
-def get_categories(data) -> pd.DataFrame:
-    try:
-        return _get_categories_categorized(data)
-    except AttributeError:
-        return _get_categories_annotated(data)
+            h.update(pickle.dumps(x, protocol=4))
+        except Exception as ex:
+            raise ValueError(f"Can't fingerprint {x!r} stably, set a fingerprint explicitly.") from ex
@@ -1,10 +1,59 @@
 import io
 import os
+import time
+import warnings
 
 import flywheel
 import natsort
 from fsspec import AbstractFileSystem
 from fsspec.callbacks import _DEFAULT_CALLBACK
+from fsspec.spec import AbstractBufferedFile
+
+
+class _TTLCache:
+
+    def __init__(self, ttl=None, max_bytes=None):
+        # max_bytes: Budget for the total len() of values, the oldest are evicted first. None for no limit.
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = {}
+        self._nbytes = 0
+
+    def get(self, key):
+        try:
+            t, value = self._data[key]
+        except KeyError:
+            return None
+        if self.ttl is not None and time.monotonic() - t >= self.ttl:
+            self.pop(key)
+            return None
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+        if self.max_bytes is not None:
+            if len(value) > self.max_bytes:
+                return
+            while self._nbytes + len(value) > self.max_bytes:
+                self.pop(next(iter(self._data)))
+            self._nbytes += len(value)
+        self._data[key] = (time.monotonic(), value)
+
+    def pop(self, key):
+        try:
+            value = self._data.pop(key)[1]
+        except KeyError:
+            return None
+        if self.max_bytes is not None:
+            self._nbytes -= len(value)
+        return value
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def clear(self):
+        self._data.clear()
+        self._nbytes = 0
 
 
 class FlywheelFileSystem(AbstractFileSystem):
@@ -15,12 +64,56 @@ class FlywheelFileSystem(AbstractFileSystem):
     async_impl = False
     root_marker = "/"
 
-    def __init__(self, hostname=None, apikey=None, *args, **kwargs):
+    def __init__(self, hostname=None, apikey=None, cache_ttl=300, block_size=2**16, cache_type="readahead",
+                 max_cached_contents=2**30, *args, **kwargs):
+        # cache_ttl: Seconds to cache nodes and listings for, None to never expire, 0 to disable
+        # block_size, cache_type: Defaults for files opened for reading, fetched in ranges of at least block_size
+        # max_cached_contents: Budget in bytes for entire files kept because the server ignored range requests
         super().__init__(*args, **kwargs)
+        self.block_size = block_size
+        self.cache_type = cache_type
         self._hostname = os.environ["FLYWHEEL_HOSTNAME"] if hostname is None else hostname
         if apikey is None:
             apikey = os.environ["FLYWHEEL_APIKEY"]
         self._client = flywheel.Client(f"{self._hostname}:{apikey.split(':')[-1]}")
+        self._nodes = _TTLCache(cache_ttl)     # node id -> node
+        self._paths = _TTLCache(cache_ttl)     # path -> node
+        self._listings = _TTLCache(cache_ttl)  # path -> ls(path, detail=True)
+        self._contents = _TTLCache(cache_ttl, max_cached_contents)  # path -> contents, if ranges weren't honored
+
+    def _get(self, id):
+        node = self._nodes.get(id)
+        if node is None:
+            node = self._client.get(id)
+            self._nodes.put(id, node)
+        return node
+
+    def _lookup(self, path):
+        node = self._paths.get(path)
+        if node is None:
+            node = self._client.lookup(path)
+            self._paths.put(path, node)
+            id = getattr(node, "id", None)
+            if id is not None:
+                self._nodes.put(id, node)
+        return node
+
+    def invalidate_cache(self, path=None):
+        if path is None:
+            self._nodes.clear()
+            self._paths.clear()
+            self._listings.clear()
+            self._contents.clear()
+        else:
+            path = self._strip_hostname(path).rstrip(self.sep).lstrip(self.root_marker)
+            parent = path.rsplit(self.sep, 1)[0] if self.sep in path else ""
+            for cache in (self._paths, self._listings, self._contents):
+                for k in cache.keys():
+                    if k == path or k.startswith(path + self.sep) or (cache is self._listings and k == parent):
+                        node = cache.pop(k)
+                        if cache is self._paths:
+                            self._nodes.pop(getattr(node, "id", None))
+        super().invalidate_cache(path)
 
     def _strip_hostname(self, x):
         x = self._strip_protocol(x)
@@ -39,9 +132,19 @@ class FlywheelFileSystem(AbstractFileSystem):
 
     def ls(self, path, detail=False, **kwargs):
         path = self._strip_hostname(path).rstrip(self.sep).lstrip(self.root_marker)
+        listing = self._listings.get(path)
+        if listing is None:
+            listing = self._ls(path)
+            self._listings.put(path, listing)
+        if not detail:
+            return [i["name"] for i in listing]
+        return [dict(i) for i in listing]
+
+    def _ls(self, path):
         if len(path.strip()) == 0:
             node = None
-            items = [i.id for i in self._client.groups()]
+            file = None
+            items = list(self._client.groups())
         else:
             try:
                 parent, file = path.rsplit(self.sep, 1)
@@ -50,10 +153,10 @@ class FlywheelFileSystem(AbstractFileSystem):
                 file = None
             if file in ("analyses", "files"):
                 # List analyses and files if path ends on "/analyses" or "/files"
-                node = self._client.lookup(parent)
+                node = self._lookup(parent)
                 items = getattr(node, file)
             else:
-                node = self._client.lookup(path)
+                node = self._lookup(path)
                 items = getattr(node, node.child_types[0])
                 try:
                     items = items()
@@ -77,15 +180,16 @@ class FlywheelFileSystem(AbstractFileSystem):
             except AttributeError:
                 continue
 
-        paths = [self.root_marker + path + self.sep + i for i in map(self._ls_name, items)]
-        if not detail:
-            return paths
-        else:
-            items = list(map(self.info, items))
-            for i, n in zip(items, paths):
-                i["name"] = n
-
-        return items
+        # Names are known from the listed path, no need to resolve them through the parents of each item
+        out = []
+        for item in items:
+            name = self.root_marker + (path + self.sep if path else "") + self._ls_name(item)
+            if isinstance(item, str):
+                out.append(dict(name=name, type="directory", size=None, created=None, modified=None, data=None))
+            else:
+                self._paths.put(name.lstrip(self.root_marker), item)
+                out.append(self._info(item, name))
+        return out
 
     def _ls_name(self, x):
         if not isinstance(x, str) and self._type(x) == "group":
@@ -134,46 +238,72 @@ class FlywheelFileSystem(AbstractFileSystem):
             yield from self.walk(d, maxdepth=maxdepth, detail=detail, **kwargs)
 
     def info(self, path, **kwargs):
-        out = {}
         if not isinstance(path, str):
-            node = path
-            out["name"] = [self._ls_name(node)]
-
-            parent = node
-            while hasattr(parent, "parent"):
-                if self._type(parent) == "analysis":
-                    out["name"].insert(0, "analyses")
-                elif self._type(parent) == "file":
-                    out["name"].insert(0, "files")
-                parent = self._client.get(getattr(parent, "parent")["id"])
-                out["name"].insert(0, self._ls_name(parent))
-            try:
-                parents = parent["parents"]
-                for field in ("acquisition", "session", "subject", "project", "group"):
-                    id = parents.get(field) or None
-                    if id is not None:
-                        out["name"].insert(0, self._ls_name(self._client.get(id)))
-            except KeyError:
-                pass
-
-            out["name"] = self.sep.join(out["name"])
-            out["type"] = self._type(node)
-        else:
-            out["name"] = self._strip_hostname(path).rstrip(self.sep)
-            out["type"] = self._type(out["name"])
-            node = self._client.lookup(out["name"])
-        out["size"] = self.size(node)
-        out["created"] = self.created(node)
-        out["modified"] = self.modified(node)
-        out["data"] = node
+            return self._info(path, self._resolve_name(path))
+
+        name = self._strip_hostname(path).rstrip(self.sep)
+
+        # Use the listing of the parent if cached
+        if self.sep in name.lstrip(self.root_marker):
+            for item in self._listings.get(name.lstrip(self.root_marker).rsplit(self.sep, 1)[0]) or ():
+                if item["name"].lstrip(self.root_marker) == name.lstrip(self.root_marker):
+                    return dict(item, name=name)
+
+        out = self._info(self._lookup(name.lstrip(self.root_marker)), name)
+        out["type"] = self._type(name)
         return out
-    
+
+    def _info(self, node, name):
+        return dict(
+            name=name,
+            type=self._type(node),
+            size=self.size(node),
+            created=self.created(node),
+            modified=self.modified(node),
+            data=node
+        )
+
+    def _parent_ref(self, node):
+        # Newer SDK versions expose a reference as "parent_ref" and fetch the container on accessing "parent"
+        for field in ("parent_ref", "parent"):
+            try:
+                ref = getattr(node, field)
+            except AttributeError:
+                continue
+            if ref is not None:
+                return ref
+        return None
+
+    def _resolve_name(self, node):
+        # Walk up to the enclosing container, then resolve all remaining ancestors from its "parents" field in one
+        # pass. Each container is fetched at most once per cache lifetime.
+        name = [self._ls_name(node)]
+        parent = node
+        ref = self._parent_ref(parent)
+        while ref is not None:
+            if self._type(parent) == "analysis":
+                name.insert(0, "analyses")
+            elif self._type(parent) == "file":
+                name.insert(0, "files")
+            parent = self._get(ref["id"])
+            name.insert(0, self._ls_name(parent))
+            ref = self._parent_ref(parent)
+        try:
+            parents = parent["parents"]
+            for field in ("acquisition", "session", "subject", "project", "group"):
+                id = parents.get(field) or None
+                if id is not None:
+                    name.insert(0, self._ls_name(self._get(id)))
+        except (KeyError, TypeError):
+            pass
+        return self.sep.join(name)
+
     def _type(self, path):
         if self.isfile(path):
             return "file"
 
         if isinstance(path, str):
-            path = self._strip_hostname(path).rstrip(self.sep).split(self.sep)
+            path = self._strip_hostname(path).rstrip(self.sep).lstrip(self.root_marker).split(self.sep)
             if path[-1] in ("analyses", "files"):
                 return "directory"
             if len(path) > 1 and path[-2] == "analyses":
@@ -209,6 +339,8 @@ class FlywheelFileSystem(AbstractFileSystem):
         return not self.isfile(path)
 
     def isfile(self, path):
+        if isinstance(path, dict) and "type" in path and "data" in path:
+            return path["type"] == "file"
         if not isinstance(path, str):
             return "file" in str(type(path)).lower()
         try:
@@ -217,7 +349,12 @@ class FlywheelFileSystem(AbstractFileSystem):
             return False
 
     def cat_file(self, path, start=None, end=None, **kwargs):
-        raise NotImplementedError
+        container, file, size = self._file_container(path)
+        if start is not None and start < 0:
+            start = max(size + start, 0)
+        if end is not None and end < 0:
+            end = size + end
+        return self._fetch_range(path, container, file, start or 0, size if end is None else min(end, size))
 
     def pipe_file(self, path, value, **kwargs):
         raise NotImplementedError
@@ -237,10 +374,10 @@ class FlywheelFileSystem(AbstractFileSystem):
         raise NotImplementedError
 
     def head(self, path, size=1024):
-        raise NotImplementedError
+        return self.cat_file(path, 0, size)
 
     def tail(self, path, size=1024):
-        raise NotImplementedError
+        return self.cat_file(path, -size)
 
     def cp_file(self, path1, path2, **kwargs):
         raise NotImplementedError
@@ -269,19 +406,48 @@ class FlywheelFileSystem(AbstractFileSystem):
         cache_options=None,
         **kwargs,
     ):
-        # return AbstractBufferedFile(
-        #     self,
-        #     path,
-        #     mode,
-        #     block_size,
-        #     autocommit,
-        #     cache_options=cache_options,
-        #     **kwargs,
-        # )
-        container, file = path.split("/files/")
-        container = self.info(container)
-        file = io.BytesIO(container["data"].read_file(file))
-        return io.BufferedRandom(file)
+        if "r" not in mode:
+            raise NotImplementedError
+        container, file, size = self._file_container(path)
+        return FlywheelFile(
+            self,
+            path,
+            container,
+            file,
+            mode=mode,
+            block_size=self.block_size if block_size is None else block_size,
+            autocommit=autocommit,
+            cache_type=kwargs.pop("cache_type", self.cache_type),
+            cache_options=cache_options,
+            size=size,
+            **kwargs,
+        )
+
+    def _file_container(self, path):
+        path = self._strip_hostname(path)
+        container, file = path.rsplit("/files/", 1)
+        container = self.info(container)["data"]
+        try:
+            size = next(i for i in container.files if self._ls_name(i) == file).size
+        except (AttributeError, StopIteration):
+            size = self.info(path)["size"]
+        return container, file, size
+
+    def _fetch_range(self, path, container, file, start, end):
+        if end <= start:
+            return b""
+        key = self._strip_hostname(path).lstrip(self.root_marker)
+        contents = self._contents.get(key)
+        if contents is None:
+            # Range headers are only honored for view requests
+            out = container.read_file(file, range=f"bytes={start}-{end - 1}", view=True)
+            if len(out) <= end - start:
+                return out
+            # The server returned the entire file, keep it instead of downloading it again for every block
+            warnings.warn(f"Range request for {file} returned the entire file, caching it.")
+            contents = out
+            self._contents.put(key, contents)
+        return contents[start:end]
 
     def open(self, path, mode="rb", block_size=None, cache_options=None, **kwargs):
         path = self._strip_hostname(path)
@@ -322,3 +488,15 @@ class FlywheelFileSystem(AbstractFileSystem):
         if not isinstance(path, str):
             return path.get("modified") or None
         return self.info(path).get("modified") or None
+
+
+class FlywheelFile(AbstractBufferedFile):
+    """Read-only file on Flywheel, fetched in byte ranges through a configurable block cache."""
+
+    def __init__(self, fs, path, container, file, **kwargs):
+        self.container = container
+        self.file = file
+        super().__init__(fs, path, **kwargs)
+
+    def _fetch_range(self, start, end):
+        return self.fs._fetch_range(self.path, self.container, self.file, start, end)
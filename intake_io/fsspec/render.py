@@ -2,6 +2,26 @@ from fsspec import AbstractFileSystem
 import re
 import io
 import requests
+from requests.adapters import HTTPAdapter
+
+
+def render_session(pool_size: int = 10) -> requests.Session:
+    # Keep-alive session with a connection pool large enough for pool_size concurrent requests
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def render_box_url(host, owner, project, stack, z, x, y, w, h, s, f="tiff", c=None):
+    # Port defaults to 8080 unless given as part of host, e.g. "localhost:8081"
+    if ":" not in host:
+        host += ":8080"
+    uri = f"http://{host}/render-ws/v1/owner/{owner}/project/{project}/stack/{stack}/z/{z}/box/{x},{y},{w},{h},{s}/{f}-image"
+    if c is not None:
+        uri += f"?channels={c}"
+    return uri
 
 class RenderFileSystem(AbstractFileSystem):
 
@@ -16,6 +36,7 @@ class RenderFileSystem(AbstractFileSystem):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._session = render_session()
 
     def _strip_hostname(self, x):
         x = self._strip_protocol(x)
@@ -97,11 +118,9 @@ class RenderFileSystem(AbstractFileSystem):
         if f == "tif":
             f += "f"
         
-        uri = f"http://{host}:8080/render-ws/v1/owner/{owner}/project/{project}/stack/{stack}/z/{z}/box/{x},{y},{w},{h},{s}/{f}-image"
-        if c is not None:
-            uri += f"?channels={c}"
-        rq = requests.get(uri, stream=True)
-        return io.BufferedRandom(io.BytesIO(rq.content))
+        rq = self._session.get(render_box_url(host, owner, project, stack, z, x, y, w, h, s, f, c))
+        rq.raise_for_status()
+        return io.BytesIO(rq.content)
 
     def touch(self, path, truncate=True, **kwargs):
         raise NotImplementedError
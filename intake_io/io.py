@@ -1,7 +1,11 @@
 import os
-from typing import Any, Optional
+import threading
+from concurrent.futures import FIRST_COMPLETED as _FIRST_COMPLETED, ThreadPoolExecutor as _ThreadPoolExecutor, \
+    wait as _wait
+from typing import Any, Generator, Iterable, Optional, Tuple, Union
 
 import intake
+import numpy as np
 import xarray as xr
 import zarr
 
@@ -30,6 +34,17 @@ def imload(uri: str, partition: Optional[Any] = None, metadata_only: bool = Fals
 
         * **output_axis_order** (`Optional[str]`) --
           Deviate from default "itczyx" output axis ordering, or `None` to use original axis ordering of the data
+        * **collect_stats** (`Optional[bool]`) --
+          Collect I/O statistics, see :meth:`intake_io.source.base.ImageSource.stats`. Defaults to the global setting
+          of :func:`intake_io.source.enable_stats`
+        * **storage_options** (`Optional[Dict[str, Any]]`) --
+          Arguments passed to the `fsspec <https://filesystem-spec.readthedocs.io>`_ file system, e.g. credentials
+        * **block_size** (`Optional[int]`) --
+          Read block size of remote files, larger blocks trade bandwidth for fewer requests
+        * **cache_type** (`Optional[str]`) --
+          fsspec read cache of remote files, e.g. "readahead", "blockcache" or "all"
+        * **filecache** (`Optional[str]`) --
+          Local directory to cache whole remote files in, so that repeated reads of the same file hit local disk
         * **metadata** (`Optional[Dict[str, Any]]`) --
           Add or overrule metadata fields, for instance:
 
@@ -63,6 +78,149 @@ def imload(uri: str, partition: Optional[Any] = None, metadata_only: bool = Fals
         return imload(src, partition, metadata_only)
 
 
+def imload_many(
+        uris: Iterable[str],
+        partition: Optional[Any] = None,
+        metadata_only: bool = False,
+        max_concurrency: int = 8,
+        max_memory: Optional[int] = None,
+        ordered: bool = True,
+        **kwargs
+) -> Generator[Tuple[str, Union[xr.Dataset, Exception]], None, None]:
+    """
+    Load many images concurrently, autodetect source types.
+
+    Opening, format detection, metadata parsing and reading of different URIs overlap across a pool of threads. Results
+    are yielded as :code:`(uri, image)` tuples. If loading a URI fails, the exception is yielded in place of the image
+    and the remaining URIs are still loaded.
+
+    :param Iterable[str] uris:
+
+    :param Optional[Any] partition:
+        Load only a partition of each image
+
+    :param bool metadata_only:
+        Load metadata only
+
+    :param int max_concurrency:
+        Maximum number of URIs loaded at the same time
+
+    :param Optional[int] max_memory:
+        Approximate upper bound in bytes of decoded image data held by images that are being read or have been read but
+        not yet yielded. Estimated from image metadata before reading. A single image larger than the bound is still
+        loaded. Default `None` is unbounded.
+
+    :param bool ordered:
+        Yield results in input order if `True`, otherwise in order of completion
+
+    :param kwargs:
+        Additional arguments passed to the source constructor, see :func:`imload`
+
+    :return: generator of :code:`(uri, image)` tuples
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be positive, got {max_concurrency}.")
+
+    budget = _MemoryBudget(max_memory)
+    uris = enumerate(uris)
+    pending = {}
+
+    def submit():
+        try:
+            ix, uri = next(uris)
+        except StopIteration:
+            return False
+        future = pool.submit(_imload_task, ix, uri, budget, partition, metadata_only, kwargs)
+        pending[ix] = (uri, future)
+        return True
+
+    pool = _ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        # Keep a bounded window of submitted URIs, so that long or lazy inputs aren't consumed all at once
+        for _ in range(2 * max_concurrency):
+            if not submit():
+                break
+
+        next_ix = 0
+        while len(pending) > 0:
+            if ordered:
+                ix = next_ix
+            else:
+                _wait([f for _, f in pending.values()], return_when=_FIRST_COMPLETED)
+                ix = next(i for i, (_, f) in pending.items() if f.done())
+            uri, future = pending.pop(ix)
+            out, nbytes = future.result()
+            next_ix += 1
+            budget.release(nbytes, next_ix if ordered else None)
+            submit()
+            yield uri, out
+    finally:
+        budget.close()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class _MemoryBudget:
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._next_ix = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, ix: Optional[int] = None):
+        # The next result to be yielded in ordered mode must never wait, otherwise results that are complete but
+        # queued behind it could hold the entire budget.
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._used == 0 or ix == self._next_ix
+                                     or self._used + nbytes <= self.max_bytes)
+            self._used += nbytes
+
+    def release(self, nbytes: int, next_ix: Optional[int] = None):
+        with self._condition:
+            self._used -= nbytes
+            if next_ix is not None:
+                self._next_ix = next_ix
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def _estimate_nbytes(src: intake.DataSource, partition: Optional[Any] = None) -> int:
+    nbytes = int(np.prod(src.shape)) * np.dtype(src.dtype).itemsize
+    if partition is None:
+        return nbytes
+    nbytes //= max(src.npartitions, 1)
+    if isinstance(partition, (list, tuple)):
+        nbytes *= len(partition)
+    return nbytes
+
+
+def _imload_task(
+        ix: int,
+        uri: Any,
+        budget: _MemoryBudget,
+        partition: Optional[Any],
+        metadata_only: bool,
+        kwargs: dict
+) -> Tuple[Union[xr.Dataset, Exception], int]:
+    nbytes = 0
+    try:
+        if metadata_only or budget.max_bytes is None or not isinstance(uri, str):
+            return imload(uri, partition, metadata_only, **kwargs), nbytes
+        with _autodetect(uri, **kwargs) as src:
+            src.discover()
+            estimate = _estimate_nbytes(src, partition)
+            budget.acquire(estimate, ix)
+            nbytes = estimate
+            return imload(src, partition), nbytes
+    except Exception as ex:
+        return ex, nbytes
+
+
 def imsave(image: Any, uri: str, compress: Optional[bool] = None, partition: Optional[str] = None, **kwargs):
     """
     Save image, autodetect format.
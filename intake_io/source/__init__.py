@@ -1,5 +1,6 @@
 from ..fsspec import *
 from .auto import AutoSource
+from .base import enable_stats, set_stats_callback
 from .bioformats import BioformatsSource
 from .dicom import DicomSource, DicomZipSource
 from .directory import DirSource
@@ -8,6 +9,7 @@ from .imageio import ImageIOSource
 from .list import ListSource
 from .nifti import NiftiSource
 from .nrrd import NrrdSource
+from .render import RenderSource
 from .tif import TifSource
 
 try:
@@ -1,30 +1,183 @@
+import time
+from contextlib import contextmanager
 from copy import deepcopy
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
-import fsspec
 import numpy as np
+from fsspec.caching import caches as _fsspec_caches
+from fsspec.core import split_protocol, url_to_fs
 import xarray as xr
 from intake.source.base import DataSource, Schema
 from yaml import dump as _dump
 
 from ..util import _get_spacing_dicts, _reorder_axes, get_axes, to_xarray
 
+_STATS_PHASES = ("open", "schema", "decode", "reorder")
+_collect_stats = False
+_stats_callback = None
+
+
+def enable_stats(enabled: bool = True):
+    """
+    Enable or disable collection of I/O statistics by all image sources that don't explicitly set `collect_stats`.
+
+    :param bool enabled:
+    """
+    global _collect_stats
+    _collect_stats = enabled
+
+
+def set_stats_callback(callback: Optional[Callable[["ImageSource", str, float], None]]):
+    """
+    Set a global hook that is called as :code:`callback(source, phase, seconds)` whenever a source with statistics
+    collection enabled finishes one of the phases "open", "schema", "decode" or "reorder".
+
+    :param callback:
+        Callable, or `None` to remove the current hook
+    """
+    global _stats_callback
+    _stats_callback = callback
+
+
+class _CountingFile:
+    """File wrapper that counts the bytes read through it."""
+
+    def __init__(self, file, stats: Dict[str, Any]):
+        self._file = file
+        self._stats = stats
+
+    def __getattr__(self, item):
+        return getattr(self._file, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def read(self, *args) -> bytes:
+        out = self._file.read(*args)
+        self._stats["bytes_read"] += len(out)
+        return out
+
+    def read1(self, *args) -> bytes:
+        out = self._file.read1(*args)
+        self._stats["bytes_read"] += len(out)
+        return out
+
+    def readline(self, *args) -> bytes:
+        out = self._file.readline(*args)
+        self._stats["bytes_read"] += len(out)
+        return out
+
+    def readinto(self, b) -> int:
+        n = self._file.readinto(b)
+        self._stats["bytes_read"] += n or 0
+        return n
+
 
 class ImageSource(DataSource):
 
-    def __init__(self, uri: str, *args, output_axis_order: Optional[str] = "itczyx", **kwargs):
+    def __init__(
+            self,
+            uri: str,
+            *args,
+            output_axis_order: Optional[str] = "itczyx",
+            collect_stats: Optional[bool] = None,
+            block_size: Optional[int] = None,
+            cache_type: Optional[str] = None,
+            filecache: Optional[str] = None,
+            **kwargs
+    ):
         super().__init__(*args, **kwargs)
         self.uri = uri
         self._output_axis_order = output_axis_order
         if self._output_axis_order is not None and len(set(self._output_axis_order)) != len(self._output_axis_order):
             raise ValueError(f"Duplicate axis in {self._output_axis_order}.")
+        if cache_type == "blockcache" and cache_type not in _fsspec_caches:
+            cache_type = "block"
+        if cache_type is not None and cache_type not in _fsspec_caches:
+            raise ValueError(f"Unknown cache type {cache_type}, supports {[i for i in _fsspec_caches if i]}.")
+        self._block_size = block_size
+        self._cache_type = cache_type
+        self._filecache = filecache
+        self._collect_stats = collect_stats
+        self.reset_stats()
+
+    @property
+    def _stats_enabled(self) -> bool:
+        return _collect_stats if self._collect_stats is None else self._collect_stats
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        I/O statistics collected since construction or the last call to :meth:`reset_stats`.
+
+        Wall time and call count per phase ("open", "schema", "decode" and "reorder", where "decode" excludes
+        "reorder"), bytes read through :meth:`open`, bytes of arrays returned by :meth:`to_xarray` and the number of
+        reused file handles ("cache_hits"). Only collected if enabled via `collect_stats` or
+        :func:`intake_io.source.enable_stats`.
+        """
+        return deepcopy(self._stats)
+
+    def reset_stats(self):
+        self._stats = {phase: {"count": 0, "seconds": 0.0} for phase in _STATS_PHASES}
+        self._stats.update(bytes_read=0, bytes_output=0, cache_hits=0)
+
+    @contextmanager
+    def _timed(self, phase: str, exclude: Tuple[str, ...] = ()):
+        # Time spent in phases nested in this one and listed in `exclude` isn't counted, so that phases are disjoint
+        if not self._stats_enabled:
+            yield
+            return
+        excluded = sum(self._stats[i]["seconds"] for i in exclude)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            seconds -= sum(self._stats[i]["seconds"] for i in exclude) - excluded
+            self._stats[phase]["count"] += 1
+            self._stats[phase]["seconds"] += seconds
+            if _stats_callback is not None:
+                _stats_callback(self, phase, seconds)
 
     def open(self):
         try:
-            return self.__file
+            file = self.__file
         except AttributeError:
-            self.__file = fsspec.open(self.uri).open()
+            with self._timed("open"):
+                self.__file = self._open_file()
+                if self._stats_enabled:
+                    self.__file = _CountingFile(self.__file, self._stats)
             return self.__file
+        if self._stats_enabled:
+            self._stats["cache_hits"] += 1
+        return file
+
+    def _open_file(self):
+        uri = self.uri
+        storage_options = dict(self.storage_options or {})
+        protocol, _ = split_protocol(uri)
+        if self._filecache is not None and protocol not in (None, "file"):
+            # Chain a local whole-file cache in front of the remote file system
+            storage_options = {protocol: storage_options, "filecache": {"cache_storage": self._filecache}}
+            uri = f"filecache::{uri}"
+        fs, path = url_to_fs(uri, **storage_options)
+
+        kwargs = {}
+        if self._block_size is not None:
+            kwargs["block_size"] = self._block_size
+        if self._cache_type is not None:
+            kwargs["cache_type"] = self._cache_type
+        return fs.open(path, "rb", **kwargs)
+
+    def _load_metadata(self):
+        if self._schema is None:
+            with self._timed("schema", exclude=("open",)):
+                super()._load_metadata()
 
     def to_xarray(self, partition: Optional[Any] = None):
         self._load_metadata()
@@ -39,11 +192,14 @@ class ImageSource(DataSource):
         spacing_units = self.metadata.get("spacing_units") or {}
         coords = self.metadata.get("coords") or {}
 
+        with self._timed("decode", exclude=("open", "schema", "reorder")):
+            data = self.read() if partition is None else self.read_partition(partition)
+        if self._stats_enabled:
+            self._stats["bytes_output"] += getattr(data, "nbytes", 0)
+
         if partition is not None:
             axes = axes[1:]
-            img = to_xarray(self.read_partition(partition), spacing, axes, coords, spacing_units)
-        else:
-            img = to_xarray(self.read(), spacing, axes, coords, spacing_units)
+        img = to_xarray(data, spacing, axes, coords, spacing_units)
 
         img.attrs["metadata"] = self.metadata
         try:
@@ -130,10 +286,28 @@ class ImageSource(DataSource):
         metadata = self.metadata.get("fileheader") or {}
         self.metadata["fileheader"] = {**header, **metadata}
 
+    @property
+    def supports_region_access(self) -> bool:
+        # Whether read_region reads only the requested region
+        return False
+
+    def read_region(self, region: Tuple[slice, ...], partition: Optional[Any] = None) -> np.ndarray:
+        """
+        Read a region of the image or of a partition, in output axis order. Reads the whole image or partition unless
+        the source supports region access.
+
+        Arguments:
+            region (tuple of slices): region, trailing axes may be omitted
+            partition (optional): partition to read the region from
+        """
+        data = self.read() if partition is None else self.read_partition(partition)
+        return data[tuple(region)]
+
     def _reorder_axes(self, array: np.ndarray, axes_source: Optional[str] = None) -> np.ndarray:
         if axes_source is None:
             axes_source = self.metadata["original_axes"][-array.ndim:]
-        return _reorder_axes(array, axes_source, self.metadata["axes"])
+        with self._timed("reorder"):
+            return _reorder_axes(array, axes_source, self.metadata["axes"])
 
     def _yaml(self, rename_to: Optional[str] = None) -> Dict[str, Any]:
         out = deepcopy(super()._yaml())
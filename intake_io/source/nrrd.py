@@ -11,7 +11,7 @@ class NrrdSource(ImageSource):
     """Intake source for NRRD files.
 
     Attributes:
-        uri (str): URI (file system path)
+        uri (str): URI (e.g. file system path or URL)
     """
 
     container = "ndarray"
@@ -22,13 +22,16 @@ class NrrdSource(ImageSource):
     def __init__(self, uri: str, **kwargs):
         """
         Arguments:
-            uri (str): URI (file system path)
+            uri (str): URI (e.g. file system path or URL)
             metadata (dict, optional): Extra metadata, handed over to intake
         """
         super().__init__(uri, **kwargs)
 
     def _get_schema(self) -> Schema:
-        self._header = nrrd.read_header(self.open(), {"channels": "quoted string list"})
+        file = self.open()
+        file.seek(0)
+        self._header = nrrd.read_header(file, {"channels": "quoted string list"})
+        self._data_offset = file.tell()
 
         shape = tuple(self._header["sizes"])[::-1]
         try:
@@ -103,8 +106,9 @@ class NrrdSource(ImageSource):
         )
 
     def _get_partition(self, i: int) -> np.ndarray:
-        # return self._reorder_axes(nrrd.read_data(self._header, reader, index_order="C"))
-        return self._reorder_axes(nrrd.read(self.uri, index_order="C")[0])
+        file = self.open()
+        file.seek(self._data_offset)
+        return self._reorder_axes(nrrd.read_data(self._header, file, self.uri, index_order="C"))
 
 
 def save_nrrd(
@@ -0,0 +1,169 @@
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Union
+
+import imageio
+import numpy as np
+import tifffile
+
+from .base import ImageSource, Schema
+from ..fsspec.render import render_box_url, render_session
+
+
+class RenderSource(ImageSource):
+    """Intake source for a bounding box of a render stack (https://github.com/saalfeldlab/render).
+
+    The bounding box is split into tiles that are fetched concurrently over a pooled keep-alive session and assembled
+    into a single zyx array.
+
+    Attributes:
+        uri (str): URI of the stack, e.g. render://host/owner/project/stack
+    """
+
+    container = "ndarray"
+    name = "render"
+    version = "0.0.1"
+    partition_access = True
+
+    def __init__(
+            self,
+            uri: str,
+            z: Union[int, Tuple[int, int]],
+            x: int,
+            y: int,
+            width: int,
+            height: int,
+            scale: float = 1.0,
+            channel: Optional[str] = None,
+            tile_size: int = 2048,
+            image_format: str = "tiff",
+            tile_cache: Optional[str] = None,
+            num_workers: int = 8,
+            **kwargs
+    ):
+        """
+        Arguments:
+            uri (str): URI of the stack, e.g. render://host/owner/project/stack, host may include a port
+            z (int or tuple): z section, or range of z sections [first, last)
+            x, y, width, height (int): bounding box in full resolution world coordinates
+            scale (float, default=1.0): scale of the output relative to full resolution
+            channel (str, optional): channel to render
+            tile_size (int, default=2048): maximum tile width and height requested from the server, at output scale
+            image_format (str, default='tiff'): tile format requested from the server, 'tiff', 'png' or 'jpeg'
+            tile_cache (str, optional): directory to cache fetched tiles in
+            num_workers (int, default=8): number of tiles fetched concurrently
+            metadata (dict, optional): Extra metadata, handed over to intake
+        """
+        super().__init__(uri, **kwargs)
+        self.host, self.owner, self.project, self.stack = self._strip_protocol(uri).split("/")
+        self.z = (z, z + 1) if isinstance(z, int) else tuple(z)
+        self.box = (x, y, width, height)
+        self.scale = scale
+        self.channel = channel
+        self.tile_size = tile_size
+        self.image_format = image_format
+        self.tile_cache = tile_cache
+        self.num_workers = num_workers
+        self._session = None
+        self._schema_tile = None
+
+    @staticmethod
+    def _strip_protocol(uri: str) -> str:
+        return uri.split("://", 1)[-1].strip("/")
+
+    def _get_schema(self) -> Schema:
+        x, y, width, height = self.box
+        shape = (self.z[1] - self.z[0], int(round(height * self.scale)), int(round(width * self.scale)))
+        spacing = {ax: 1.0 / self.scale for ax in "yx"}
+        shape = self._set_shape_metadata("zyx", shape, spacing, {})
+        self._set_fileheader({"host": self.host, "owner": self.owner, "project": self.project, "stack": self.stack,
+                              "box": self.box, "scale": self.scale, "channel": self.channel})
+        # Tiles don't report their pixel type ahead of time, fetch the first one and keep it for reading.
+        key = (self.z[0], *self._tiles()[0][:4])
+        self._schema_tile = (key, self._fetch_tile(*key))
+        dtype = self._schema_tile[1].dtype
+        return Schema(
+            dtype=dtype,
+            shape=shape,
+            npartitions=shape[0],
+            chunks=None
+        )
+
+    def _tiles(self) -> list:
+        # Tiles as (x, y, width, height) in world coordinates and (row, column) offsets in the output
+        x, y, width, height = self.box
+        step = max(int(round(self.tile_size / self.scale)), 1)
+        out = []
+        for ty in range(y, y + height, step):
+            for tx in range(x, x + width, step):
+                out.append((tx, ty, min(step, x + width - tx), min(step, y + height - ty),
+                            int(round((ty - y) * self.scale)), int(round((tx - x) * self.scale))))
+        return out
+
+    def _fetch_tile(self, z: int, x: int, y: int, width: int, height: int) -> np.ndarray:
+        if self._schema_tile is not None and self._schema_tile[0] == (z, x, y, width, height):
+            tile = self._schema_tile[1]
+            self._schema_tile = None
+            return tile
+        url = render_box_url(self.host, self.owner, self.project, self.stack, z, x, y, width, height, self.scale,
+                             self.image_format, self.channel)
+        fpath = None
+        if self.tile_cache is not None:
+            ext = {"tiff": ".tif", "png": ".png", "jpeg": ".jpg"}.get(self.image_format, "")
+            fpath = os.path.join(self.tile_cache, hashlib.sha1(url.encode()).hexdigest() + ext)
+            if os.path.exists(fpath):
+                with open(fpath, "rb") as f:
+                    return self._decode_tile(f.read())
+
+        rq = self._get_session().get(url)
+        rq.raise_for_status()
+        data = rq.content
+
+        if fpath is not None:
+            os.makedirs(self.tile_cache, exist_ok=True)
+            tmp = f"{fpath}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, fpath)
+        return self._decode_tile(data)
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = render_session(self.num_workers)
+        return self._session
+
+    def _decode_tile(self, data: bytes) -> np.ndarray:
+        if self.image_format == "tiff":
+            return tifffile.imread(io.BytesIO(data))
+        return np.asarray(imageio.v2.imread(data))
+
+    def _read_sections(self, zs: range) -> np.ndarray:
+        self._load_metadata()
+        out = np.zeros((len(zs), *self.metadata["original_shape"][1:]), self.dtype)
+        self._get_session()
+
+        def _task(args):
+            i, (x, y, width, height, row, col) = args
+            tile = self._fetch_tile(zs[i], x, y, width, height)
+            if tile.ndim > 2:
+                tile = tile[..., 0]
+            tile = tile[:out.shape[1] - row, :out.shape[2] - col]
+            out[i, row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+
+        tasks = [(i, tile) for i in range(len(zs)) for tile in self._tiles()]
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            list(executor.map(_task, tasks))
+        return out
+
+    def _get_partition(self, i: int) -> np.ndarray:
+        return self._reorder_axes(self._read_sections(range(self.z[0] + i, self.z[0] + i + 1))[0])
+
+    def read(self) -> np.ndarray:
+        return self._reorder_axes(self._read_sections(range(*self.z)))
+
+    def _close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
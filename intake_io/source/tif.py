@@ -1,7 +1,8 @@
-from typing import Any, Optional
+from typing import Any, Optional, Tuple
 
 import numpy as np
 import tifffile
+import zarr
 
 from .base import ImageSource, Schema
 from .bioformats import _parse_ome_metadata
@@ -28,6 +29,7 @@ class TifSource(ImageSource):
         """
         super().__init__(uri, **kwargs)
         self._file = None
+        self._zarr = None
 
     def _get_schema(self) -> Schema:
         if self._file is None:
@@ -152,7 +154,28 @@ class TifSource(ImageSource):
     def _get_partition(self, i: int) -> np.ndarray:
         return self._reorder_axes(self._file.series[0][0].asarray())
 
+    @property
+    def supports_region_access(self) -> bool:
+        # Regions are read through tifffile's zarr interface, which requires axes in the file to match the metadata.
+        self._load_metadata()
+        series = self._file.series[0]
+        axes = series.axes.lower().replace("q", "c").replace("s", "c")
+        return (axes == self.metadata["original_axes"] and set(axes) == set(self.metadata["axes"])
+                and tuple(series.shape) == tuple(self.metadata["original_shape"]))
+
+    def read_region(self, region: Tuple[slice, ...], partition: Optional[Any] = None) -> np.ndarray:
+        if partition is not None or not self.supports_region_access:
+            return super().read_region(region, partition)
+        if self._zarr is None:
+            self._zarr = zarr.open(self._file.series[0].aszarr(), mode="r")
+        axes = self.metadata["axes"]
+        region = dict(zip(axes, (*region, *[slice(None)] * (len(axes) - len(region)))))
+        return self._reorder_axes(self._zarr[tuple(region[ax] for ax in self.metadata["original_axes"])])
+
     def _close(self):
+        if self._zarr is not None:
+            self._zarr.store.close()
+            self._zarr = None
         if self._file is not None:
             self._file.close()
 
@@ -53,7 +53,8 @@ setup(
             "klb = intake_io.source.KlbSource",
             "list = intake_io.source.ListSource",
             "nifti = intake_io.source.NiftiSource",
-            "nrrd = intake_io.source.NrrdSource"
+            "nrrd = intake_io.source.NrrdSource",
+            "render = intake_io.source.RenderSource"
         ]
     }
 )
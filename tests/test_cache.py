@@ -0,0 +1,257 @@
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("lmdb")
+from intake_io.dataset import CachedDataset
+
+
+class _Data:
+
+    def __init__(self, n, shape=(64, 64)):
+        self.n = n
+        self.shape = shape
+        self.num_loads = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        self.num_loads += 1
+        return {"sample_index": i, "image": np.full(self.shape, i, np.float32)}
+
+
+def test_cached_dataset(tmp_path):
+    data = _Data(8)
+    cache = CachedDataset(data, str(tmp_path))
+    for _ in range(3):
+        for i in range(len(cache)):
+            assert np.all(cache[i]["image"] == i)
+    assert data.num_loads == len(data)
+    stats = cache.stats()
+    assert stats["misses"] == 8
+    assert stats["hits"] == 16
+    assert stats["evictions"] == 0
+    assert stats["num_entries"] == 8
+    cache.close()
+
+
+def test_map_growth(tmp_path):
+    data = _Data(16, (256, 256))
+    cache = CachedDataset(data, str(tmp_path), map_size_gb=1 / 1024, flush_every_n=4)
+    for i in range(len(cache)):
+        cache[i]
+    cache.flush()
+    assert cache._cache.info()["map_size"] > 1024**2
+    assert all(np.all(cache[i]["image"] == i) for i in range(len(cache)))
+    assert data.num_loads == len(data)
+    cache.close()
+
+
+def test_zero_copy_reads(tmp_path):
+    data = _Data(16, (256, 256))
+    cache = CachedDataset(data, str(tmp_path), map_size_gb=1 / 1024, flush_every_n=4)
+    cache[0]
+    cache.flush()
+    x = cache[0]["image"]
+    assert not x.flags.writeable
+    # The map has to grow, which is deferred while x views it
+    for i in range(1, len(cache)):
+        cache[i]
+    assert cache._cache.info()["map_size"] == 1024**2
+    assert np.all(x == 0)
+    del x
+    cache.flush()
+    assert cache._cache.info()["map_size"] > 1024**2
+    assert all(np.all(cache[i]["image"] == i) for i in range(len(cache)))
+    assert data.num_loads == len(data)
+    cache.close()
+
+
+@pytest.mark.parametrize("eviction", ["lru", "lfu"])
+def test_eviction(tmp_path, eviction):
+    data = _Data(32, (128, 128))
+    nbytes = 128 * 128 * 4
+    cache = CachedDataset(data, str(tmp_path), max_size_gb=10.5 * nbytes / 1024**3, eviction=eviction)
+
+    # Make sample 0 hot
+    for _ in range(5):
+        cache[0]
+    for i in range(1, len(cache)):
+        cache[i]
+        cache[0]
+
+    stats = cache.stats()
+    assert stats["evictions"] > 0
+    assert stats["size_bytes"] <= 10.5 * nbytes
+    assert stats["num_entries"] <= 10
+    num_loads = data.num_loads
+    cache[0]
+    cache[len(cache) - 1]
+    assert data.num_loads == num_loads
+    cache[1]
+    assert data.num_loads == num_loads + 1
+    cache.close()
+
+
+def _normalize(x):
+    return dict(x, image=x["image"] / 2)
+
+
+def _scale_all(x, factors=(1, 2)):
+    return dict(x, images=[x["image"] * f for f in factors])
+
+
+_double = lambda x: dict(x, image=x["image"] * 2)  # noqa: E731
+
+
+def _fingerprints():
+    from intake_io.dataset import Transform
+
+    def _closure(x):
+        return _scale_all(x, factors)
+
+    factors = (3, {"a": [4]})
+    return [Transform(fn).fingerprint for fn in (_normalize, _scale_all, _double, _closure)]
+
+
+def test_transform_fingerprint():
+    from intake_io.dataset import Transform
+
+    # Stable across processes, incl. lambdas and functions with comprehensions or closures
+    out = subprocess.run([sys.executable, "-c", "from tests.test_cache import _fingerprints; print(_fingerprints())"],
+                         capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+    fingerprints = _fingerprints()
+    assert out.stdout.strip() == str(fingerprints)
+    assert len(set(fingerprints)) == len(fingerprints)
+
+    lock = threading.Lock()
+    with pytest.raises(ValueError):
+        Transform(lambda x: lock and x).fingerprint
+    assert Transform(lambda x: lock and x, fingerprint="v1").fingerprint == "v1"
+
+
+def test_transform_stages(tmp_path):
+    from intake_io.dataset import deterministic, stochastic
+
+    calls = []
+
+    def augment(x):
+        calls.append(x["sample_index"])
+        return dict(x, image=x["image"] + np.random.rand(*x["image"].shape).astype(np.float32))
+
+    data = _Data(4)
+    cache = CachedDataset(data, str(tmp_path), transform=[deterministic(_normalize), stochastic(augment)])
+    for _ in range(2):
+        for i in range(len(cache)):
+            y = cache[i]
+            assert np.all((y["image"] >= i / 2) & (y["image"] <= i / 2 + 1))
+    assert data.num_loads == 4
+    assert len(calls) == 8
+    cache.close()
+
+    # Different preprocessing invalidates cached entries, same preprocessing reuses them
+    cache = CachedDataset(data, str(tmp_path), transform=[deterministic(lambda x: dict(x, image=x["image"] * 2))])
+    assert np.all(cache[1]["image"] == 2)
+    assert data.num_loads == 5
+    cache.close()
+    cache = CachedDataset(data, str(tmp_path), transform=deterministic(_normalize))
+    assert np.all(cache[1]["image"] == 0.5)
+    assert data.num_loads == 5
+    cache.close()
+
+
+def _load_all(cache, indices):
+    for i in indices:
+        cache[i]
+    cache.flush()
+
+
+def test_write_behind(tmp_path):
+    import multiprocessing
+
+    data = _Data(16)
+    cache = CachedDataset(data, str(tmp_path), write_behind=True, write_behind_interval=0.1)
+    # Like DataLoader workers, each process gets a pickled copy
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_load_all, args=(cache, range(i, len(data), 4))) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    cache.close()
+
+    cache = CachedDataset(data, str(tmp_path))
+    assert all(np.all(cache[i]["image"] == i) for i in range(len(cache)))
+    assert data.num_loads == 0
+    assert cache.stats()["num_entries"] == 16
+    cache.close()
+
+
+def test_shared_memory_cache():
+    from intake_io.dataset import SharedMemoryCache
+    from intake_io.dataset.serialization import deserialize, serialize
+
+    nbytes = 64 * 64 * 4
+    ram = SharedMemoryCache(4.5 * nbytes / 1024**3, max_entries=8)
+    for i in range(4):
+        assert ram.put(str(i).encode(), serialize(np.full((64, 64), i, np.float32)))
+    x = deserialize(ram.get(b"0"))
+    assert np.all(x == 0)
+    assert not x.flags.writeable
+    assert ram.stats()["num_entries"] == 4
+
+    # Entry 0 is pinned by x, the ring skips it and evicts entry 1 instead
+    assert ram.put(b"4", serialize(np.full((64, 64), 4, np.float32)))
+    assert ram.get(b"1") is None
+    assert np.all(x == 0)
+    del x
+    assert ram.put(b"5", serialize(np.full((64, 64), 5, np.float32)))
+    assert ram.get(b"2") is None
+    assert np.all(deserialize(ram.get(b"5")) == 5)
+    assert ram.stats()["evictions"] == 2
+    ram.close()
+
+
+def test_shared_memory_cache_table():
+    from intake_io.dataset import SharedMemoryCache
+
+    # Few hash table positions, so that probe sequences collide, wrap around and are shifted on eviction
+    ram = SharedMemoryCache(64 * 16 / 1024**3, max_entries=16)
+    for i in range(200):
+        assert ram.put(str(i).encode(), np.full(64, i % 256, np.uint8))
+        present = [j for j in range(i + 1) if str(j).encode() in ram]
+        assert present == list(range(i + 1 - len(present), i + 1))
+        assert np.all(ram.get(str(i).encode()) == i % 256)
+        assert ram.stats()["num_entries"] == len(present) == np.count_nonzero(ram._table)
+    ram.close()
+
+
+def _read_all(cache, indices, q):
+    q.put([float(cache[i]["image"][0, 0]) for i in indices])
+    q.put(cache.stats()["ram"]["hits"])
+
+
+def test_ram_tier(tmp_path):
+    import multiprocessing
+
+    data = _Data(8)
+    cache = CachedDataset(data, str(tmp_path), ram_cache_gb=1 / 1024)
+    for i in range(len(cache)):
+        cache[i]
+    assert cache.stats()["ram"]["num_entries"] == 8
+
+    ctx = multiprocessing.get_context("spawn")
+    q = ctx.Queue()
+    worker = ctx.Process(target=_read_all, args=(cache, range(len(data)), q))
+    worker.start()
+    assert q.get() == list(range(8))
+    assert q.get() == 8
+    worker.join()
+    assert data.num_loads == 8
+    cache.close()
@@ -0,0 +1,416 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+import intake_io
+from intake_io.dataset import AnnotatedDataset, CategorizedDataset, IntakeDataset, MappedDataset, PaddedCollate, \
+    PatchDataset, ShapeBatchSampler, StreamingDataset, SubsetDataset, category_subset
+from intake_io.dataset.statistics import _ChannelStatistics, _sample_statistics
+from intake_io.dataset.util import CategoryIndex
+
+
+def _write_catalog(path, shapes=((4, 16, 24), (6, 16, 16), (4, 8, 8)), stack=3):
+    # One item per shape, plus one item with axis "i" made of `stack` images
+    sources = {}
+    uris = []
+    for i, shape in enumerate(shapes):
+        uri = os.path.join(path, f"image{i}.tif")
+        image = intake_io.to_xarray(np.full(shape, i, np.uint16), spacing=(2.0, 0.5, 0.5), axes="zyx")
+        intake_io.imsave(image, uri)
+        uris.append(uri)
+        sources[f"image{i}"] = {"driver": "intake_io.source.TifSource", "args": {"uri": uri}}
+    sources["stack"] = {"driver": "intake_io.source.ListSource", "args": {"items": uris[:1] * stack, "axis": "i"}}
+    fpath = os.path.join(path, "catalog.yaml")
+    with open(fpath, "w") as f:
+        yaml.safe_dump({"sources": sources}, f)
+    return fpath
+
+
+def test_sample_index(tmp_path):
+    catalog = _write_catalog(str(tmp_path))
+    data = IntakeDataset(catalog)
+    assert len(data) == 6
+    assert [data._get_item_partition_ixs(i) for i in range(6)] == [(0, None), (1, None), (2, None), (3, 0), (3, 1),
+                                                                     (3, 2)]
+    assert data.get_shape(1) == (6, 16, 16)
+    assert data.get_shape(4) == (4, 16, 24)
+    assert data.get_dtype(0) == np.uint16
+    assert data.get_spacing(0) == {"z": 2.0, "y": 0.5, "x": 0.5}
+    with pytest.raises(IndexError):
+        data.get_shape(6)
+
+
+def test_sample_index_persistence(tmp_path):
+    catalog = _write_catalog(str(tmp_path))
+    index_path = str(tmp_path / "catalog.index.npy")
+    data = IntakeDataset(catalog, index_path=index_path)
+    assert os.path.exists(index_path)
+
+    # Loaded from disk without discovering items
+    loaded = IntakeDataset(catalog, index_path=index_path)
+    assert not any(item._schema is not None for item in loaded._items)
+    assert len(loaded) == len(data)
+    assert all(loaded.get_shape(i) == data.get_shape(i) for i in range(len(data)))
+    assert np.all(loaded[2]["data"]["image"].values == 2)
+
+
+def _add_sources(catalog, sources):
+    with open(catalog) as f:
+        content = yaml.safe_load(f)
+    content["sources"].update(sources)
+    with open(catalog, "w") as f:
+        yaml.safe_dump(content, f)
+
+
+def test_discovery_errors(tmp_path):
+    catalog = _write_catalog(str(tmp_path))
+    _add_sources(catalog, {"broken": {"driver": "intake_io.source.TifSource",
+                                      "args": {"uri": str(tmp_path / "missing.tif")}}})
+    with pytest.raises(Exception):
+        IntakeDataset(catalog)
+    with pytest.warns(UserWarning, match="broken"):
+        data = IntakeDataset(catalog, errors="skip", num_workers=2)
+    assert len(data) == 6
+    with pytest.raises(ValueError):
+        IntakeDataset(catalog, errors="ignore")
+
+
+class _SlowTifSource(intake_io.source.TifSource):
+    name = "slow_tif"
+
+    def _get_schema(self):
+        if "slow" in self.uri:
+            time.sleep(3)
+        return super()._get_schema()
+
+
+def test_discovery_timeout(tmp_path):
+    catalog = _write_catalog(str(tmp_path), shapes=((4, 8, 8),) * 4, stack=1)
+    image = intake_io.to_xarray(np.zeros((2, 8, 8), np.uint16), axes="zyx")
+    sources = {}
+    for i in range(2):
+        intake_io.imsave(image, str(tmp_path / f"slow{i}.tif"))
+        sources[f"a_slow{i}"] = {"driver": f"{__name__}._SlowTifSource", "args": {"uri": str(tmp_path / f"slow{i}.tif")}}
+    _add_sources(catalog, sources)
+    start = time.monotonic()
+    with pytest.warns(UserWarning, match="slow"):
+        data = IntakeDataset(catalog, errors="skip", num_workers=2, timeout=0.5)
+    assert time.monotonic() - start < 2.5
+    assert sorted(data._index.names) == ["image0", "image1", "image2", "image3", "stack"]
+
+
+def test_manifest_update(tmp_path):
+    catalog = _write_catalog(str(tmp_path), shapes=((4, 16, 24), (6, 16, 16)))
+    index_path = str(tmp_path / "catalog.index.npy")
+    IntakeDataset(catalog, index_path=index_path)
+
+    image = intake_io.to_xarray(np.zeros((2, 8, 8), np.uint16), axes="zyx")
+    intake_io.imsave(image, str(tmp_path / "new.tif"))
+    _add_sources(catalog, {"new": {"driver": "intake_io.source.TifSource", "args": {"uri": str(tmp_path / "new.tif")}}})
+    data = IntakeDataset(catalog, index_path=index_path)
+    # Only the new item is discovered
+    discovered = {name: item._schema is not None for name, item in zip(data._index.names, data._items)}
+    assert discovered == {"image0": False, "image1": False, "stack": False, "new": True}
+    assert sorted(data.get_shape(i) for i in range(len(data)))[0] == (2, 8, 8)
+    assert len(IntakeDataset(catalog, index_path=index_path)) == len(data)
+
+
+def test_median_shape_spacing(tmp_path):
+    catalog = _write_catalog(str(tmp_path), shapes=((4, 16, 24), (6, 16, 16), (4, 8, 8)), stack=3)
+    data = IntakeDataset(catalog)
+    shapes = np.asarray([data.get_shape(i) for i in range(len(data))])
+    assert data.median_shape == tuple(map(int, np.round(np.median(shapes, axis=0))))
+    assert data.median_shape == (4, 16, 24)
+    assert data.median_spacing == (2.0, 0.5, 0.5)
+
+
+def test_compute_statistics(tmp_path):
+    catalog = _write_catalog(str(tmp_path), shapes=((4, 16, 24), (6, 16, 16), (4, 8, 8)), stack=1)
+    data = IntakeDataset(catalog)
+    values = np.concatenate([data[i]["data"]["image"].values.ravel() for i in range(len(data))]).astype(np.float64)
+    cache_path = str(tmp_path / "statistics.json")
+    stats = data.compute_statistics(cache_path, num_workers=2, bins=4, num_values=100000)
+    assert len(stats["channels"]) == 1
+    channel = stats["channels"][0]
+    assert channel["count"] == values.size
+    assert np.isclose(channel["mean"], values.mean())
+    assert np.isclose(channel["std"], values.std())
+    assert channel["min"] == 0 and channel["max"] == 2
+    assert np.isclose(channel["foreground_fraction"], np.mean(values != 0))
+    assert abs(channel["quantiles"]["0.5"] - np.median(values)) <= 1
+    assert sum(channel["histogram"]["counts"]) == values.size
+
+    # Cached
+    assert os.path.exists(cache_path)
+    data._load_index = None
+    assert data.compute_statistics(cache_path, num_workers=2, bins=4, num_values=100000) == stats
+
+    # Transforms and foreground callables are part of the cache key
+    data = IntakeDataset(catalog)
+    data.transform = lambda x: dict(x, data=x["data"] * 2)
+    assert data.compute_statistics(cache_path, num_workers=2, bins=4)["channels"][0]["max"] == 4
+    fractions = [data.compute_statistics(cache_path, num_workers=2, bins=4, foreground=foreground)["channels"][0][
+        "foreground_fraction"] for foreground in (lambda x: x["data"]["image"].values > 1,
+                                                  lambda x: x["data"]["image"].values > 3)]
+    assert np.isclose(fractions[0], np.mean(values >= 1)) and np.isclose(fractions[1], np.mean(values >= 2))
+
+
+def test_statistics_bounded():
+    rng = np.random.default_rng(0)
+    channel = _ChannelStatistics(bins=16, num_values=100)
+    values = []
+    for i in range(50):
+        sample = rng.normal(i / 10, 1, 1000)
+        values.append(sample)
+        channel.add(_sample_statistics(sample, sample > 0, 16, 100, rng))
+        assert channel.num_held <= 200
+    values = np.concatenate(values)
+    stats = channel.result((0.1, 0.5, 0.9))
+    assert stats["count"] == values.size and np.isclose(stats["mean"], values.mean())
+    assert stats["min"] == values.min() and stats["max"] == values.max()
+    assert sum(stats["histogram"]["counts"]) == values.size
+    for q in (0.1, 0.5, 0.9):
+        assert abs(stats["quantiles"][f"{q:g}"] - np.quantile(values, q)) < 0.2
+
+
+def test_tif_read_region(tmp_path):
+    fpath = str(tmp_path / "image.tif")
+    image = np.arange(4 * 16 * 24, dtype=np.uint16).reshape(4, 16, 24)
+    intake_io.imsave(intake_io.to_xarray(image, axes="zyx"), fpath)
+    with intake_io.source.TifSource(fpath) as src:
+        assert src.supports_region_access
+        region = (slice(1, 3), slice(4, 12), slice(20, 30))
+        assert np.array_equal(src.read_region(region), image[region])
+        assert np.array_equal(src.read_region(region[:1]), image[region[:1]])
+
+
+def test_patch_dataset(tmp_path):
+    catalog = _write_catalog(str(tmp_path))
+    data = IntakeDataset(catalog)
+
+    patches = PatchDataset(data, (8, 8), patches_per_sample=2, seed=0)
+    assert len(patches) == 12
+    patch = patches[5]
+    assert patch["source_index"] == 2
+    assert patch["data"].shape == (4, 8, 8)
+    assert np.all(patch["data"] == 2)
+    # Zero-padded beyond the sample
+    patch = PatchDataset(data, (12, 12), seed=0)[2]
+    assert patch["region"] == ((0, 12), (0, 12))
+    assert np.all(patch["data"][:, :8, :8] == 2)
+    assert np.all(patch["data"][:, 8:] == 0) and np.all(patch["data"][:, :, 8:] == 0)
+    # Read from a partition of the stack
+    assert np.all(PatchDataset(data, (8, 8), seed=0)[4]["data"] == 0)
+
+    windows = PatchDataset(data, (8, 8), sampling="sliding_window", overlap=0.5)
+    # (3 * 5) + (3 * 3) + 1 + 3 * (3 * 5) windows
+    assert len(windows) == 70
+    regions = [windows[i]["region"] for i in range(15)]
+    assert regions[0] == ((0, 8), (0, 8))
+    assert regions[-1] == ((8, 16), (16, 24))
+
+    # Patches depend on seed, epoch and index, not on the order of access
+    patches = PatchDataset(data, (4, 4), patches_per_sample=4, seed=0)
+    regions = [patches[i]["region"] for i in range(len(patches))]
+    assert [patches[i]["region"] for i in reversed(range(len(patches)))] == regions[::-1]
+    assert [PatchDataset(data, (4, 4), patches_per_sample=4, seed=0)[i]["region"] for i in range(8)] == regions[:8]
+    patches.set_epoch(1)
+    assert [patches[i]["region"] for i in range(len(patches))] != regions
+
+    with pytest.raises(ValueError):
+        PatchDataset(data, (8, 8), sampling="foreground")
+
+
+def test_patch_dataset_foreground(tmp_path):
+    image_dir = tmp_path / "images"
+    label_dir = tmp_path / "labels"
+    image_dir.mkdir()
+    label_dir.mkdir()
+    data = IntakeDataset(_write_catalog(str(image_dir), shapes=((4, 32, 32),), stack=2))
+    sources = {}
+    for i, name in enumerate(("image0", "stack")):
+        labels = np.zeros((4, 32, 32), np.uint16)
+        labels[:, 28:, 28:] = 1
+        uri = str(label_dir / f"labels{i}.tif")
+        intake_io.imsave(intake_io.to_xarray(labels, axes="zyx"), uri)
+        sources[name] = {"driver": "intake_io.source.TifSource", "args": {"uri": uri}}
+    sources["stack"] = {"driver": "intake_io.source.ListSource",
+                        "args": {"items": [sources["stack"]["args"]["uri"]] * 2, "axis": "i"}}
+    with open(label_dir / "catalog.yaml", "w") as f:
+        yaml.safe_dump({"sources": sources}, f)
+    labels = IntakeDataset(str(label_dir / "catalog.yaml"))
+
+    cache = str(tmp_path / "foreground")
+    patches = PatchDataset(data, (8, 8), sampling="foreground", labels=labels, patches_per_sample=20,
+                           foreground_probability=1.0, foreground_cache=cache, seed=0)
+    for i in range(len(patches)):
+        patch = patches[i]
+        assert patch["labels"].shape == (4, 8, 8)
+        assert np.any(patch["labels"] > 0)
+    assert len(os.listdir(cache)) == 3
+
+
+def test_shape_batch_sampler(tmp_path):
+    catalog = _write_catalog(str(tmp_path), shapes=((4, 16, 24), (4, 8, 8), (4, 16, 24), (4, 8, 8), (4, 8, 8)))
+    data = IntakeDataset(catalog)
+    sampler = ShapeBatchSampler(data, 2, seed=0)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 4
+    assert sorted(i for batch in batches for i in batch) == list(range(len(data)))
+    # Only the batch straddling the two shapes mixes them
+    assert sum(len({data.get_shape(i) for i in batch}) > 1 for batch in batches) <= 1
+    sampler.set_epoch(1)
+    assert len(list(sampler)) == 4
+    assert len(ShapeBatchSampler(data, 2, drop_last=True)) == 4
+    assert list(ShapeBatchSampler(data, 2, shuffle=False))[0] == [1, 3]
+
+
+def test_padded_collate():
+    collate = PaddedCollate(num_buffers=2)
+    samples = [{"data": np.ones((2, 3), np.uint16), "name": "a"}, {"data": np.full((3, 2), 2, np.uint16), "name": "b"}]
+    batch = collate(samples)
+    assert batch["data"].shape == (2, 3, 3)
+    assert batch["data"].dtype == np.uint16
+    assert np.array_equal(batch["data"][0], [[1, 1, 1], [1, 1, 1], [0, 0, 0]])
+    assert np.array_equal(batch["data"][1], [[2, 2, 0], [2, 2, 0], [2, 2, 0]])
+    assert batch["data_shape"].tolist() == [[2, 3], [3, 2]]
+    assert batch["name"] == ["a", "b"]
+
+    # Buffers are used in turn and reused once large enough
+    second = collate(samples[::-1])
+    assert not np.shares_memory(batch["data"], second["data"])
+    third = collate(samples[:1])
+    assert np.shares_memory(batch["data"], third["data"])
+    assert np.array_equal(third["data"][0], samples[0]["data"])
+
+
+def _get_category(metadata):
+    return metadata["metadata"]["category"]
+
+
+def _get_annotations(metadata):
+    return pd.DataFrame({"category": metadata["metadata"]["annotations"]})
+
+
+def test_category_index(tmp_path):
+    catalog = _write_catalog(str(tmp_path))
+    with open(catalog) as f:
+        sources = yaml.safe_load(f)["sources"]
+    annotations = {"image0": ["a", "b", "b"], "image1": ["b"], "image2": [], "stack": ["c", "a"]}
+    for name, source in sources.items():
+        source["metadata"] = {"category": "a" if name == "image1" else "b", "annotations": annotations[name]}
+    with open(catalog, "w") as f:
+        yaml.safe_dump({"sources": sources}, f)
+
+    path = str(tmp_path / "categories.npz")
+    data = CategorizedDataset(catalog, _get_category, category_index_path=path)
+    assert data.all_categories.to_dict("list") == dict(category_index=[0, 1], category_name=["a", "b"],
+                                                       category_num_samples=[1, 5])
+    assert os.path.exists(path)
+    loaded = CategorizedDataset(catalog, _get_category, category_index_path=path)
+    assert loaded.category_index.samples.tolist() == data.category_index.samples.tolist()
+    # A different callback doesn't reuse the cached index, even with the same name
+    other = CategorizedDataset(catalog, lambda m: m["metadata"]["category"].upper(), category_index_path=path)
+    assert other.all_categories["category_name"].tolist() == ["A", "B"]
+    other = CategorizedDataset(catalog, lambda m: m["metadata"]["category"] * 2, category_index_path=path)
+    assert other.all_categories["category_name"].tolist() == ["aa", "bb"]
+    assert category_subset(data, ["a"])._ixs == (1,)
+    subset = SubsetDataset(SubsetDataset(data, (0, 1, 3, 4)), (1, 2))
+    assert subset.subset_categories.to_dict("list") == dict(category_index=[0, 1], category_name=["a", "b"],
+                                                            category_num_samples=[1, 1])
+
+    data = AnnotatedDataset(catalog, _get_annotations)
+    assert data.all_categories.to_dict("list") == dict(category_index=[0, 1, 2], category_name=["a", "b", "c"],
+                                                       category_num_samples=[4, 2, 3],
+                                                       category_num_instances=[4, 3, 3])
+    assert category_subset(data, ["c"])._ixs == (3, 4, 5)
+    assert data.category_index.dominant_categories().tolist() == [1, 1, -1, 0, 0, 0]
+    assert SubsetDataset(data, (0, 2)).subset_categories.to_dict("list") == dict(
+        category_index=[0, 1], category_name=["a", "b"], category_num_samples=[1, 1], category_num_instances=[1, 2])
+
+
+def test_category_index_types(tmp_path):
+    path = str(tmp_path / "categories.npz")
+    index = CategoryIndex(4, np.arange(4), np.array([1, 2, 1, 0]), [1, 2, 10], False)
+    index.save(path, "key")
+    loaded = CategoryIndex.load(path, "key")
+    assert loaded.names == [1, 2, 10] and all(type(i) is int for i in loaded.names)
+    assert loaded.sample_ixs([10]).tolist() == [1]
+    assert CategoryIndex.load(path, "other") is None
+    with pytest.raises(ValueError):
+        CategoryIndex(2, np.arange(2), np.arange(2), [1, "a"], False).save(path)
+
+
+def _square(x):
+    return x ** 2
+
+
+def _square_all(xs):
+    return list(np.square(xs))
+
+
+def test_mapped_iter_batches():
+    threads = set()
+
+    def _mapper(x):
+        threads.add(threading.get_ident())
+        time.sleep(0.01 * (x % 3))
+        return x ** 2
+
+    data = MappedDataset(list(range(23)), _mapper)
+    batches = list(data.iter_batches(4, num_workers=4))
+    assert [len(i) for i in batches] == [4, 4, 4, 4, 4, 3]
+    assert [i for batch in batches for i in batch] == [i ** 2 for i in range(23)]
+    assert len(threads) > 1
+    assert list(data.iter_batches(2, ixs=[5, 1, 3])) == [[25, 1], [9]]
+
+    calls = []
+    batches = MappedDataset(list(range(10)), calls.append).iter_batches(1, num_workers=4, max_in_flight=2)
+    next(batches)
+    assert len(calls) <= 2
+    batches.close()
+
+    data = MappedDataset(list(range(10)), _square_all, batched=True)
+    assert data[3] == 9
+    with ProcessPoolExecutor(2) as executor:
+        assert [i for batch in data.iter_batches(3, executor=executor) for i in batch] == [i ** 2 for i in range(10)]
+    assert list(MappedDataset(list(range(3)), _square).iter_batches(5)) == [[0, 1, 4]]
+
+
+def test_streaming_dataset(tmp_path):
+    data = IntakeDataset(_write_catalog(str(tmp_path), stack=4))
+
+    # Partitions of an item are read in order
+    ixs = [i["sample_index"] for i in StreamingDataset(data, seed=0)]
+    assert sorted(ixs) == list(range(len(data)))
+    assert ixs[ixs.index(3):ixs.index(3) + 4] == [3, 4, 5, 6]
+
+    shards = [StreamingDataset(data, rank=rank, world_size=2) for rank in range(2)]
+    ixs = [[i["sample_index"] for i in shard] for shard in shards]
+    assert sorted(ixs[0] + ixs[1]) == list(range(len(data)))
+    assert [len(i) for i in ixs] == [len(shard) for shard in shards] == [4, 3]
+
+    stream = StreamingDataset(data, shuffle_buffer=3, seed=1)
+    stream.set_epoch(2)
+    full = [i["sample_index"] for i in stream]
+    assert sorted(full) == list(range(len(data)))
+    assert full == [i["sample_index"] for i in stream]
+    assert full != list(range(len(data)))
+
+    # Resume after 3 samples
+    stream = StreamingDataset(data, shuffle_buffer=3, seed=1)
+    stream.set_epoch(2)
+    it = iter(stream)
+    assert [next(it)["sample_index"] for _ in range(3)] == full[:3]
+    state = stream.state_dict()
+    resumed = StreamingDataset(data, shuffle_buffer=3, seed=1)
+    resumed.load_state_dict(state)
+    samples = list(resumed)
+    assert [i["sample_index"] for i in samples] == full[3:]
+    assert samples[0]["position"] == 4
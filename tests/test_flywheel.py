@@ -0,0 +1,216 @@
+import io
+import os
+import numpy as np
+import pytest
+import tifffile
+
+flywheel = pytest.importorskip("flywheel")
+from intake_io.fsspec.flywheel import FlywheelFileSystem
+
+
+class _Node(dict):
+
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+
+class Group(_Node):
+    child_types = ["projects"]
+
+
+class Project(_Node):
+    child_types = ["subjects"]
+
+
+class Subject(_Node):
+    child_types = ["sessions"]
+
+
+class Session(_Node):
+    child_types = ["acquisitions"]
+
+
+class Acquisition(_Node):
+    child_types = ["files"]
+
+    def read_file(self, name, range=None, view=False):
+        data = self["contents"][name]
+        # Like the server, ignore range headers unless viewing
+        if range is not None and view and not self.get("ignore_range"):
+            start, end = map(int, range[len("bytes="):].split("-"))
+            data = data[start:end + 1]
+        self["served"].append(len(data))
+        return data
+
+
+class FileEntry(_Node):
+    pass
+
+
+class _Client:
+
+    def __init__(self, num_acquisitions=3, num_files=4):
+        self.calls = 0
+        self._nodes = {}
+        self._paths = {}
+        group = self._add(Group(id="grp", projects=[]), "grp")
+        project = self._add(Project(id="prj", label="project", subjects=[], files=[], analyses=[],
+                                    parents=dict(group="grp")), "grp/project")
+        group["projects"].append(project)
+        subject = self._add(Subject(id="sub", label="subject", sessions=[], files=[], analyses=[],
+                                    parents=dict(group="grp", project="prj")), "grp/project/subject")
+        project["subjects"].append(subject)
+        session = self._add(Session(id="ses", label="session", acquisitions=[], files=[], analyses=[],
+                                    parents=dict(group="grp", project="prj", subject="sub")),
+                            "grp/project/subject/session")
+        subject["sessions"].append(session)
+        for i in range(num_acquisitions):
+            path = f"grp/project/subject/session/acq{i}"
+            acquisition = self._add(Acquisition(id=f"acq{i}", label=f"acq{i}", files=[], analyses=[], contents={},
+                                                served=[], parents=dict(
+                group="grp", project="prj", subject="sub", session="ses")), path)
+            session["acquisitions"].append(acquisition)
+            for j in range(num_files):
+                acquisition["files"].append(self._add(FileEntry(
+                    id=f"file{i}{j}", name=f"image{j}.tif", size=j + 1, parent_ref=dict(id=f"acq{i}")),
+                    f"{path}/files/image{j}.tif"))
+                acquisition["contents"][f"image{j}.tif"] = bytes(range(j + 1))
+
+    def _add(self, node, path):
+        self._nodes[node["id"]] = node
+        self._paths[path] = node
+        return node
+
+    def groups(self):
+        self.calls += 1
+        return [self._nodes["grp"]]
+
+    def get(self, id):
+        self.calls += 1
+        return self._nodes[id]
+
+    def lookup(self, path):
+        self.calls += 1
+        return self._paths[path]
+
+
+@pytest.fixture
+def fs(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(flywheel, "Client", lambda *args, **kwargs: client)
+    return FlywheelFileSystem("host", "key", skip_instance_cache=True)
+
+
+def test_ls(fs):
+    assert fs.ls("/") == ["/grp"]
+    assert fs.ls("flywheel://host/grp/project/subject/session") == [
+        f"/grp/project/subject/session/acq{i}" for i in range(3)]
+    files = fs.ls("/grp/project/subject/session/acq1/files", detail=True)
+    assert [i["name"] for i in files] == [f"/grp/project/subject/session/acq1/files/image{j}.tif" for j in range(4)]
+    assert [i["type"] for i in files] == ["file"] * 4
+    assert [i["size"] for i in files] == [1, 2, 3, 4]
+
+
+def test_walk_is_cached(fs):
+    calls = fs._client.calls
+    out = list(fs.walk("/grp/project/subject/session"))
+    assert len(out) == 1 + 3 * 2
+    assert sorted(out[-1][2]) == [f"image{j}.tif" for j in range(4)]
+    assert fs._client.calls - calls <= 1 + 3
+
+    calls = fs._client.calls
+    assert list(fs.walk("/grp/project/subject/session")) == out
+    assert fs.info("/grp/project/subject/session/acq2/files/image3.tif")["size"] == 4
+    assert fs.size("/grp/project/subject/session/acq2/files/image1.tif") == 2
+    assert fs._client.calls == calls
+
+
+def test_info_resolves_parents(fs):
+    node = fs._client._nodes["file12"]
+    assert fs.info(node)["name"] == "grp/project/subject/session/acq1/files/image2.tif"
+    calls = fs._client.calls
+    for j in range(4):
+        fs.info(fs._client._nodes[f"file1{j}"])
+    assert fs._client.calls == calls
+
+
+def test_invalidate_cache(fs):
+    fs.ls("/grp/project/subject/session/acq0/files")
+    calls = fs._client.calls
+    fs.ls("/grp/project/subject/session/acq0/files")
+    assert fs._client.calls == calls
+    fs.invalidate_cache("/grp/project/subject/session/acq0")
+    fs.ls("/grp/project/subject/session/acq0/files")
+    assert fs._client.calls > calls
+
+    calls = fs._client.calls
+    fs.invalidate_cache()
+    fs.info(fs._client._nodes["file00"])
+    assert fs._client.calls > calls
+
+
+def test_cache_ttl(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(flywheel, "Client", lambda *args, **kwargs: client)
+    fs = FlywheelFileSystem("host", "key", cache_ttl=0, skip_instance_cache=True)
+    fs.ls("/grp/project")
+    calls = client.calls
+    fs.ls("/grp/project")
+    assert client.calls > calls
+
+
+def test_range_reads(fs):
+    path = "/grp/project/subject/session/acq0/files/image3.tif"
+    assert fs.cat_file(path) == bytes(range(4))
+    assert fs.cat_file(path, 1, 3) == bytes(range(1, 3))
+    assert fs.head(path, 2) == bytes(range(2))
+    assert fs.tail(path, 2) == bytes(range(2, 4))
+    with fs.open(path) as f:
+        f.seek(2)
+        assert f.read() == bytes(range(2, 4))
+
+
+def test_range_ignored(fs):
+    acquisition = fs._client._nodes["acq1"]
+    acquisition["ignore_range"] = True
+    acquisition["contents"]["image0.tif"] = bytes(range(200))
+    acquisition["files"][0]["size"] = 200
+    path = "/grp/project/subject/session/acq1/files/image0.tif"
+    with pytest.warns(UserWarning):
+        with fs.open(path, block_size=16, cache_type="none") as f:
+            assert [f.read(16) for _ in range(3)] == [bytes(range(i, i + 16)) for i in (0, 16, 32)]
+    # Downloaded once, not once per block
+    assert acquisition["served"] == [200]
+
+    # Dropped on invalidation
+    fs.invalidate_cache("/grp/project/subject/session/acq1")
+    with pytest.warns(UserWarning):
+        with fs.open(path, block_size=16, cache_type="none") as f:
+            f.read(16)
+    assert acquisition["served"] == [200, 200]
+
+    # Not kept if it exceeds the budget
+    fs = FlywheelFileSystem("host", "key", max_cached_contents=100, skip_instance_cache=True)
+    with pytest.warns(UserWarning):
+        with fs.open(path, block_size=16, cache_type="none") as f:
+            assert f.read(16) + f.read(16) == bytes(range(32))
+    assert acquisition["served"] == [200, 200, 200, 200]
+
+
+def test_header_only_read(fs):
+    image = np.random.randint(0, 255, (16, 512, 512), np.uint8)
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, image, imagej=True)
+    acquisition = fs._client._nodes["acq1"]
+    acquisition["contents"]["image0.tif"] = buffer.getvalue()
+    acquisition["files"][0]["size"] = len(buffer.getvalue())
+
+    path = "/grp/project/subject/session/acq1/files/image0.tif"
+    with fs.open(path, block_size=2**12) as f:
+        with tifffile.TiffFile(f) as tif:
+            assert tif.series[0].shape == image.shape
+            assert sum(acquisition["served"]) < image.nbytes / 100
+            assert np.all(tif.asarray() == image)
@@ -0,0 +1,32 @@
+import os
+import numpy as np
+import pytest
+import intake_io
+from .fixtures import *
+
+
+def test_imload_many(tmp_path):
+    images = [i for i in ramp_images() if i.dtype in (np.uint8, np.uint16, np.float32)]
+    uris = []
+    for i, img in enumerate(images):
+        uris.append(os.path.join(tmp_path, f"image{i}.nrrd"))
+        intake_io.imsave(img, uris[-1])
+    uris.insert(1, os.path.join(tmp_path, "missing.nrrd"))
+
+    for kwargs in ({}, {"max_concurrency": 1}, {"max_memory": images[0].nbytes}):
+        out = list(intake_io.imload_many(uris, **kwargs))
+        assert [uri for uri, _ in out] == uris
+        assert isinstance(out[1][1], Exception)
+        out.pop(1)
+        for img0, (_, img1) in zip(images, out):
+            assert np.mean(img0.data) == np.mean(img1["image"].data)
+
+    out = dict(intake_io.imload_many(uris, ordered=False, max_concurrency=2, max_memory=1))
+    assert set(out.keys()) == set(uris)
+
+    out = dict(intake_io.imload_many(uris, metadata_only=True))
+    assert out[uris[0]]["shape"] == images[0].shape
+
+    # Stopping early must not block on loads still in flight
+    for _ in intake_io.imload_many(uris, max_concurrency=2, max_memory=1):
+        break
@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("zmq")
+pytest.importorskip("lmdb")
+from intake_io.dataset.remote import CachedRemoteDataset, _RemoteDataset, start_server
+
+KEY = "secret"
+_LOADS = multiprocessing.get_context("fork").Value("q", 0)
+
+
+class _Data:
+
+    def __len__(self):
+        return 40
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        with _LOADS.get_lock():
+            _LOADS.value += 1
+        return {"sample_index": i, "image": np.full((32, 32), i, np.float32)}
+
+
+def _serve(port, kwargs):
+    # Own process group, so that the server and its workers can be stopped together
+    os.setpgid(0, 0)
+    start_server({"data": _Data()}, port, KEY, num_workers=2, **kwargs)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, request):
+    # The server binds its backend in the working directory
+    monkeypatch.chdir(tmp_path)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.get_context("fork").Process(target=_serve, args=(port, getattr(request, "param", {})))
+    process.start()
+    yield port
+    os.killpg(process.pid, signal.SIGKILL)
+    process.join()
+
+
+def test_remote_dataset(server):
+    data = _RemoteDataset("127.0.0.1", server, KEY, "data", max_in_flight=3, batch_size=4)
+    assert len(data) == 40
+    assert data[5]["sample_index"] == 5
+    indices = list(np.random.permutation(40))
+    out = data.get_many(indices)
+    assert [y["sample_index"] for y in out] == indices
+    assert all(np.all(y["image"] == i) for i, y in zip(indices, out))
+
+    with pytest.raises(IndexError):
+        data.get_many([1, 2, 100, 3, 4, 5, 6, 7, 8, 9])
+    # Replies to the abandoned requests are dropped
+    assert data[7]["sample_index"] == 7
+    assert [y["sample_index"] for y in data.get_many(range(10))] == list(range(10))
+
+
+def test_cached_remote_dataset(server, tmp_path):
+    data = CachedRemoteDataset("127.0.0.1", server, KEY, "data", str(tmp_path / "cache"))
+    assert data[3]["sample_index"] == 3
+    out = data.get_many(range(8))
+    assert [y["sample_index"] for y in out] == list(range(8))
+    stats = data.stats()
+    assert stats["hits"] == 1
+    assert stats["num_entries"] == 8
+    data.close()
+
+
+@pytest.mark.parametrize("codec", ["none", "lz4", "zstd"])
+def test_codec_negotiation(server, codec):
+    data = _RemoteDataset("127.0.0.1", server, KEY, "data", codec=[codec, "none"])
+    y = data[3]
+    assert data._wire_codec == codec
+    assert np.all(y["image"] == 3)
+    if codec == "none":
+        # View of the received frame
+        assert not y["image"].flags.owndata
+    with pytest.raises(ValueError):
+        _RemoteDataset("127.0.0.1", server, KEY, "data", codec="unknown")[0]
+
+
+def _wait_for_loads(n, timeout=10):
+    t = time.monotonic()
+    while _LOADS.value < n and time.monotonic() - t < timeout:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    return _LOADS.value
+
+
+@pytest.mark.parametrize("server", [{"cache_gb": 1 / 256}], indirect=True)
+def test_epoch_plan(server):
+    data = _RemoteDataset("127.0.0.1", server, KEY, "data")
+    len(data)
+    _LOADS.value = 0
+    plan = [int(i) for i in np.random.permutation(40)]
+    data.set_epoch_plan(plan)
+    assert _wait_for_loads(40) == 40
+    assert [y["sample_index"] for y in data.get_many(plan)] == plan
+    # Other clients are served from the server's cache too
+    other = _RemoteDataset("127.0.0.1", server, KEY, "data")
+    assert all(np.all(y["image"] == i) for i, y in enumerate(other.get_many(range(40))))
+    assert _LOADS.value == 40
+
+
+@pytest.mark.parametrize("server", [{"cache_gb": 1 / 256, "prefetch": 8}], indirect=True)
+def test_epoch_plan_prefetch_ahead(server):
+    data = _RemoteDataset("127.0.0.1", server, KEY, "data")
+    len(data)
+    _LOADS.value = 0
+    data.set_epoch_plan(range(40))
+    assert _wait_for_loads(8) == 8
+    data.get_many(range(4))
+    assert _wait_for_loads(12) == 12
@@ -0,0 +1,72 @@
+import io
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import tifffile
+import intake_io
+
+
+def _section(z, x, y, w, h, s):
+    # Synthetic section, value depends on world coordinates
+    yy, xx = np.meshgrid(y + np.arange(int(round(h * s))) / s, x + np.arange(int(round(w * s))) / s, indexing="ij")
+    return ((yy * 3 + xx * 5 + z * 7) % 65521).astype(np.uint16)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        z, x, y, w, h, s = re.search(r"/z/(\d+)/box/(\d+),(\d+),(\d+),(\d+),([\d.]+)/tiff-image", self.path).groups()
+        self.requests.append(self.path)
+        buffer = io.BytesIO()
+        tifffile.imwrite(buffer, _section(int(z), int(x), int(y), int(w), int(h), float(s)))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(buffer.getvalue())))
+        self.end_headers()
+        self.wfile.write(buffer.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("localhost", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _Handler.requests.clear()
+    yield f"render://localhost:{server.server_address[1]}/owner/project/stack"
+    server.shutdown()
+
+
+def test_render_source(server, tmp_path):
+    with intake_io.source.RenderSource(server, (3, 6), 100, 200, 300, 250, tile_size=64,
+                                       tile_cache=str(tmp_path)) as src:
+        img = intake_io.imload(src)["image"]
+    assert intake_io.get_axes(img) == "zyx"
+    assert img.shape == (3, 250, 300)
+    assert img.dtype == np.uint16
+    for i, z in enumerate(range(3, 6)):
+        assert np.all(img.data[i] == _section(z, 100, 200, 300, 250, 1.0))
+    # The tile fetched for the schema is reused
+    num_requests = len(_Handler.requests)
+    assert num_requests == 3 * 5 * 4
+    assert len(set(_Handler.requests)) == num_requests
+
+    # Served from tile cache
+    with intake_io.source.RenderSource(server, (3, 6), 100, 200, 300, 250, tile_size=64,
+                                       tile_cache=str(tmp_path)) as src:
+        img = intake_io.imload(src, partition=1)["image"]
+    assert np.all(img.data == _section(4, 100, 200, 300, 250, 1.0))
+    assert len(_Handler.requests) == num_requests
+
+
+def test_render_source_scaled(server):
+    with intake_io.source.RenderSource(server, 7, 0, 0, 512, 256, scale=0.5, tile_size=100) as src:
+        img = intake_io.imload(src)["image"]
+    assert img.shape == (1, 128, 256)
+    assert np.all(img.data[0] == _section(7, 0, 0, 512, 256, 0.5))
+    assert len(_Handler.requests) == 3 * 2
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from intake_io.dataset.serialization import deserialize, join_frames, serialize, serialize_frames
+
+
+def _sample():
+    return {
+        "sample_index": 3,
+        "data": xr.Dataset({"image": xr.DataArray(np.random.rand(4, 32, 32).astype(np.float32), dims=tuple("zyx"))}),
+        "labels": np.arange(32 * 32, dtype=np.uint16).reshape(32, 32),
+        "nested": {"name": "a", "values": [np.zeros(3), 1.5]}
+    }
+
+
+def _assert_equal(x, y):
+    assert x["sample_index"] == y["sample_index"]
+    assert x["data"].identical(y["data"])
+    assert np.all(x["labels"] == y["labels"])
+    assert x["nested"]["name"] == y["nested"]["name"]
+    assert np.all(x["nested"]["values"][0] == y["nested"]["values"][0])
+
+
+@pytest.mark.parametrize("cname", [None, "lz4", "zstd"])
+@pytest.mark.parametrize("key", [None, b"secret"])
+def test_round_trip(cname, key):
+    if cname is not None:
+        pytest.importorskip("blosc")
+    x = _sample()
+    _assert_equal(x, deserialize(serialize(x, key, cname), key))
+    _assert_equal(x, deserialize(bytes(serialize(x, key, cname)), key))
+    _assert_equal(x, deserialize(serialize_frames(x, key, cname), key))
+
+
+def test_zero_copy():
+    x = _sample()
+    data = memoryview(bytes(serialize(x)))
+    y = deserialize(data)
+    assert not y["labels"].flags.owndata
+    assert not y["labels"].flags.writeable
+    assert np.shares_memory(y["labels"], np.frombuffer(data, np.uint8))
+    assert (y["labels"].ctypes.data - np.frombuffer(data, np.uint8).ctypes.data) % 64 == 0
+
+    frames = serialize_frames(x)
+    assert any(np.shares_memory(np.frombuffer(f, np.uint8), x["labels"]) for f in frames[1:])
+
+
+def test_hmac():
+    x = _sample()
+    data = serialize(x, b"secret")
+    with pytest.raises(ValueError):
+        deserialize(data, b"other")
+    with pytest.raises(ValueError):
+        deserialize(serialize(x), b"secret")
+    data[-100] ^= 1
+    with pytest.raises(ValueError):
+        deserialize(data, b"secret")
+
+
+@pytest.mark.parametrize("wire", [None, "lz4"])
+@pytest.mark.parametrize("cname", [None, "zstd"])
+def test_join_frames(wire, cname):
+    if wire is not None or cname is not None:
+        pytest.importorskip("blosc")
+    x = _sample()
+    frames = serialize_frames(x, b"secret", cname=wire)
+    y = join_frames(frames, b"secret", cname=cname)
+    _assert_equal(x, deserialize(y))
+    if wire is None and cname is None:
+        assert len(y) == len(serialize(x))
+    with pytest.raises(ValueError):
+        join_frames([*frames[:-1], bytes(len(frames[-1]))], b"secret")
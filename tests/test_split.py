@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from intake_io.dataset import BalancedSampler, Dataset, SubsetDataset, kfold_split, shuffle_split
+
+
+class _Data(Dataset):
+
+    def __init__(self, metadata):
+        super().__init__()
+        self.metadata = metadata
+        self.calls = 0
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def _load_index(self, i):
+        return {}
+
+    def get_metadata(self, i):
+        self.calls += 1
+        return self.metadata[i]
+
+    def get_category(self, i):
+        return self.metadata[i]["category"]
+
+
+def _metadata(n=100):
+    return [{"category": "a" if i % 4 else "b", "subject": i // 5} for i in range(n)]
+
+
+def test_shuffle_split():
+    metadata = _metadata()
+    metadata[3]["must_be_in_validation_set"] = True
+    metadata[7]["must_be_in_train_set"] = True
+    data = _Data(metadata)
+    split = shuffle_split(data, 0.2, stratify=True, seed=0)
+    assert data.calls == len(data)
+    trn, val = split["trn"]._ixs, split["val"]._ixs
+    assert sorted(trn + val) == list(range(len(data)))
+    assert 3 in val and 7 in trn
+    assert len(val) == 20
+    assert sum(metadata[i]["category"] == "b" for i in val) == 5
+    assert shuffle_split(data, 0.2, stratify=True, seed=0)["val"]._ixs == val
+    assert shuffle_split(data, 0.2, stratify=True, seed=1)["val"]._ixs != val
+
+    # Groups aren't split
+    split = shuffle_split(data, 0.2, groups="subject", seed=0)
+    subjects = [{metadata[i]["subject"] for i in split[k]._ixs} for k in ("trn", "val")]
+    assert len(subjects[0] & subjects[1]) == 0
+    assert len(split["val"]) == 20
+
+    metadata[4]["must_be_in_train_set"] = True
+    with pytest.raises(ValueError):
+        shuffle_split(_Data(metadata), groups="subject")
+
+
+def test_kfold_split():
+    metadata = _metadata()
+    metadata[3]["must_be_in_validation_set"] = True
+    metadata[7]["must_be_in_train_set"] = True
+    splits = kfold_split(_Data(metadata), 5, stratify=True, groups=lambda data, i: data.metadata[i]["subject"], seed=0)
+    assert len(splits) == 5
+    val = [set(split["val"]._ixs) for split in splits]
+    # Pinned samples pin their subjects, 0 and 1
+    counts = np.bincount([i for ixs in val for i in ixs], minlength=len(metadata))
+    assert np.all(counts[:5] == 5) and np.all(counts[5:10] == 0)
+    assert np.all(counts[10:] == 1)
+    assert all(abs(len(i) - 23) <= 5 for i in val)
+    assert all(sorted(split["trn"]._ixs + split["val"]._ixs) == list(range(len(metadata))) for split in splits)
+
+
+def test_balanced_sampler():
+    metadata = [{"category": "a" if i < 90 else "b" if i < 99 else "c"} for i in range(100)]
+    data = _Data(metadata)
+    sampler = BalancedSampler(data, num_samples=30000, seed=0)
+    ixs = np.array(list(sampler))
+    assert len(ixs) == len(sampler) == 30000
+    counts = np.bincount(np.searchsorted([90, 99], ixs, side="right"), minlength=3)
+    assert np.allclose(counts / len(ixs), 1 / 3, atol=0.02)
+    assert np.array_equal(list(sampler), ixs)
+    sampler.set_epoch(1)
+    assert not np.array_equal(list(sampler), ixs)
+
+    sampler = BalancedSampler(data, num_samples=20, replacement=False, weights={"a": 1, "c": 1})
+    ixs = list(sampler)
+    assert len(set(ixs)) == 20
+    assert 99 in ixs and not any(90 <= i < 99 for i in ixs)
+    with pytest.raises(ValueError):
+        BalancedSampler(data, num_samples=92, replacement=False, weights={"a": 1, "c": 1})
+
+    # Subsets are sampled by position
+    subset = SubsetDataset(data, tuple(range(85, 100)))
+    ixs = np.array(list(BalancedSampler(subset, num_samples=3000)))
+    assert ixs.max() < len(subset)
+    assert np.allclose(np.mean(ixs < 5), 1 / 3, atol=0.05)
@@ -0,0 +1,56 @@
+import os
+import time
+import numpy as np
+import pytest
+import intake_io
+from .fixtures import *
+
+
+def test_stats(tmp_path):
+    fpath = os.path.join(tmp_path, "stats.tif")
+    img0 = next(i for i in ramp_images() if i.dtype == np.uint16)
+    intake_io.imsave(img0, fpath, compress=False)
+
+    with intake_io.source.TifSource(fpath) as src:
+        intake_io.imload(src)
+        stats = src.stats()
+    for phase in ("open", "schema", "decode", "reorder"):
+        assert stats[phase]["count"] == 0
+    assert stats["bytes_read"] == stats["bytes_output"] == 0
+
+    calls = []
+    intake_io.source.set_stats_callback(lambda src, phase, seconds: calls.append(phase))
+    try:
+        with intake_io.source.TifSource(fpath, collect_stats=True) as src:
+            img1 = intake_io.imload(src)["image"]
+            stats = src.stats()
+    finally:
+        intake_io.source.set_stats_callback(None)
+
+    for phase in ("open", "schema", "decode", "reorder"):
+        assert stats[phase]["count"] >= 1
+        assert stats[phase]["seconds"] >= 0
+        assert phase in calls
+    assert stats["bytes_read"] > 0
+    assert stats["bytes_output"] == img1.nbytes
+
+    src.reset_stats()
+    assert src.stats()["decode"]["count"] == 0
+
+
+def test_stats_phases_disjoint(tmp_path, monkeypatch):
+    fpath = os.path.join(tmp_path, "stats.tif")
+    img0 = next(i for i in ramp_images() if i.dtype == np.uint16)
+    intake_io.imsave(img0, fpath, compress=False)
+
+    # Opening the file happens while loading the schema
+    open_file = intake_io.source.TifSource._open_file
+    monkeypatch.setattr(intake_io.source.TifSource, "_open_file", lambda self: time.sleep(0.2) or open_file(self))
+    t0 = time.perf_counter()
+    with intake_io.source.TifSource(fpath, collect_stats=True) as src:
+        intake_io.imload(src)
+        stats = src.stats()
+    seconds = time.perf_counter() - t0
+    assert stats["open"]["seconds"] >= 0.2
+    assert stats["schema"]["seconds"] < 0.2
+    assert sum(stats[phase]["seconds"] for phase in ("open", "schema", "decode", "reorder")) <= seconds
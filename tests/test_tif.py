@@ -86,3 +86,27 @@ def test_load_from_url():
     assert img["image"].shape == (7, 3, 5, 167, 439)
     assert img["image"].dtype == np.int8
     assert intake_io.get_axes(img) == "tczyx"
+
+
+def test_load_with_filecache(tmp_path):
+    import fsspec
+
+    img0 = next(i for i in ramp_images() if i.dtype == np.uint16)
+    fpath = os.path.join(tmp_path, "ramp.tif")
+    intake_io.imsave(img0, fpath, compress=False)
+    fs = fsspec.filesystem("memory")
+    fs.put(fpath, "/filecache/ramp.tif")
+
+    cache_dir = os.path.join(tmp_path, "cache")
+    try:
+        for _ in range(2):
+            img1 = intake_io.imload("memory://filecache/ramp.tif", filecache=cache_dir, cache_type="readahead",
+                                    block_size=2**16)["image"]
+            assert img0.shape == img1.shape
+            assert np.mean(img0.data) == np.mean(img1.data)
+            assert len(os.listdir(cache_dir)) > 0
+    finally:
+        fs.rm("/filecache", recursive=True)
+
+    with pytest.raises(ValueError):
+        intake_io.source.TifSource(fpath, cache_type="unknown")